@@ -0,0 +1,11 @@
+"""
+Benchmarks for the messenger. Each module is a runnable script and works on a
+throwaway test database, never on the configured one:
+
+    python -m benchmarks                 seed, HTTP harness and WebSocket load, one JSON file
+    python -m benchmarks.seed            seeded data generator
+    python -m benchmarks.harness         query counts and latency of the hot HTTP paths
+    python -m benchmarks.ws_load         thousands of ChatConsumer sockets, fan-out latency
+    python -m benchmarks.async_views     async views against the sync views they replaced
+    python -m benchmarks.compare a b     diff two result files
+"""
@@ -0,0 +1,42 @@
+"""
+Run the whole suite on one seeded dataset and write a single JSON file.
+
+    python -m benchmarks --output bench.json
+    python -m benchmarks --users 5000 --chats 20000 --messages 1000000 --skip-ws
+    python -m benchmarks.group_fanout --group-sizes 10,100,1000,5000
+"""
+import argparse
+import random
+
+from benchmarks import group_fanout, harness, runtime, ws_load
+from benchmarks.seed import add_arguments as add_seed_arguments, seed_from_args
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__.split('\n\n')[0])
+    add_seed_arguments(parser)
+    harness.add_arguments(parser)
+    ws_load.add_arguments(parser)
+    group_fanout.add_arguments(parser)
+    parser.add_argument('--skip-ws', action='store_true', help="Skip the WebSocket load driver.")
+    parser.add_argument('--skip-groups', action='store_true', help="Skip the group chat fan-out rooms.")
+    parser.add_argument('--output', default='bench.json', help="JSON results file (default: bench.json).")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with runtime.test_database():
+        dataset = seed_from_args(args)
+        results = {'http': harness.run_scenarios(args.iterations, args.sample_users, rng)}
+        harness.print_results(results['http'])
+        if not args.skip_ws:
+            results['websocket'] = ws_load.run(args, rng)
+            ws_load.print_results(results['websocket'])
+        if not args.skip_groups:
+            results['groups'] = group_fanout.run(args)
+            group_fanout.print_results(results['groups'])
+        runtime.write_results(args.output, 'all', {**runtime.params(args), 'dataset': dataset}, results)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
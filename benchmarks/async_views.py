@@ -0,0 +1,137 @@
+"""
+p50/p99 latency of the async chat API views against the sync views they
+replaced, under concurrent load.
+
+    python -m benchmarks.async_views --concurrency 50 --requests 2000
+
+Requests go through Django's ASGI request handling with AsyncClient. The sync
+baselines are in benchmarks.sync_views: the pre-async implementations, on the
+sync ORM and helpers, which Django runs on its sync worker thread. Before
+timing, both are checked to give the same responses on a sample of requests.
+"""
+import argparse
+import asyncio
+import random
+import time
+from urllib.parse import quote
+
+from benchmarks import runtime, sync_views
+from benchmarks.seed import add_arguments as add_seed_arguments, seed_from_args
+
+from django.test import AsyncClient, override_settings
+from django.urls import path
+
+from comms import views
+from comms.models import ChatMembership
+
+# name: (async view, sync view, route)
+ENDPOINTS = {
+    'chat_list': (views.chat_list_api, sync_views.chat_list_api, 'chat_list/'),
+    'chat_status': (views.chat_status_api, sync_views.chat_status_api, 'chat_status/'),
+    'history': (views.chat_messages_api, sync_views.chat_messages_api, 'history/<int:chat_id>/'),
+    'search': (views.search_users, sync_views.search_users, 'search/'),
+}
+
+urlpatterns = [
+    path(f'{mode}/{route}', sync_view if mode == 'sync' else async_view)
+    for mode in ('sync', 'async')
+    for async_view, sync_view, route in ENDPOINTS.values()
+]
+
+
+def load_pairs():
+    """[(user, chat, other)] for every member of a seeded direct chat with messages."""
+    pairs = []
+    memberships = ChatMembership.objects.filter(last_message__isnull=False, chat__is_group=False) \
+        .select_related('user', 'chat').prefetch_related('chat__participants')
+    for membership in memberships:
+        others = [p for p in membership.chat.participants.all() if p.id != membership.user_id]
+        pairs.append((membership.user, membership.chat, others[0] if others else membership.user))
+    return pairs
+
+
+def request_path(mode, name, user, chat, other):
+    if name == 'chat_status':
+        return f'/{mode}/chat_status/?phone={quote(other.phone)}'
+    if name == 'history':
+        return f'/{mode}/history/{chat.id}/'
+    if name == 'search':
+        return f'/{mode}/search/?q=lunch'
+    return f'/{mode}/chat_list/'
+
+
+async def check_parity(clients, pairs, rng, samples=20):
+    """Fail unless the sync and async view of each endpoint answer a sample of requests alike."""
+    for name in ENDPOINTS:
+        for user, chat, other in rng.sample(pairs, min(samples, len(pairs))):
+            sync, async_ = [
+                await clients[user.id].get(request_path(mode, name, user, chat, other)) for mode in ('sync', 'async')
+            ]
+            if (sync.status_code, sync.content) != (async_.status_code, async_.content):
+                raise AssertionError(f"{name}: the sync and async views differ for user {user.id}")
+
+
+async def run_load(clients, pairs, mode, name, total, concurrency, rng):
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for _ in range(total):
+        queue.put_nowait(rng.choice(pairs))
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            user, chat, other = queue.get_nowait()
+            start = time.perf_counter()
+            response = await clients[user.id].get(request_path(mode, name, user, chat, other))
+            latencies.append(time.perf_counter() - start)
+            errors += response.status_code != 200
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+async def benchmark(pairs, args, rng):
+    clients = {}
+    for user, _, _ in pairs:
+        if user.id not in clients:
+            clients[user.id] = AsyncClient()
+            await clients[user.id].aforce_login(user)
+
+    await check_parity(clients, pairs, rng)
+    results = {}
+    print(f"{'endpoint':<12} {'mode':<6} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8} {'errors':>7}")
+    for name in ENDPOINTS:
+        for mode in ('sync', 'async'):
+            latencies, errors, elapsed = await run_load(
+                clients, pairs, mode, name, args.requests, args.concurrency, rng
+            )
+            summary = runtime.summarize(latencies)
+            results[f'{name}.{mode}'] = {
+                **summary, 'requests_per_second': round(len(latencies) / elapsed, 1), 'errors': errors,
+            }
+            print(f"{name:<12} {mode:<6} {summary['p50_ms']:>8.2f} {summary['p99_ms']:>8.2f} "
+                  f"{len(latencies) / elapsed:>8.0f} {errors:>7}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    add_seed_arguments(parser)
+    parser.add_argument('--requests', type=int, default=1000, help="Requests per endpoint and mode.")
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    parser.set_defaults(users=200, chats=1000, messages=50000)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with runtime.test_database(), override_settings(ROOT_URLCONF=__name__):
+        dataset = seed_from_args(args)
+        results = asyncio.run(benchmark(load_pairs(), args, rng))
+        if args.output:
+            runtime.write_results(args.output, 'async_views', {**runtime.params(args), 'dataset': dataset}, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""
+Compare two benchmark JSON files, e.g. from two commits.
+
+    python -m benchmarks.compare before.json after.json
+
+Prints every numeric result present in both files with its relative change.
+Does not need Django or a database.
+"""
+import argparse
+import json
+
+
+def flatten(value, prefix=''):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, f'{prefix}.{key}' if prefix else key)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print(f"before: {before.get('commit')}  after: {after.get('commit')}")
+    old = dict(flatten(before['results']))
+    new = dict(flatten(after['results']))
+    width = max((len(key) for key in old.keys() & new.keys()), default=10)
+    for key in sorted(old.keys() & new.keys()):
+        change = f"{(new[key] - old[key]) / old[key] * 100:+.1f}%" if old[key] else 'n/a'
+        print(f"{key:<{width}} {old[key]:>12} {new[key]:>12} {change:>9}")
+
+
+if __name__ == '__main__':
+    main()
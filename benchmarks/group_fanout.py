@@ -0,0 +1,131 @@
+"""
+Group chat fan-out: send latency as the room grows.
+
+    python -m benchmarks.group_fanout --group-sizes 10,100,1000,5000 \
+        --group-messages 50 --group-listeners 20 --output groups.json
+
+For each room size it builds a group chat with that many members and opens a
+ws/chats/ socket for `listeners` of them, the first of which sends
+`messages` messages one after another, each once every listener has the one
+before. Reports per size the latency from send to the sender's own echo and
+to the last listener's frame, and the queries each message frame ran. Group
+chats count messages and receipts per chat and per member watermark (see
+comms.groups), so neither should grow with the room.
+"""
+import argparse
+import asyncio
+import json
+import time
+from unittest import mock
+
+from benchmarks import runtime
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from comms import metrics
+from comms.membership import ensure_memberships
+from comms.models import Chat, User
+from comms.routing import websocket_urlpatterns
+
+
+def build_room(size, room):
+    """A group chat with `size` new members. Returns (chat, members)."""
+    users = User.objects.bulk_create(
+        [User(username=f'room{room}_{i}', phone=f'+7{room:02d}{i:08d}', name=f'Member {i}') for i in range(size)]
+    )
+    chat = Chat.objects.create(is_group=True)
+    Chat.participants.through.objects.bulk_create(
+        [Chat.participants.through(chat_id=chat.id, user_id=user.id) for user in users]
+    )
+    ensure_memberships(chat)
+    return chat, users
+
+
+async def measure(chat, listeners, messages, timeout):
+    application = URLRouter(websocket_urlpatterns)
+    sockets = []
+    for user in listeners:
+        communicator = WebsocketCommunicator(application, '/ws/chats/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect(timeout=timeout)
+        if connected:
+            sockets.append(communicator)
+
+    async def arrival(communicator, text):
+        # Presence frames of the other listeners come in between
+        while True:
+            frame = json.loads(await communicator.receive_from(timeout=timeout))
+            if frame.get('type') == 'message' and frame['message'] == text:
+                return time.perf_counter()
+
+    echo, fan_out = [], []
+    sender = sockets[0]
+    for n in range(messages):
+        text = f'bench {n}'
+        start = time.perf_counter()
+        await sender.send_to(text_data=json.dumps({'type': 'message', 'chat_id': chat.id, 'message': text}))
+        arrivals = await asyncio.gather(*(arrival(communicator, text) for communicator in sockets))
+        echo.append(arrivals[0] - start)
+        fan_out.append(max(arrivals) - start)
+
+    await asyncio.gather(*(communicator.disconnect() for communicator in sockets))
+    return len(sockets), echo, fan_out
+
+
+def run(args):
+    """{room size: results}, keyed by str so benchmarks.compare lines the sizes up."""
+    results = {}
+    for room, size in enumerate(args.group_sizes):
+        chat, members = build_room(size, room)
+        with mock.patch.object(metrics, 'check_budget') as check_budget:
+            listeners, echo, fan_out = asyncio.run(
+                measure(chat, members[:args.group_listeners], args.group_messages, args.group_timeout)
+            )
+        queries = [call.args[1] for call in check_budget.call_args_list if call.args[0] == 'ws:message']
+        results[str(size)] = {
+            'members': size,
+            'listeners': listeners,
+            'echo_latency': runtime.summarize(echo),
+            'fan_out_latency': runtime.summarize(fan_out),
+            'queries_min': min(queries, default=None),
+            'queries_max': max(queries, default=None),
+        }
+    return results
+
+
+def print_results(results):
+    print(f"{'members':>8} {'listeners':>9} {'echo p50':>9} {'echo p99':>9} {'fan-out p50':>12} {'fan-out p99':>12} {'queries':>8}")
+    for r in results.values():
+        queries = str(r['queries_min']) if r['queries_min'] == r['queries_max'] else f"{r['queries_min']}-{r['queries_max']}"
+        echo, fan_out = r['echo_latency'], r['fan_out_latency']
+        print(f"{r['members']:>8} {r['listeners']:>9} {echo['p50_ms']:>9.2f} {echo['p99_ms']:>9.2f} "
+              f"{fan_out['p50_ms']:>12.2f} {fan_out['p99_ms']:>12.2f} {queries:>8}")
+
+
+def sizes(value):
+    return [int(size) for size in value.split(',')]
+
+
+def add_arguments(parser):
+    parser.add_argument('--group-sizes', type=sizes, default=[10, 100, 1000], help="Comma-separated room sizes.")
+    parser.add_argument('--group-messages', type=int, default=30, help="Messages sent in each room.")
+    parser.add_argument('--group-listeners', type=int, default=10, help="Members with a socket open, sender included.")
+    parser.add_argument('--group-timeout', type=float, default=30, help="Seconds to wait for any one frame.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    add_arguments(parser)
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    args = parser.parse_args()
+
+    with runtime.test_database():
+        results = run(args)
+        print_results(results)
+        if args.output:
+            runtime.write_results(args.output, 'group_fanout', runtime.params(args), results)
+
+
+if __name__ == '__main__':
+    main()
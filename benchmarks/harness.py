@@ -0,0 +1,136 @@
+"""
+Query counts and latency of the hot HTTP paths on a seeded dataset.
+
+    python -m benchmarks.harness --users 1000 --chats 3000 --messages 100000 \
+        --iterations 200 --output harness.json
+
+Each scenario runs through the test client (middleware, auth and all) for a
+sample of users, heaviest first, and records per-request latency and the
+number of queries. Chat lists are measured cold (cache cleared) and warm.
+"""
+import argparse
+import random
+import time
+
+from benchmarks import runtime
+from benchmarks.seed import WORDS, add_arguments as add_seed_arguments, seed_from_args
+
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from comms.models import ChatMembership, Message, User
+
+
+def sample_users(count, rng):
+    """The heaviest users (most chats) plus a random spread of the rest."""
+    by_load = list(
+        User.objects.annotate(n=Count('memberships')).filter(n__gt=0).order_by('-n').values_list('id', flat=True)
+    )
+    heavy = by_load[:count // 2]
+    rest = by_load[count // 2:]
+    return heavy + rng.sample(rest, min(len(rest), count - len(heavy)))
+
+
+class Scenario:
+    """A named request built per iteration from (user, membership, rng)."""
+
+    def __init__(self, name, build, before=None):
+        self.name = name
+        self.build = build
+        self.before = before
+
+
+def _history_older(user, membership, rng):
+    ids = list(Message.objects.filter(chat_id=membership.chat_id).order_by('-id').values_list('id', flat=True)[:500])
+    return 'get', f'/api/chats/{membership.chat_id}/messages/', {'before_id': rng.choice(ids)}
+
+
+def _get_or_create_chat(user, membership, rng):
+    others = [p for p in membership.chat.participants.all() if p.id != user.id] or [user]
+    return 'post', '/api/get_or_create_chat/', {'phone': others[0].phone}
+
+
+SCENARIOS = [
+    Scenario('chat_list_cold', lambda user, m, rng: ('get', '/api/chats/', {}), before=cache.clear),
+    Scenario('chat_list_warm', lambda user, m, rng: ('get', '/api/chats/', {})),
+    Scenario('search', lambda user, m, rng: ('get', '/api/search-users', {'q': rng.choice(WORDS)})),
+    Scenario('history_latest', lambda user, m, rng: ('get', f'/api/chats/{m.chat_id}/messages/', {})),
+    Scenario('history_older', _history_older),
+    Scenario('get_or_create_chat', _get_or_create_chat),
+]
+
+
+def run_scenarios(iterations, sample_size, rng, scenarios=SCENARIOS):
+    users = User.objects.in_bulk(sample_users(sample_size, rng))
+    memberships = {}
+    for membership in ChatMembership.objects.filter(user_id__in=users, last_message__isnull=False) \
+            .select_related('chat').prefetch_related('chat__participants'):
+        memberships.setdefault(membership.user_id, []).append(membership)
+    users = {user_id: user for user_id, user in users.items() if user_id in memberships}
+
+    clients = {}
+    for user_id, user in users.items():
+        clients[user_id] = Client()
+        clients[user_id].force_login(user)
+
+    results = {}
+    for scenario in scenarios:
+        latencies, queries, errors = [], [], 0
+        for _ in range(iterations):
+            user_id = rng.choice(list(users))
+            method, path, data = scenario.build(users[user_id], rng.choice(memberships[user_id]), rng)
+            if scenario.before:
+                scenario.before()
+            client = clients[user_id]
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                if method == 'post':
+                    response = client.post(path, data, content_type='application/json')
+                else:
+                    response = client.get(path, data)
+                latencies.append(time.perf_counter() - start)
+            queries.append(len(captured))
+            errors += response.status_code != 200
+
+        results[scenario.name] = {
+            **runtime.summarize(latencies),
+            'queries_min': min(queries),
+            'queries_max': max(queries),
+            'errors': errors,
+        }
+    return results
+
+
+def print_results(results):
+    print(f"{'scenario':<20} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>9} {'errors':>7}")
+    for name, r in results.items():
+        queries = str(r['queries_min']) if r['queries_min'] == r['queries_max'] else f"{r['queries_min']}-{r['queries_max']}"
+        print(f"{name:<20} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f} {queries:>9} {r['errors']:>7}")
+
+
+def add_arguments(parser):
+    parser.add_argument('--iterations', type=int, default=200, help="Requests per scenario.")
+    parser.add_argument('--sample-users', type=int, default=50)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    add_seed_arguments(parser)
+    add_arguments(parser)
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with runtime.test_database():
+        dataset = seed_from_args(args)
+        results = run_scenarios(args.iterations, args.sample_users, rng)
+        print_results(results)
+        if args.output:
+            runtime.write_results(args.output, 'harness', {**runtime.params(args), 'dataset': dataset}, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Shared plumbing for the benchmark scripts: Django setup, a throwaway test
+database, percentile summaries and JSON result files.
+
+Import this module before anything that touches models; it configures Django.
+"""
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'messenger.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.test.utils import setup_test_environment, teardown_test_environment  # noqa: E402
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+@contextmanager
+def test_database():
+    """Create the test database for the configured backend and drop it afterwards."""
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def summarize(seconds):
+    """Latency summary in milliseconds for a list of durations in seconds."""
+    if not seconds:
+        return {'count': 0}
+    ms = sorted(s * 1000 for s in seconds)
+    cuts = statistics.quantiles(ms, n=100, method='inclusive') if len(ms) > 1 else [ms[0]] * 99
+    return {
+        'count': len(ms),
+        'mean_ms': round(statistics.fmean(ms), 3),
+        'p50_ms': round(cuts[49], 3),
+        'p95_ms': round(cuts[94], 3),
+        'p99_ms': round(cuts[98], 3),
+        'max_ms': round(ms[-1], 3),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def params(args):
+    """Command-line arguments worth recording with the results."""
+    return {key: value for key, value in vars(args).items() if key != 'output'}
+
+
+def write_results(path, suite, params, results):
+    """
+    Write one run as JSON: the suite name, the commit it ran against, the
+    parameters and the results, so runs can be diffed across commits.
+    """
+    document = {
+        'suite': suite,
+        'commit': git_revision(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'params': params,
+        'results': results,
+    }
+    Path(path).write_text(json.dumps(document, indent=2) + '\n')
+    return document
@@ -0,0 +1,152 @@
+"""
+Seeded data generator.
+
+Builds N users, M chats and K messages with the skew real messengers show: a
+few users are in many chats, a few chats carry most of the traffic (both
+Zipf-distributed), and only the tail of each chat is unread. The same
+arguments and seed always produce the same dataset.
+
+    python -m benchmarks.seed --users 1000 --chats 5000 --messages 200000
+
+Run standalone it seeds a test database and prints what it built.
+"""
+import argparse
+import itertools
+import random
+import time
+
+from benchmarks import runtime
+
+from django.contrib.auth.hashers import make_password
+
+from comms.direct_chats import pair_key
+from comms.membership import rebuild_memberships
+from comms.models import Chat, Message, User
+
+WORDS = (
+    'hello hi hey ok okay sure thanks lunch dinner coffee meeting tomorrow today tonight later soon '
+    'call me when are you free see you there running late on my way sounds good great nice love it '
+    'did you get the file photo link address ticket train flight hotel weekend plans birthday party'
+).split()
+
+
+def zipf_weights(n, s=1.1):
+    return [1 / (rank ** s) for rank in range(1, n + 1)]
+
+
+def seed_dataset(users=1000, chats=3000, messages=100000, group_fraction=0.05, unread_tail=5,
+                 seed=0, batch_size=5000):
+    """
+    Populate the database and return a summary dict. Returns ids only, so
+    callers can choose which rows to load.
+    """
+    rng = random.Random(seed)
+    started = time.perf_counter()
+
+    password = make_password('bench')
+    User.objects.bulk_create(
+        [
+            User(username=f'bench_{i}', phone=f'+65{i:08d}', password=password, name=f'Bench User {i}')
+            for i in range(users)
+        ],
+        batch_size=batch_size,
+    )
+    user_ids = list(User.objects.filter(username__startswith='bench_').order_by('id').values_list('id', flat=True))
+    user_weights = list(itertools.accumulate(zipf_weights(len(user_ids), s=0.8)))
+
+    # Chat participants: one Zipf-popular user plus partners
+    participant_sets = []
+    seen_pairs = set()
+    attempts = 0
+    while len(participant_sets) < chats and attempts < chats * 10:
+        attempts += 1
+        hub = rng.choices(user_ids, cum_weights=user_weights)[0]
+        if rng.random() < group_fraction:
+            members = {hub, *rng.sample(user_ids, rng.randint(2, 7))}
+            participant_sets.append((True, members))
+            continue
+        other = rng.choice(user_ids)
+        key = pair_key(hub, other)
+        if key in seen_pairs:
+            continue
+        seen_pairs.add(key)
+        participant_sets.append((False, {hub, other}))
+
+    chat_objs = Chat.objects.bulk_create(
+        [
+            Chat(is_group=True) if is_group else Chat(pair_low_id=min(members), pair_high_id=max(members))
+            for is_group, members in participant_sets
+        ],
+        batch_size=batch_size,
+    )
+    links = [
+        Chat.participants.through(chat_id=chat.id, user_id=user_id)
+        for chat, (_, members) in zip(chat_objs, participant_sets)
+        for user_id in members
+    ]
+    Chat.participants.through.objects.bulk_create(links, batch_size=batch_size)
+
+    # Messages: Zipf over chats, in send order; the last few per chat stay unread
+    chat_ids = [chat.id for chat in chat_objs]
+    members = {chat.id: sorted(m) for chat, (_, m) in zip(chat_objs, participant_sets)}
+    chat_weights = list(itertools.accumulate(zipf_weights(len(chat_ids))))
+    targets = rng.choices(chat_ids, cum_weights=chat_weights, k=messages)
+    per_chat = {}
+    for chat_id in targets:
+        per_chat[chat_id] = per_chat.get(chat_id, 0) + 1
+    unread_from = {chat_id: count - rng.randint(0, unread_tail) for chat_id, count in per_chat.items()}
+
+    position = dict.fromkeys(per_chat, 0)
+    batch = []
+    for chat_id in targets:
+        position[chat_id] += 1
+        read = position[chat_id] <= unread_from[chat_id]
+        batch.append(Message(
+            chat_id=chat_id,
+            sender_id=rng.choice(members[chat_id]),
+            text=' '.join(rng.choices(WORDS, k=rng.randint(2, 14))),
+            delivered=True,
+            read=read,
+        ))
+        if len(batch) >= batch_size:
+            Message.objects.bulk_create(batch)
+            batch = []
+    Message.objects.bulk_create(batch)
+
+    rebuild_memberships(batch_size=batch_size)
+
+    return {
+        'users': len(user_ids),
+        'chats': len(chat_ids),
+        'group_chats': sum(1 for is_group, _ in participant_sets if is_group),
+        'messages': messages,
+        'busiest_chat_messages': max(per_chat.values(), default=0),
+        'seconds': round(time.perf_counter() - started, 2),
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--chats', type=int, default=3000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--group-fraction', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def seed_from_args(args):
+    return seed_dataset(
+        users=args.users, chats=args.chats, messages=args.messages,
+        group_fraction=args.group_fraction, seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    add_arguments(parser)
+    args = parser.parse_args()
+    with runtime.test_database():
+        print(seed_from_args(args))
+
+
+if __name__ == '__main__':
+    main()
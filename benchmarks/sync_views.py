@@ -0,0 +1,199 @@
+"""
+Sync baselines for benchmarks.async_views: the chat API views as they were
+before they became async, ported to the current helpers so that they return
+the same responses. Each one uses the sync ORM, cache and helper functions, so
+Django runs it on its sync worker thread like any sync view under ASGI.
+"""
+from functools import wraps
+
+from django.contrib.auth.decorators import login_required
+from django.db.models import F, Q
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.utils.timezone import localtime
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import require_GET
+
+from comms.chat_list import chat_list_validators, get_cached_chat_list, get_chat_list_version, split_chat_list
+from comms.direct_chats import find_direct_chat_by_phone
+from comms.groups import receipt_counts
+from comms.history import clamp_page_size, get_message_page
+from comms.membership import get_unread_count
+from comms.models import ArchivedChat, Chat, ChatMembership, User
+from comms.presence import presence_stamp, with_presence
+from comms.search import clamp_page_size as clamp_search_page_size, search_messages
+from comms.serializers import MessageSerializer
+from comms.utils import format_phone, get_avatar_url
+
+
+def chat_list_conditional(view):
+    @wraps(view)
+    def inner(request, *args, **kwargs):
+        version = get_chat_list_version(request.user.id)
+        chats = with_presence(get_cached_chat_list(request.user))
+        etag, last_modified = chat_list_validators(request.user.id, version, presence_stamp(chats))
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = view(request, *args, chats=chats, **kwargs)
+        if request.method in ('GET', 'HEAD'):
+            response.headers.setdefault('ETag', etag)
+            response.headers.setdefault('Last-Modified', http_date(last_modified))
+        return response
+    return inner
+
+
+@login_required
+@cache_control(private=True, no_cache=True)
+@chat_list_conditional
+def chat_list_api(request, chats):
+    user = request.user
+    return JsonResponse({
+        "profile_pic": get_avatar_url(user, 'large'),
+        "name": user.name,
+        "about": user.about,
+        **split_chat_list(chats),
+    })
+
+
+@login_required
+@require_GET
+def chat_status_api(request):
+    phone = request.GET.get('phone')
+    user = request.user
+    if not phone:
+        return JsonResponse({'error': 'Missing phone parameter'}, status=400)
+
+    chat = find_direct_chat_by_phone(user, phone)
+    if not chat:
+        return JsonResponse({'error': 'Chat not found'}, status=404)
+
+    unread_messages_count = get_unread_count(user, chat)
+    return JsonResponse({
+        'is_archived': ArchivedChat.objects.filter(user=user, chat=chat).exists(),
+        'has_unread': unread_messages_count > 0,
+        'unread_count': unread_messages_count,
+        'is_favourite': user.favourite_chats.filter(pk=chat.pk).exists(),
+    })
+
+
+@login_required
+@require_GET
+def chat_messages_api(request, chat_id):
+    chat = get_object_or_404(Chat, pk=chat_id, participants=request.user)
+
+    try:
+        before_id = int(request.GET['before_id']) if request.GET.get('before_id') else None
+        after_id = int(request.GET['after_id']) if request.GET.get('after_id') else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    if before_id is not None and after_id is not None:
+        return JsonResponse({'error': 'Use either before_id or after_id, not both'}, status=400)
+
+    limit = clamp_page_size(request.GET.get('limit'))
+    messages, has_more = get_message_page(chat, before_id=before_id, after_id=after_id, limit=limit)
+
+    data = MessageSerializer(messages, many=True).data
+    if chat.is_group:
+        counts = receipt_counts(chat.id, messages)
+        data = [{**message, **counts[message['id']]} for message in data]
+    return JsonResponse({'messages': data, 'has_more': has_more})
+
+
+@login_required
+def search_users(request):
+    query = request.GET.get('q', '').strip()
+    user = request.user
+    if not query:
+        return JsonResponse({'chats': [], 'people': [], 'messages': []})
+
+    matched_users = list(User.objects.filter(Q(phone__icontains=query) | Q(name__icontains=query)).exclude(id=user.id))
+    shared_chats = ChatMembership.objects.filter(
+        user=user, chat__participants__in=[u.id for u in matched_users]
+    ).values(
+        'chat_id', 'unread_count', 'last_message_id', 'last_message__text', 'last_message__timestamp',
+        other_id=F('chat__participants'), is_group=F('chat__is_group'), created_at=F('chat__created_at'),
+    )
+
+    chat_user_ids = set()
+    direct_chats = {}
+    for row in shared_chats:
+        if row['last_message_id'] is not None:
+            chat_user_ids.add(row['other_id'])
+        if not row['is_group']:
+            current = direct_chats.get(row['other_id'])
+            if current is None or row['created_at'] > current['created_at']:
+                direct_chats[row['other_id']] = row
+    chats_users = [u for u in matched_users if u.id in chat_user_ids]
+    people_users = [u for u in matched_users if u.id not in chat_user_ids]
+
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    matched_messages, messages_has_more = search_messages(
+        user, query, page=page, limit=clamp_search_page_size(request.GET.get('limit'))
+    )
+
+    other_participants = {}
+    for link in Chat.participants.through.objects.filter(
+        chat_id__in={m.chat_id for m in matched_messages}
+    ).exclude(user_id=user.id).select_related('user').order_by('user_id'):
+        other_participants.setdefault(link.chat_id, link.user)
+
+    def format_user(u):
+        return {
+            'id': u.id,
+            'username': u.username,
+            'phone': format_phone(u.phone),
+            'name': u.name or format_phone(u.phone),
+            'profile_picture': get_avatar_url(u, 'small'),
+            'fullphone': u.phone,
+            'about': u.about,
+        }
+
+    def format_chat_user(u):
+        chat = direct_chats.get(u.id)
+        has_message = chat and chat['last_message_id'] is not None
+        return {
+            'id': u.id,
+            'username': u.username,
+            'phone': format_phone(u.phone),
+            'name': u.name or format_phone(u.phone),
+            'profile_picture': get_avatar_url(u, 'small'),
+            'fullphone': u.phone,
+            'last_message_preview': chat['last_message__text'] if has_message else '',
+            'last_message_time': localtime(chat['last_message__timestamp']).strftime('%H:%M') if has_message else '',
+            'unread_count': chat['unread_count'] if chat else 0,
+        }
+
+    def format_message(m):
+        other_user = other_participants.get(m.chat_id)
+        other_user_data = {
+            'id': other_user.id if other_user else None,
+            'username': other_user.username if other_user else None,
+            'phone': format_phone(other_user.phone) if other_user else None,
+            'name': other_user.name if other_user else None,
+            'profile_picture': get_avatar_url(other_user, 'small') if other_user else None,
+            'fullphone': other_user.phone if other_user else None,
+            'about': other_user.about if other_user else '',
+        }
+        return {
+            'messageId': m.id,
+            'chatId': m.chat_id,
+            'chatName': f"Group Chat {m.chat_id}" if m.chat.is_group else other_user_data['name'],
+            'snippet': m.search_snippet,
+            'rank': m.search_rank,
+            'otherUser': other_user_data,
+            'time': localtime(m.timestamp).strftime('%H:%M'),
+        }
+
+    return JsonResponse({
+        'chats': [format_chat_user(u) for u in chats_users],
+        'people': [format_user(u) for u in people_users],
+        'messages': [format_message(m) for m in matched_messages],
+        'messagesPage': page,
+        'messagesHasMore': messages_has_more,
+        'selfUser': format_user(user),
+    })
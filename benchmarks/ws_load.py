@@ -0,0 +1,157 @@
+"""
+WebSocket load driver: thousands of ChatConsumer connections in-process.
+
+    python -m benchmarks.ws_load --connections 2000 --senders 50 \
+        --messages-per-sender 20 --output ws.json
+
+Opens one ws/chat/<id>/ socket per participant of the most active seeded chats
+through Channels' WebsocketCommunicator (full consumer, channel layer and
+database path, no network), then has `senders` sockets send concurrently. It
+reports connect latency, messages/s accepted, fan-out frames/s delivered, and
+end-to-end latency from send to each member's receipt.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from benchmarks import runtime
+from benchmarks.seed import add_arguments as add_seed_arguments, seed_from_args
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.db.models import Max
+from django.db.models.functions import Coalesce
+
+from comms.models import Chat
+from comms.routing import websocket_urlpatterns
+
+
+def plan_connections(connections):
+    """[(chat_id, user)] for the participants of the most recently active chats, up to `connections` sockets."""
+    plan = []
+    # Group chats keep their newest message on the chat (see comms.groups), others on the memberships
+    chats = Chat.objects.annotate(newest_message_id=Coalesce('last_message_id', Max('memberships__last_message_id'))) \
+        .filter(newest_message_id__isnull=False).order_by('-newest_message_id').prefetch_related('participants')
+    for chat in chats.iterator(chunk_size=500):
+        for user in chat.participants.all():
+            plan.append((chat.id, user))
+            if len(plan) >= connections:
+                return plan
+    return plan
+
+
+async def run_load(plan, senders, messages_per_sender, timeout, rng):
+    application = URLRouter(websocket_urlpatterns)
+    sockets = []
+    connect_times = []
+
+    async def connect(chat_id, user):
+        communicator = WebsocketCommunicator(application, f'/ws/chat/{chat_id}/')
+        communicator.scope['user'] = user
+        start = time.perf_counter()
+        connected, _ = await communicator.connect(timeout=timeout)
+        connect_times.append(time.perf_counter() - start)
+        if connected:
+            sockets.append((chat_id, communicator))
+
+    for offset in range(0, len(plan), 200):
+        await asyncio.gather(*(connect(chat_id, user) for chat_id, user in plan[offset:offset + 200]))
+
+    by_chat = {}
+    for chat_id, communicator in sockets:
+        by_chat.setdefault(chat_id, []).append(communicator)
+    sending = rng.sample(sockets, min(senders, len(sockets)))
+    expected = {}
+    for chat_id, _ in sending:
+        expected[chat_id] = expected.get(chat_id, 0) + messages_per_sender
+
+    sent_at = {}
+    latencies = []
+    received = 0
+
+    async def receive(chat_id, communicator):
+        nonlocal received
+        for _ in range(expected.get(chat_id, 0)):
+            try:
+                frame = json.loads(await communicator.receive_from(timeout=timeout))
+            except asyncio.TimeoutError:
+                return
+            if frame.get('type') == 'message':
+                latencies.append(time.perf_counter() - sent_at[frame['message']])
+                received += 1
+
+    async def send(sender_index, communicator):
+        for n in range(messages_per_sender):
+            text = f'bench {sender_index}:{n}'
+            sent_at[text] = time.perf_counter()
+            await communicator.send_to(text_data=json.dumps({'type': 'message', 'message': text}))
+            await asyncio.sleep(0)
+
+    started = time.perf_counter()
+    receivers = [asyncio.create_task(receive(chat_id, c)) for chat_id, c in sockets if chat_id in expected]
+    await asyncio.gather(*(send(i, c) for i, (_, c) in enumerate(sending)))
+    sent_elapsed = time.perf_counter() - started
+    await asyncio.gather(*receivers)
+    elapsed = time.perf_counter() - started
+
+    await asyncio.gather(*(c.disconnect() for _, c in sockets))
+
+    sent = len(sent_at)
+    fan_out = sum(expected[chat_id] for chat_id, _ in sockets if chat_id in expected)
+    return {
+        'connections': len(sockets),
+        'failed_connections': len(plan) - len(sockets),
+        'chats': len(by_chat),
+        'connect': runtime.summarize(connect_times),
+        'messages_sent': sent,
+        'messages_per_second': round(sent / elapsed, 1) if elapsed else None,
+        'send_rate_per_second': round(sent / sent_elapsed, 1) if sent_elapsed else None,
+        'frames_expected': fan_out,
+        'frames_received': received,
+        'frames_per_second': round(received / elapsed, 1) if elapsed else None,
+        'fan_out_latency': runtime.summarize(latencies),
+    }
+
+
+def print_results(results):
+    print(f"{results['connections']} sockets over {results['chats']} chats "
+          f"({results['failed_connections']} failed), connect p99 {results['connect']['p99_ms']} ms")
+    print(f"{results['messages_sent']} messages, {results['messages_per_second']} msg/s; "
+          f"{results['frames_received']}/{results['frames_expected']} frames, {results['frames_per_second']} frames/s")
+    latency = results['fan_out_latency']
+    if latency['count']:
+        print(f"fan-out latency p50 {latency['p50_ms']} ms, p99 {latency['p99_ms']} ms")
+
+
+def add_arguments(parser):
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--senders', type=int, default=20)
+    parser.add_argument('--messages-per-sender', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=30, help="Seconds to wait for any one frame.")
+
+
+def run(args, rng):
+    plan = plan_connections(args.connections)
+    return asyncio.run(run_load(plan, args.senders, args.messages_per_sender, args.timeout, rng))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    add_seed_arguments(parser)
+    add_arguments(parser)
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with runtime.test_database():
+        dataset = seed_from_args(args)
+        results = run(args, rng)
+        print_results(results)
+        if args.output:
+            runtime.write_results(args.output, 'ws_load', {**runtime.params(args), 'dataset': dataset}, results)
+
+
+if __name__ == '__main__':
+    main()
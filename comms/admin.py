@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import User, Chat, Message, ArchivedChat
+from .models import User, Chat, ChatMembership, Message, ArchivedChat
+from .thumbnails import schedule_thumbnails
+from .utils import file_checksum
 
 # Custom UserAdmin to show extra fields in admin for your User model
 class UserAdmin(BaseUserAdmin):
@@ -22,6 +24,13 @@ class UserAdmin(BaseUserAdmin):
     search_fields = ('username', 'phone')
     ordering = ('username',)
 
+    def save_model(self, request, obj, form, change):
+        if 'profile_picture' in form.changed_data:
+            obj.avatar_checksum = file_checksum(obj.profile_picture) if obj.profile_picture else ''
+            if obj.avatar_checksum:
+                schedule_thumbnails(obj)
+        super().save_model(request, obj, form, change)
+
 admin.site.register(User, UserAdmin)
 
 # Register Chat and Message models normally
@@ -46,3 +55,9 @@ class ArchivedChatAdmin(admin.ModelAdmin):
     list_display = ('user', 'chat', 'archived_at')
     search_fields = ('user__username', 'chat__id')
     ordering = ('-archived_at',)
+
+@admin.register(ChatMembership)
+class ChatMembershipAdmin(admin.ModelAdmin):
+    list_display = ('user', 'chat', 'unread_count', 'last_message', 'last_read_message')
+    search_fields = ('user__username', 'chat__id')
+    raw_id_fields = ('last_message', 'last_read_message')
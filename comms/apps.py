@@ -1,5 +1,13 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed
 
 
 class NetworkConfig(AppConfig):
     name = 'comms'
+
+    def ready(self):
+        from .metrics import install_query_recorder
+        from .participants import Participant, participants_changed
+        connection_created.connect(install_query_recorder)
+        m2m_changed.connect(participants_changed, sender=Participant)
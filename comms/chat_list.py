@@ -0,0 +1,267 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, Exists, F, OuterRef, Prefetch, Q, When
+from django.utils.http import quote_etag
+from django.utils.timezone import localtime
+
+from .models import ArchivedChat, Chat, ChatMembership, User
+from .utils import format_phone, get_avatar_url
+
+ACTIVE = 'active'
+ARCHIVED = 'archived'
+FAVOURITE = 'favourite'
+UNREAD = 'unread'
+
+CHAT_FILTERS = (ACTIVE, ARCHIVED, FAVOURITE, UNREAD)
+
+CACHE_TIMEOUT = getattr(settings, 'CHAT_LIST_CACHE_TIMEOUT', 300)
+
+
+def get_chat_queryset(user, status=None):
+    """
+    The user's memberships that have at least one message, newest first, with
+    the chat, its last message and the other participants loaded.
+    Unread counts (as `unread`) and last-message pointers come from
+    ChatMembership, or from Chat for group chats (see comms.groups), so no
+    aggregate over the messages table is needed.
+    """
+    from .groups import unread_count_expression  # groups imports this module
+
+    if status is not None and status not in CHAT_FILTERS:
+        raise ValueError(f"Unknown chat filter: {status}")
+
+    def latest(field):
+        return Case(When(chat__is_group=True, then=F(f'chat__last_message__{field}')), default=F(f'last_message__{field}'))
+
+    has_messages = Q(chat__is_group=False, last_message__isnull=False) | Q(chat__is_group=True, chat__last_message__isnull=False)
+    memberships = ChatMembership.objects.filter(has_messages, user=user) \
+        .select_related('chat', 'last_message', 'chat__last_message') \
+        .annotate(
+            unread=unread_count_expression(),
+            is_archived=Exists(ArchivedChat.objects.filter(user=user, chat=OuterRef('chat_id'))),
+            is_favourite=Exists(
+                User.favourite_chats.through.objects.filter(user=user, chat=OuterRef('chat_id'))
+            ),
+        ) \
+        .prefetch_related(
+            Prefetch('chat__participants', queryset=User.objects.exclude(id=user.id), to_attr='other_participants')
+        ) \
+        .order_by(latest('timestamp').desc(), latest('id').desc())
+
+    if status == ACTIVE:
+        memberships = memberships.filter(is_archived=False)
+    elif status == ARCHIVED:
+        memberships = memberships.filter(is_archived=True)
+    elif status == FAVOURITE:
+        memberships = memberships.filter(is_favourite=True)
+    elif status == UNREAD:
+        memberships = memberships.filter(is_archived=False, unread__gt=0)
+
+    return memberships
+
+
+def serialize_chat(membership, user):
+    chat = membership.chat
+    last_msg = chat.last_message if chat.is_group else membership.last_message
+    others = chat.other_participants
+    if others:
+        other = others[0]
+        name = other.name or format_phone(other.phone)
+        avatar = get_avatar_url(other, 'small')
+        phone = other.phone
+    else:
+        # Self chat
+        other = user
+        name = "You"
+        avatar = get_avatar_url(user, 'small')
+        phone = user.phone
+
+    return {
+        'id': chat.id,
+        'name': name,
+        'avatar': avatar,
+        'message': last_msg.text,
+        'time': localtime(last_msg.timestamp).strftime('%H:%M'),
+        'phone': phone,
+        'user_id': other.id,
+        # Online state is not cached with the list; see comms.presence.with_presence
+        'last_seen': other.last_seen.isoformat() if other.last_seen else None,
+        'has_unread': membership.unread > 0,
+        'unread_count': membership.unread,
+        'is_archived': membership.is_archived,
+        'is_favourite': membership.is_favourite,
+    }
+
+
+def get_chat_list(user, status=None):
+    """
+    Build the chat-list rows for `user` in a constant number of queries
+    (one membership query plus one participant prefetch).
+
+    `status` narrows the list to one of CHAT_FILTERS; None returns every chat.
+    """
+    return [serialize_chat(membership, user) for membership in get_chat_queryset(user, status)]
+
+
+def split_chat_list(chats):
+    """
+    Split a full chat list into the sidebar sections used by the index page.
+    """
+    active_chats = [c for c in chats if not c['is_archived']]
+    return {
+        "chats": active_chats,
+        "unreadchats": [c for c in active_chats if c['unread_count'] > 0],
+        "archived_chats": [c for c in chats if c['is_archived']],
+        "favouritechats": [c for c in active_chats if c['is_favourite']],
+    }
+
+
+def filter_chat_list(chats, status=None):
+    """Apply a CHAT_FILTERS status to serialized rows, as get_chat_queryset does."""
+    if status is None:
+        return chats
+    if status == ACTIVE:
+        return [c for c in chats if not c['is_archived']]
+    if status == ARCHIVED:
+        return [c for c in chats if c['is_archived']]
+    if status == FAVOURITE:
+        return [c for c in chats if c['is_favourite']]
+    if status == UNREAD:
+        return [c for c in chats if not c['is_archived'] and c['unread_count'] > 0]
+    raise ValueError(f"Unknown chat filter: {status}")
+
+
+# Cached chat lists
+#
+# Each user has a version stamp (time.time_ns() of the last change) and the
+# serialized list is cached under (user, version). Invalidating bumps the stamp,
+# so a list built concurrently from older data is stored under a key nobody
+# reads again. The stamp is also the list's ETag and Last-Modified.
+#
+# Group chats have a stamp of their own, bumped by every message, and a user's
+# version is the newest of theirs and those of their group chats (whose ids
+# are cached too), so a message in a large room is one cache write.
+
+def _version_key(user_id):
+    return f'chat_list:version:{user_id}'
+
+
+def _groups_key(user_id):
+    return f'chat_list:groups:{user_id}'
+
+
+def _chat_version_key(chat_id):
+    return f'chat_list:chat:{chat_id}'
+
+
+def _group_chat_ids(user_id):
+    return Chat.participants.through.objects.filter(user_id=user_id, chat__is_group=True) \
+        .values_list('chat_id', flat=True)
+
+
+def get_chat_list_version(user_id):
+    key = _version_key(user_id)
+    values = cache.get_many([key, _groups_key(user_id)])
+    version = values.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key) or time.time_ns()
+    group_ids = values.get(_groups_key(user_id))
+    if group_ids is None:
+        group_ids = list(_group_chat_ids(user_id))
+        cache.set(_groups_key(user_id), group_ids, None)
+    if group_ids:
+        version = max([version, *cache.get_many([_chat_version_key(chat_id) for chat_id in group_ids]).values()])
+    return version
+
+
+async def aget_chat_list_version(user_id):
+    key = _version_key(user_id)
+    values = await cache.aget_many([key, _groups_key(user_id)])
+    version = values.get(key)
+    if version is None:
+        await cache.aadd(key, time.time_ns(), None)
+        version = await cache.aget(key) or time.time_ns()
+    group_ids = values.get(_groups_key(user_id))
+    if group_ids is None:
+        group_ids = [chat_id async for chat_id in _group_chat_ids(user_id)]
+        await cache.aset(_groups_key(user_id), group_ids, None)
+    if group_ids:
+        version = max([version, *(await cache.aget_many([_chat_version_key(chat_id) for chat_id in group_ids])).values()])
+    return version
+
+
+def get_cached_chat_list(user, status=None):
+    """get_chat_list, served from the cache while the user's lists are unchanged."""
+    key = f'chat_list:{user.id}:{get_chat_list_version(user.id)}'
+    chats = cache.get(key)
+    if chats is None:
+        chats = get_chat_list(user)
+        cache.set(key, chats, CACHE_TIMEOUT)
+    return filter_chat_list(chats, status)
+
+
+async def aget_cached_chat_list(user, status=None, version=None):
+    """
+    Async version of get_cached_chat_list. Pass the `version` already read
+    for the response's ETag to save a cache round trip.
+    """
+    if version is None:
+        version = await aget_chat_list_version(user.id)
+    key = f'chat_list:{user.id}:{version}'
+    chats = await cache.aget(key)
+    if chats is None:
+        chats = [serialize_chat(membership, user) async for membership in get_chat_queryset(user)]
+        await cache.aset(key, chats, CACHE_TIMEOUT)
+    return filter_chat_list(chats, status)
+
+
+def invalidate_chat_lists(user_ids):
+    """
+    Mark the chat lists of `user_ids` as changed. Runs when the current
+    transaction commits, so a rebuilt list always sees the change.
+    """
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+
+    def bump():
+        version = time.time_ns()
+        cache.set_many({_version_key(user_id): version for user_id in user_ids}, None)
+
+    transaction.on_commit(bump)
+
+
+def invalidate_group_chat_lists(chat_id):
+    """invalidate_chat_lists for every member of a group chat, with one cache write."""
+    transaction.on_commit(lambda: cache.set(_chat_version_key(chat_id), time.time_ns(), None))
+
+
+def invalidate_group_memberships(user_ids):
+    """The users joined or left group chats: their lists change, and so do the group stamps they follow."""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    invalidate_chat_lists(user_ids)
+    transaction.on_commit(lambda: cache.delete_many([_groups_key(user_id) for user_id in user_ids]))
+
+
+def invalidate_chat_lists_showing(user):
+    """Invalidate every list that shows `user`'s name or avatar, including their own."""
+    chat_ids = Chat.participants.through.objects.filter(user_id=user.id).values('chat_id')
+    invalidate_chat_lists(
+        {user.id, *ChatMembership.objects.filter(chat_id__in=chat_ids).values_list('user_id', flat=True)}
+    )
+
+
+def chat_list_validators(user_id, version, presence=None):
+    """
+    (ETag, Last-Modified as a Unix timestamp) of a user's chat lists at
+    `version`. `presence` (comms.presence.presence_stamp) goes into the ETag,
+    as presence changes do not bump the version.
+    """
+    etag = f'{user_id}-{version}-{presence}' if presence else f'{user_id}-{version}'
+    return quote_etag(etag), version // 10**9
@@ -0,0 +1,258 @@
+"""
+Cold archive tier for old messages.
+
+Read messages older than MESSAGE_ARCHIVE_AFTER_DAYS are moved out of the
+message table into ColdMessageBlock rows: up to BLOCK_SIZE consecutive
+messages of one chat, stored as zlib-compressed JSON. On a partitioned
+Postgres table whole months are archived at once and their partitions
+dropped (see comms.partitions); elsewhere the rows are deleted block by block.
+
+Two kinds of message stay in the message table whatever their age: unread
+messages, which receipts and unread counts still work on, and the last
+message of each chat, which the chat list points at.
+
+History pages (comms.history) and exports (comms.export) merge archived
+messages back in transparently. Archived messages are no longer searchable,
+and receipts no longer apply to them.
+"""
+import json
+import zlib
+from datetime import datetime, timedelta
+from heapq import heappop, heappush
+from itertools import groupby, islice
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Chat, ChatMembership, ColdMessageBlock, Message, User
+from .partitions import MESSAGE_TABLE, add_months, is_partitioned, monthly_partitions
+
+ARCHIVE_AFTER_DAYS = getattr(settings, 'MESSAGE_ARCHIVE_AFTER_DAYS', None)
+BLOCK_SIZE = getattr(settings, 'MESSAGE_ARCHIVE_BLOCK_SIZE', 500)
+COMPRESSION_LEVEL = 6
+# Blocks fetched per round trip when reading; each holds up to BLOCK_SIZE messages
+READ_CHUNK_SIZE = 16
+
+# Column order of archived rows, as stored in a block and as returned by readers
+ROW_FIELDS = ('id', 'timestamp', 'sender_id', 'text', 'delivered', 'read')
+
+
+def archive_horizon(now=None):
+    """Send time before which messages may be archived, or None if archiving is off."""
+    if ARCHIVE_AFTER_DAYS is None:
+        return None
+    return (now or timezone.now()) - timedelta(days=ARCHIVE_AFTER_DAYS)
+
+
+def pack(rows):
+    data = [[id_, ts.isoformat(), sender_id, text, delivered, read] for id_, ts, sender_id, text, delivered, read in rows]
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode(), COMPRESSION_LEVEL)
+
+
+def unpack(payload):
+    return [
+        (id_, datetime.fromisoformat(ts), sender_id, text, delivered, read)
+        for id_, ts, sender_id, text, delivered, read in json.loads(zlib.decompress(payload))
+    ]
+
+
+def _key(row):
+    return row[1], row[0]
+
+
+def _block(chat_id, rows):
+    ids = [row[0] for row in rows]
+    return ColdMessageBlock(
+        chat_id=chat_id,
+        first_timestamp=rows[0][1],
+        first_message_id=rows[0][0],
+        last_timestamp=rows[-1][1],
+        last_message_id=rows[-1][0],
+        min_message_id=min(ids),
+        max_message_id=max(ids),
+        message_count=len(rows),
+        payload=pack(rows),
+    )
+
+
+def _write_blocks(rows, batch_size=100):
+    """
+    Store `rows` of (chat_id, *ROW_FIELDS), ordered by chat, timestamp and id,
+    as blocks of up to BLOCK_SIZE messages. Returns the number of messages.
+    """
+    pending = []
+    total = 0
+    for chat_id, chat_rows in groupby(rows, key=lambda row: row[0]):
+        chat_rows = (row[1:] for row in chat_rows)
+        while block_rows := list(islice(chat_rows, BLOCK_SIZE)):
+            pending.append(_block(chat_id, block_rows))
+            total += len(block_rows)
+            if len(pending) >= batch_size:
+                ColdMessageBlock.objects.bulk_create(pending)
+                pending = []
+    ColdMessageBlock.objects.bulk_create(pending)
+    return total
+
+
+def archivable_messages(before):
+    """Messages sent before `before` that may leave the message table."""
+    return Message.objects.filter(timestamp__lt=before, read=True).exclude(
+        id__in=ChatMembership.objects.filter(last_message__isnull=False).values('last_message_id')
+    ).exclude(
+        id__in=Chat.objects.filter(last_message__isnull=False).values('last_message_id')
+    )
+
+
+def archive_messages(before=None):
+    """
+    Move the archivable messages sent before `before` (by default the
+    MESSAGE_ARCHIVE_AFTER_DAYS horizon) into cold blocks. On a partitioned
+    table only whole months that end by then are archived.
+    Returns the number of messages archived.
+    """
+    if before is None:
+        before = archive_horizon()
+        if before is None:
+            raise ValueError("Set MESSAGE_ARCHIVE_AFTER_DAYS or pass the time to archive before.")
+    if is_partitioned():
+        return sum(
+            _archive_partition(name)
+            for month, name in monthly_partitions()
+            if add_months(month, 1) <= before
+        )
+    return _archive_rows(before)
+
+
+def _archive_rows(before):
+    messages = archivable_messages(before).order_by('chat_id', 'timestamp', 'id')
+    total = 0
+    for chat_id in archivable_messages(before).order_by('chat_id').values_list('chat_id', flat=True).distinct():
+        # One block per transaction: interrupted runs leave no message in both places
+        while True:
+            with transaction.atomic():
+                rows = list(messages.filter(chat_id=chat_id).values_list('chat_id', *ROW_FIELDS)[:BLOCK_SIZE])
+                if not rows:
+                    break
+                total += _write_blocks(rows)
+                _delete_rows([row[1] for row in rows])
+    return total
+
+
+def _delete_rows(ids):
+    # Plain DELETE, as dropping a partition would be: read pointers to these
+    # messages stay as watermarks instead of being cleared by on_delete
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {qn(MESSAGE_TABLE)} WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+
+
+def _archive_partition(name):
+    """
+    Detach a monthly partition, put the messages that must stay hot back
+    through the parent (they land in the default partition, as no partition
+    covers their month any more), archive the rest and drop the partition.
+    """
+    qn = connection.ops.quote_name
+    table, partition = qn(MESSAGE_TABLE), qn(name)
+    keep = (
+        f'NOT {qn("read")} OR id IN (SELECT last_message_id FROM {qn(ChatMembership._meta.db_table)} '
+        f'WHERE last_message_id IS NOT NULL) OR id IN (SELECT last_message_id FROM {qn(Chat._meta.db_table)} '
+        f'WHERE last_message_id IS NOT NULL)'
+    )
+    columns = ', '.join(qn(column) for column in ('chat_id', 'id', 'timestamp', 'sender_id', 'text', 'delivered', 'read'))
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {partition}")
+            cursor.execute(f"INSERT INTO {table} SELECT * FROM {partition} WHERE {keep}")
+
+        def rows():
+            with connection.chunked_cursor() as cursor:
+                cursor.execute(f"SELECT {columns} FROM {partition} WHERE NOT ({keep}) ORDER BY chat_id, \"timestamp\", id")
+                while batch := cursor.fetchmany(BLOCK_SIZE):
+                    yield from batch
+
+        total = _write_blocks(rows())
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE {partition}")
+    return total
+
+
+def find_archived_cursor(chat, message_id):
+    """{'timestamp', 'id'} of archived message `message_id` of `chat`, or None."""
+    blocks = ColdMessageBlock.objects.filter(chat=chat, min_message_id__lte=message_id, max_message_id__gte=message_id)
+    for payload in blocks.values_list('payload', flat=True):
+        for row in unpack(payload):
+            if row[0] == message_id:
+                return {'timestamp': row[1], 'id': row[0]}
+    return None
+
+
+def _to_messages(chat, rows):
+    senders = User.objects.in_bulk({row[2] for row in rows})
+    return [
+        Message(id=id_, chat=chat, sender=senders[sender_id], text=text, timestamp=ts, delivered=delivered, read=read)
+        for id_, ts, sender_id, text, delivered, read in rows
+        # Messages of deleted users would have gone with them from the hot table
+        if sender_id in senders
+    ]
+
+
+def archived_page(chat, cursor, forward, need):
+    """
+    Up to `need` archived messages of `chat` beyond `cursor` ({'timestamp',
+    'id'}, or None to start from the newest), as unsaved Message instances:
+    newest first, or oldest first when paging `forward`.
+
+    Blocks are read nearest first and reading stops once no further block can
+    hold a message nearer than those already found, so a page usually
+    decompresses one or two blocks.
+    """
+    blocks = ColdMessageBlock.objects.filter(chat=chat)
+    bound = (cursor['timestamp'], cursor['id']) if cursor else None
+    if forward:
+        blocks = blocks.filter(
+            Q(last_timestamp__gt=bound[0]) | Q(last_timestamp=bound[0], last_message_id__gt=bound[1])
+        ).order_by('first_timestamp', 'first_message_id')
+    else:
+        if bound:
+            blocks = blocks.filter(
+                Q(first_timestamp__lt=bound[0]) | Q(first_timestamp=bound[0], first_message_id__lt=bound[1])
+            )
+        blocks = blocks.order_by('-last_timestamp', '-last_message_id')
+
+    found = []
+    for block in blocks.iterator(chunk_size=READ_CHUNK_SIZE):
+        if len(found) >= need:
+            edge = (block.first_timestamp, block.first_message_id) if forward else (block.last_timestamp, block.last_message_id)
+            nearest_left = _key(found[need - 1])
+            if (edge > nearest_left) if forward else (edge < nearest_left):
+                break
+        rows = unpack(block.payload)
+        if bound:
+            rows = [row for row in rows if (_key(row) > bound if forward else _key(row) < bound)]
+        found.extend(rows)
+        found.sort(key=_key, reverse=not forward)
+        del found[need:]
+    return _to_messages(chat, found)
+
+
+def iter_archived_rows(chat):
+    """
+    Every archived message of `chat` as a ROW_FIELDS tuple, oldest first.
+    Blocks of one chat may overlap in time (a message kept hot can be archived
+    by a later run), so rows are released only once no later block can
+    precede them.
+    """
+    pending = []
+    blocks = ColdMessageBlock.objects.filter(chat=chat).order_by('first_timestamp', 'first_message_id')
+    for block in blocks.iterator(chunk_size=READ_CHUNK_SIZE):
+        edge = (block.first_timestamp, block.first_message_id)
+        while pending and pending[0][0] < edge:
+            yield heappop(pending)[1]
+        for row in unpack(block.payload):
+            heappush(pending, (_key(row), row))
+    while pending:
+        yield heappop(pending)[1]
@@ -1,99 +1,556 @@
-import json
+import asyncio
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.db import IntegrityError, transaction
 from .models import Chat, Message
+from .membership import get_unread_count, mark_messages_delivered, mark_messages_read, record_message
+from .flow_control import (
+    WS_CONNECTION_RATE, SendQueue, TokenBucket, admit_connection, database_sync_to_async, frame_limit,
+    release_connection,
+)
+from .frames import JSON, MSGPACK, MSGPACK_SUBPROTOCOL, FrameError, build_frame, decode, encode_all
+from .groups import apply_receipt
+from .metrics import WS_REFUSED, WS_THROTTLED, ws_frame
+from .participants import aget_member_ids, load_chat_members
+from .presence import connected, disconnected, get_contact_ids, heartbeat, typing_allowed
+from .write_behind import MAX_CLIENT_MSG_ID_LENGTH, accept_message, write_behind
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
 
-class ChatConsumer(AsyncWebsocketConsumer):
+# Upper bound on message ids accepted in one receipt frame
+MAX_RECEIPT_IDS = 500
+
+# Close code for sockets refused or dropped under load (RFC 6455 "Try Again Later")
+TRY_AGAIN_LATER = 1013
+
+# Frame types clients may send; anything else is recorded as 'other' in metrics
+FRAME_TYPES = ('message', 'delivered', 'read', 'typing', 'heartbeat')
+
+# Persistence confirmations still running, kept referenced until they finish
+_confirmations = set()
+
+
+def chat_group(chat_id):
+    return f'chat_{chat_id}'
+
+
+def user_group(user_id):
+    return f'user_{user_id}'
+
+
+def members_group(chat_id):
+    # The per-user sockets of a group chat's members, so fan-out is one send
+    return f'chat_{chat_id}_members'
+
+
+def message_event(message, sender):
+    return {
+        'type': 'chat_message',
+        'message': message.text,
+        'sender': sender.username,
+        'timestamp': message.timestamp.isoformat(),
+        'message_id': message.id,
+        'client_msg_id': message.client_msg_id,
+        'delivered': message.delivered,
+        'read': message.read,
+    }
+
+
+def frame_type(data):
+    msg_type = data.get('type')
+    return msg_type if msg_type in FRAME_TYPES else 'other'
+
+
+def parse_receipt(data):
+    """
+    Read the target of a delivered/read frame. Clients send either
+    {"message_ids": [...]}, a watermark {"up_to": id} covering every earlier
+    message, or the legacy single {"message_id": id}.
+    Returns (message_ids, up_to), or None if the frame names no valid ids.
+    """
+    try:
+        if data.get('up_to') is not None:
+            return None, int(data['up_to'])
+        if data.get('message_ids'):
+            return [int(i) for i in data['message_ids'][:MAX_RECEIPT_IDS]], None
+        if data.get('message_id') is not None:
+            return [int(data['message_id'])], None
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+class ChatEventsMixin:
+    """
+    Frame handling shared by the per-chat and the per-user consumer.
+
+    Every event is sent to the chat's group (sockets opened on ws/chat/<id>/)
+    and to the user group of each member (multiplexed sockets on ws/chats/),
+    the latter tagged with the chat id and the member's unread count. Group
+    chats send it once to their members group instead, without unread counts,
+    and keep receipts as per-member watermarks (see comms.groups).
+    """
+
+    async def admit(self):
+        """
+        Set up flow control for a new socket, or refuse it if this worker is
+        full (see comms.flow_control). Returns whether it was admitted.
+        """
+        self.admitted = admit_connection()
+        if not self.admitted:
+            await self.close(code=TRY_AGAIN_LATER)
+            return False
+        self.frame_bucket = TokenBucket(*WS_CONNECTION_RATE)
+        self.throttled = False
+        self.closing = False
+        self.encoding = MSGPACK if MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', ()) else JSON
+        self.send_queue = SendQueue(self.send_data, encoding=self.encoding)
+        self.send_queue.start()
+        return True
+
+    async def accept_socket(self):
+        """accept(), confirming the subprotocol that picked the encoding, if any."""
+        await self.accept(MSGPACK_SUBPROTOCOL if self.encoding == MSGPACK else None)
+
+    async def send_data(self, data):
+        if isinstance(data, bytes):
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
+
+    def release(self):
+        """Undo admit(). Returns whether the socket had been admitted."""
+        if not getattr(self, 'admitted', False):
+            return False
+        self.admitted = False
+        self.send_queue.close()
+        release_connection()
+        return True
+
+    async def send_frame(self, frame, encoded=None):
+        if not self.send_queue.put(frame, encoded) and not self.closing:
+            # Too far behind to catch up frame by frame; it reloads on reconnect
+            self.closing = True
+            WS_REFUSED.inc('slow_client')
+            await self.close(code=TRY_AGAIN_LATER)
+
+    async def admit_frame(self, data, user):
+        """Apply the rate and size limits, before the frame is parsed."""
+        limit = frame_limit(data, self.frame_bucket, user.id if user.is_authenticated else None)
+        if limit is None:
+            self.throttled = False
+            return True
+        if not self.throttled:
+            # Once per run of refused frames
+            self.throttled = True
+            await self.send_frame({'type': 'error', 'error': 'Frame too large' if limit == 'size' else 'Rate limited'})
+        return False
+
+    async def parse_frame(self, text_data, bytes_data):
+        """The frame as a dict, or None (and the client told) if it does not decode to one."""
+        try:
+            return decode(text_data, bytes_data)
+        except FrameError:
+            WS_THROTTLED.inc('malformed')
+            await self.send_frame({'type': 'error', 'error': 'Malformed frame'})
+            return None
+
+    async def handle_frame(self, user, chat_id, data):
+        msg_type = data.get('type')
+
+        if msg_type == 'message':
+            message_text = data.get('message')
+            client_msg_id = data.get('client_msg_id')
+            if message_text and client_msg_id:
+                await self.send_optimistic(user, chat_id, message_text, str(client_msg_id)[:MAX_CLIENT_MSG_ID_LENGTH])
+            elif message_text:
+                msg_obj, unread_counts = await self.save_message(user, chat_id, message_text, self.is_group_chat(chat_id))
+                # Broadcast new message to group
+                await self.publish(chat_id, message_event(msg_obj, user), unread_counts)
+        elif msg_type in ('delivered', 'read'):
+            receipt = parse_receipt(data)
+            if receipt:
+                message_ids, up_to = receipt
+                if write_behind.pending_in(int(chat_id)):
+                    # Receipts may name messages that are still waiting to be written
+                    await write_behind.flush()
+                if self.is_group_chat(chat_id):
+                    await self.group_receipt(user, chat_id, msg_type, up_to if up_to is not None else max(message_ids))
+                    return
+                if msg_type == 'read':
+                    changed = await self.mark_read(user, chat_id, message_ids, up_to)
+                else:
+                    changed = await self.mark_delivered(user, chat_id, message_ids, up_to)
+                if changed:
+                    # One compact status event per frame, not one per message
+                    await self.publish(chat_id, {
+                        'type': 'receipt_status',
+                        'status': msg_type,
+                        'reader': user.username,
+                        **({'up_to': up_to} if up_to is not None else {'message_ids': changed}),
+                    })
+                    if msg_type == 'read':
+                        await self.send_unread_count(user, chat_id)
+        elif msg_type == 'typing':
+            # Clients send this on keystrokes; most are dropped by the throttle
+            if await typing_allowed(user.id, chat_id):
+                await self.publish(chat_id, {
+                    'type': 'typing_status',
+                    'user_id': user.id,
+                    'username': user.username,
+                })
+        elif msg_type == 'heartbeat':
+            await heartbeat(user.id)
+
+    async def group_receipt(self, user, chat_id, status, up_to):
+        """
+        Move the reader's watermark in a group chat. The chat hears of it only
+        once every member has got that far, not on each member's receipt.
+        """
+        moved, watermark = await self.apply_receipt(user, chat_id, status, up_to)
+        if watermark is not None:
+            await self.publish(chat_id, {
+                'type': 'receipt_status',
+                'status': status,
+                'reader': user.username,
+                'up_to': watermark,
+            })
+        if moved and status == 'read':
+            await self.send_unread_count(user, chat_id)
+
+    async def send_unread_count(self, user, chat_id):
+        # The reader's badge changed, on every socket they have open
+        await self.channel_layer.group_send(user_group(user.id), {
+            'type': 'unread_update',
+            'chat_id': int(chat_id),
+            'unread_count': await self.get_unread_count(user, chat_id),
+        })
+
+    async def presence_connect(self, user):
+        if await connected(user.id):
+            await self.publish_presence(user, True, None)
+
+    async def presence_disconnect(self, user):
+        last_seen = await disconnected(user.id)
+        if last_seen is not None:
+            await self.publish_presence(user, False, last_seen)
+
+    async def publish_presence(self, user, online, last_seen):
+        # Only on coming online or going offline, not on every socket or heartbeat
+        event = {
+            'type': 'presence_update',
+            'user_id': user.id,
+            'online': online,
+            'last_seen': last_seen.isoformat() if last_seen else None,
+        }
+        for contact_id in await self.get_contact_ids(user):
+            await self.channel_layer.group_send(user_group(contact_id), event)
+
+    async def send_optimistic(self, user, chat_id, text, client_msg_id):
+        """
+        Broadcast a message that came with a client id before it is stored,
+        and have the sender told once it is (see comms.write_behind).
+        """
+        message, persisted, is_new = await accept_message(user, chat_id, text, client_msg_id)
+        if is_new:
+            await self.publish(chat_id, message_event(message, user))
+        if persisted is None:
+            await self.send_ack(message, 'persisted')
+        else:
+            task = asyncio.ensure_future(self.confirm_persisted(message, persisted))
+            _confirmations.add(task)
+            task.add_done_callback(_confirmations.discard)
+
+    async def confirm_persisted(self, message, persisted):
+        try:
+            unread_counts = await persisted
+        except IntegrityError:
+            await self.send_ack(message, 'rejected')
+            return
+        await self.send_ack(message, 'persisted')
+        # Badges of the members, now that the message is counted
+        for user_id, unread_count in (unread_counts or {}).items():
+            await self.channel_layer.group_send(user_group(user_id), {
+                'type': 'unread_update',
+                'chat_id': message.chat_id,
+                'unread_count': unread_count,
+            })
+
+    async def send_ack(self, message, status):
+        # Through the channel layer: the socket may have closed in the meantime
+        await self.channel_layer.send(self.channel_name, {
+            'type': 'message_ack',
+            'chat_id': message.chat_id,
+            'client_msg_id': message.client_msg_id,
+            'message_id': message.id,
+            'status': status,
+        })
+
+    async def message_ack(self, event):
+        await self.send_frame({
+            'type': 'ack',
+            'chat_id': event['chat_id'],
+            'client_msg_id': event['client_msg_id'],
+            'message_id': event['message_id'],
+            'status': event['status'],
+        })
+
+    async def publish(self, chat_id, event, members=None):
+        """
+        Send `event` to the chat group and to each member's user group.
+        `members` maps user id to that member's unread count, or is an
+        iterable of user ids (by default, the chat's) when the counts did not
+        change. A group chat's members all get the same event, through its
+        members group.
+
+        Each distinct frame is encoded here, once per encoding, and carried
+        by the event as `encoded`; only frames with a member's own unread
+        count are left to be encoded by the socket.
+        """
+        await self.channel_layer.group_send(chat_group(chat_id), {**event, 'encoded': encode_all(build_frame(event))})
+        user_event = {**event, 'chat_id': int(chat_id)}
+        if self.is_group_chat(chat_id):
+            await self.channel_layer.group_send(
+                members_group(chat_id), {**user_event, 'encoded': encode_all(build_frame(user_event))}
+            )
+            return
+        if members is None:
+            members = await self.get_member_ids(chat_id)
+        unread_counts = members if isinstance(members, dict) else dict.fromkeys(members)
+        shared_event = None
+        for user_id, unread_count in unread_counts.items():
+            if unread_count is not None:
+                await self.channel_layer.group_send(user_group(user_id), {**user_event, 'unread_count': unread_count})
+                continue
+            if shared_event is None:
+                shared_event = {**user_event, 'encoded': encode_all(build_frame(user_event))}
+            await self.channel_layer.group_send(user_group(user_id), shared_event)
+
+    async def send_event(self, event):
+        """Send a broadcast chat event (see publish) to this socket."""
+        await self.send_frame(build_frame(event), event.get('encoded'))
+
+    async def chat_message(self, event):
+        await self.send_event(event)
+
+    async def receipt_status(self, event):
+        await self.send_event(event)
+
+    async def typing_status(self, event):
+        await self.send_event(event)
+
+    @database_sync_to_async
+    def save_message(self, user, chat_id, message, is_group):
+        # Membership was checked when the socket connected (or first used the chat)
+        with transaction.atomic():
+            msg = Message.objects.create(chat_id=int(chat_id), sender=user, text=message)
+            unread_counts = record_message(msg, is_group)
+        return msg, unread_counts
+
+    async def get_member_ids(self, chat_id):
+        return await aget_member_ids(int(chat_id))
+
+    @database_sync_to_async
+    def get_contact_ids(self, user):
+        return get_contact_ids(user.id)
+
+    @database_sync_to_async
+    def get_unread_count(self, user, chat_id):
+        return get_unread_count(user, chat_id)
+
+    @database_sync_to_async
+    def mark_delivered(self, user, chat_id, message_ids, up_to):
+        return mark_messages_delivered(chat_id, user, message_ids=message_ids, up_to=up_to)
+
+    @database_sync_to_async
+    def mark_read(self, user, chat_id, message_ids, up_to):
+        return mark_messages_read(chat_id, user, message_ids=message_ids, up_to=up_to)
+
+    @database_sync_to_async
+    def apply_receipt(self, user, chat_id, status, up_to):
+        return apply_receipt(int(chat_id), user, status, up_to)
+
+
+class ChatConsumer(ChatEventsMixin, AsyncWebsocketConsumer):
+    """
+    A socket for one chat (ws/chat/<id>/), open to its participants only.
+    The chat and its member ids are loaded once on connect and kept on the
+    consumer, updated by chat_members_changed events (see comms.participants).
+    """
+
     async def connect(self):
-        self.chat_id = self.scope['url_route']['kwargs']['chat_id']
-        self.room_group_name = f'chat_{self.chat_id}'
+        user = self.scope['user']
+        self.chat_id = int(self.scope['url_route']['kwargs']['chat_id'])
+        self.room_group_name = chat_group(self.chat_id)
+        if not user.is_authenticated:
+            await self.close()
+            return
+        self.chat, self.member_ids = await self.load_chat(self.chat_id)
+        if user.id not in self.member_ids:
+            await self.close()
+            return
+        if not await self.admit():
+            return
 
         # Join room group
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
-        await self.accept()
+        await self.accept_socket()
+        await self.presence_connect(user)
 
     async def disconnect(self, close_code):
+        if not self.release():
+            return
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        await self.presence_disconnect(self.scope['user'])
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
         user = self.scope['user']
+        if not await self.admit_frame(text_data if text_data is not None else bytes_data, user):
+            return
+        data = await self.parse_frame(text_data, bytes_data)
+        if data is None:
+            return
+
+        async with ws_frame(frame_type(data)):
+            await self.handle_frame(user, self.chat_id, data)
+
+    async def get_member_ids(self, chat_id):
+        return self.member_ids
+
+    def is_group_chat(self, chat_id):
+        return self.chat.is_group
+
+    async def chat_members_changed(self, event):
+        self.member_ids = set(event['member_ids'])
+        if self.scope['user'].id not in self.member_ids:
+            await self.close()
+
+    @database_sync_to_async
+    def load_chat(self, chat_id):
+        return load_chat_members(chat_id)
+
+
+class UserConsumer(ChatEventsMixin, AsyncWebsocketConsumer):
+    """
+    One socket per user for all of their chats (ws/chats/).
+
+    Client frames carry a `chat_id` and are otherwise the same as on ws/chat/<id>/.
+    Server frames carry the `chat_id` they belong to; new messages also carry the
+    recipient's `unread_count`, and `unread` frames report badge changes, so the
+    whole chat list stays live without reopening sockets or refetching lists.
+    Messages of group chats come without an unread count, through the members
+    group of each group chat, which the socket joins.
+    """
 
+    async def connect(self):
+        user = self.scope['user']
         if not user.is_authenticated:
             await self.close()
             return
 
-        msg_type = data.get('type')
+        if not await self.admit():
+            return
+        self.user_group_name = user_group(user.id)
+        self.group_chat_ids = set()
+        await self.load_chats(user)
 
-        if msg_type == 'message':
-            message_text = data.get('message')
-            if message_text:
-                msg_obj = await self.save_message(user, self.chat_id, message_text)
-                # Broadcast new message to group
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'chat_message',
-                        'message': msg_obj.text,
-                        'sender': user.username,
-                        'timestamp': msg_obj.timestamp.isoformat(),
-                        'message_id': msg_obj.id,
-                        'delivered': msg_obj.delivered,
-                        'read': msg_obj.read,
-                    }
-                )
-        elif msg_type == 'delivered':
-            message_id = data.get('message_id')
-            if message_id:
-                await self.mark_delivered(message_id)
-        elif msg_type == 'read':
-            message_id = data.get('message_id')
-            if message_id:
-                await self.mark_read(message_id)
+        await self.channel_layer.group_add(
+            self.user_group_name,
+            self.channel_name
+        )
+        await self.accept_socket()
+        await self.presence_connect(user)
 
-    async def chat_message(self, event):
-        # Send message or status update to WebSocket clients
-        await self.send(text_data=json.dumps({
-            'type': 'message',
-            'message': event['message'],
-            'sender': event['sender'],
-            'timestamp': event['timestamp'],
-            'message_id': event['message_id'],
-            'delivered': event['delivered'],
-            'read': event['read'],
-        }))
+    async def disconnect(self, close_code):
+        if self.release():
+            await self.channel_layer.group_discard(
+                self.user_group_name,
+                self.channel_name
+            )
+            for chat_id in self.group_chat_ids:
+                await self.channel_layer.group_discard(members_group(chat_id), self.channel_name)
+            await self.presence_disconnect(self.scope['user'])
 
-    @database_sync_to_async
-    def save_message(self, user, chat_id, message):
-        chat = Chat.objects.get(pk=chat_id)
-        return Message.objects.create(chat=chat, sender=user, text=message)
+    async def load_chats(self, user):
+        self.chat_ids, group_chat_ids = await self.get_chat_ids(user)
+        for chat_id in group_chat_ids - self.group_chat_ids:
+            await self.channel_layer.group_add(members_group(chat_id), self.channel_name)
+        self.group_chat_ids = group_chat_ids
+
+    async def receive(self, text_data=None, bytes_data=None):
+        user = self.scope['user']
+        if not await self.admit_frame(text_data if text_data is not None else bytes_data, user):
+            return
+        data = await self.parse_frame(text_data, bytes_data)
+        if data is None:
+            return
+
+        if data.get('type') == 'heartbeat':
+            # Not tied to a chat
+            async with ws_frame('heartbeat'):
+                await heartbeat(user.id)
+            return
 
-    @database_sync_to_async
-    def mark_delivered(self, message_id):
         try:
-            msg = Message.objects.get(id=message_id)
-            if not msg.delivered:
-                msg.delivered = True
-                msg.save()
-        except Message.DoesNotExist:
-            pass
+            chat_id = int(data.get('chat_id'))
+        except (TypeError, ValueError):
+            return
+
+        async with ws_frame(frame_type(data)):
+            if chat_id not in self.chat_ids:
+                # The chat may have been created after this socket connected
+                await self.load_chats(user)
+                if chat_id not in self.chat_ids:
+                    await self.send_frame({'type': 'error', 'chat_id': chat_id, 'error': 'Chat not found'})
+                    return
+
+            await self.handle_frame(user, chat_id, data)
+
+    async def unread_update(self, event):
+        await self.send_frame({
+            'type': 'unread',
+            'chat_id': event['chat_id'],
+            'unread_count': event['unread_count'],
+        })
+
+    async def chat_members_changed(self, event):
+        chat_id = event['chat_id']
+        if self.scope['user'].id in event['member_ids']:
+            self.chat_ids.add(chat_id)
+            if event['is_group'] and chat_id not in self.group_chat_ids:
+                self.group_chat_ids.add(chat_id)
+                await self.channel_layer.group_add(members_group(chat_id), self.channel_name)
+        else:
+            self.chat_ids.discard(chat_id)
+            if chat_id in self.group_chat_ids:
+                self.group_chat_ids.discard(chat_id)
+                await self.channel_layer.group_discard(members_group(chat_id), self.channel_name)
+
+    def is_group_chat(self, chat_id):
+        return int(chat_id) in self.group_chat_ids
+
+    async def presence_update(self, event):
+        await self.send_frame({
+            'type': 'presence',
+            'user_id': event['user_id'],
+            'online': event['online'],
+            'last_seen': event['last_seen'],
+        })
 
     @database_sync_to_async
-    def mark_read(self, message_id):
-        try:
-            msg = Message.objects.get(id=message_id)
-            if not msg.read:
-                msg.read = True
-                msg.save()
-        except Message.DoesNotExist:
-            pass
+    def get_chat_ids(self, user):
+        """(ids of the user's chats, ids of those that are group chats)"""
+        chats = Chat.participants.through.objects.filter(user_id=user.id).values_list('chat_id', 'chat__is_group')
+        chat_ids, group_chat_ids = set(), set()
+        for chat_id, is_group in chats:
+            chat_ids.add(chat_id)
+            if is_group:
+                group_chat_ids.add(chat_id)
+        return chat_ids, group_chat_ids
@@ -0,0 +1,66 @@
+"""
+One-to-one chats, looked up by their (pair_low, pair_high) key.
+
+Every direct chat stores its two participant ids in canonical order, under a
+unique constraint, so finding the chat between two users is one indexed
+lookup and concurrent "start chat" requests cannot create duplicates. Chats
+from before the key existed get it in migration 0006.
+"""
+from django.db import IntegrityError, transaction
+
+from .models import Chat, User
+
+
+def pair_key(user_id, other_id):
+    return (user_id, other_id) if user_id <= other_id else (other_id, user_id)
+
+
+def find_direct_chat(user_id, other_id):
+    low, high = pair_key(user_id, other_id)
+    return Chat.objects.filter(pair_low_id=low, pair_high_id=high).first()
+
+
+def find_direct_chat_by_phone(user, phone):
+    """
+    The direct chat between `user` and whoever has `phone`, or None.
+    Two unique-index lookups: the phone, then the pair key.
+    """
+    if phone == user.phone:
+        other_id = user.id
+    else:
+        other_id = User.objects.filter(phone=phone).values_list('id', flat=True).first()
+        if other_id is None:
+            return None
+    return find_direct_chat(user.id, other_id)
+
+
+async def afind_direct_chat_by_phone(user, phone):
+    """Async version of find_direct_chat_by_phone."""
+    if phone == user.phone:
+        other_id = user.id
+    else:
+        other_id = await User.objects.filter(phone=phone).values_list('id', flat=True).afirst()
+        if other_id is None:
+            return None
+    low, high = pair_key(user.id, other_id)
+    return await Chat.objects.filter(pair_low_id=low, pair_high_id=high).afirst()
+
+
+def get_or_create_direct_chat(user, other):
+    """
+    Return (chat, created) for the one-to-one chat between `user` and `other`
+    (the same user for a self chat), creating it with its participants and
+    memberships if needed. A concurrent creator loses on the unique
+    constraint and gets the winner's chat.
+    """
+    low, high = pair_key(user.id, other.id)
+    try:
+        with transaction.atomic():
+            chat, created = Chat.objects.get_or_create(pair_low_id=low, pair_high_id=high)
+            if created:
+                # Their memberships are created with them (see comms.participants)
+                chat.participants.set({user, other})
+    except IntegrityError:
+        return Chat.objects.get(pair_low_id=low, pair_high_id=high), False
+    return chat, created
+
@@ -0,0 +1,105 @@
+"""
+Whole-chat export as NDJSON or CSV.
+
+The chat is read through a server-side cursor in chunks and encoded as it is
+read, so an export holds one chunk of rows in memory however long the chat is.
+Archived messages (comms.cold_archive) are merged in, one block at a time.
+Lines are grouped into blocks of about FLUSH_BYTES before being handed to the
+response, rather than one write per message.
+"""
+import csv
+import heapq
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .cold_archive import iter_archived_rows
+from .models import Message, User
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'CHAT_EXPORT_CHUNK_SIZE', 2000)
+FLUSH_BYTES = 64 * 1024
+
+# Same names as MessageSerializer, so exported records match the history API
+EXPORT_FIELDS = ('id', 'timestamp', 'sender_username', 'text', 'delivered', 'read')
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+}
+
+
+class _Echo:
+    """File-like object whose write returns the line instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+def export_queryset(chat):
+    return (
+        Message.objects.filter(chat=chat)
+        .order_by('timestamp', 'id')
+        .values_list('id', 'timestamp', 'sender__username', 'text', 'delivered', 'read')
+    )
+
+
+def _encoder(fmt):
+    """Return (header, encode) for `fmt`: a first line or None, and row -> line."""
+    if fmt == 'csv':
+        writer = csv.writer(_Echo())
+        return writer.writerow(EXPORT_FIELDS), writer.writerow
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    return None, lambda row: encoder.encode(dict(zip(EXPORT_FIELDS, row))) + '\n'
+
+
+def export_rows(chat, chunk_size=EXPORT_CHUNK_SIZE):
+    """Every message of `chat` as an EXPORT_FIELDS tuple, oldest first, archived ones included."""
+    usernames = dict(User.objects.filter(chats=chat).values_list('id', 'username'))
+
+    def archived():
+        for id_, ts, sender_id, text, delivered, read in iter_archived_rows(chat):
+            if sender_id not in usernames:
+                # Sent by a former participant, or by a deleted user (None: skipped)
+                usernames[sender_id] = User.objects.filter(pk=sender_id).values_list('username', flat=True).first()
+            if usernames[sender_id] is not None:
+                yield id_, ts, usernames[sender_id], text, delivered, read
+
+    live = export_queryset(chat).iterator(chunk_size=chunk_size)
+    try:
+        yield from heapq.merge(archived(), live, key=lambda row: (row[1], row[0]))
+    finally:
+        live.close()
+
+
+async def _fetch_chunks(rows, chunk_size):
+    """
+    Yield lists of up to `chunk_size` items of the iterator `rows`, each
+    fetched in the ORM's thread. (QuerySet.aiterator would run values_list
+    queries on the event loop on Django 5.2.)
+    """
+    fetch = sync_to_async(lambda: list(islice(rows, chunk_size)))
+    try:
+        while chunk := await fetch():
+            yield chunk
+    finally:
+        # Releases the server-side cursor if the client goes away mid-export
+        await sync_to_async(rows.close)()
+
+
+async def aexport_chat(chat, fmt, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield `chat`'s messages, oldest first, as blocks of `fmt` text."""
+    header, encode = _encoder(fmt)
+    block = [header] if header else []
+    size = 0
+    async for rows in _fetch_chunks(export_rows(chat, chunk_size), chunk_size):
+        for row in rows:
+            line = encode(row)
+            block.append(line)
+            size += len(line)
+            if size >= FLUSH_BYTES:
+                yield ''.join(block)
+                block = []
+                size = 0
+    if block:
+        yield ''.join(block)
@@ -0,0 +1,215 @@
+"""
+Admission control, rate limiting and backpressure for the WebSocket consumers.
+
+- Admission: a worker accepts up to WS_MAX_CONNECTIONS sockets; beyond that
+  new ones are refused, so clients reconnect to a less loaded worker.
+- Rate limits: every frame takes a token from a bucket of its connection and
+  one of its user (WS_CONNECTION_RATE and WS_USER_RATE, as (frames per
+  second, burst)). Frames over the limit, or over WS_MAX_FRAME_BYTES, are
+  dropped before they are parsed. User buckets are per worker.
+- Backpressure: frames to a client go through a SendQueue of at most
+  WS_SEND_QUEUE_SIZE frames. When a client falls behind, state frames
+  (receipts, unread counts, typing, presence) are coalesced with later
+  frames of the same kind and dropped when the queue is full; a queue full of
+  messages closes the socket, and the client reloads once it reconnects.
+- Database tasks: database_sync_to_async holds one of DB_TASK_LIMIT slots
+  per worker while it runs, so a flood of frames queues on the event loop
+  instead of taking every thread of the pool.
+
+Refusals, drops and slot waits are exported through comms.metrics.
+"""
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import metrics
+from .frames import JSON, encode
+from .metrics import DB_SLOT_WAIT, DB_TASKS, WS_CONNECTIONS, WS_DROPPED, WS_REFUSED, WS_THROTTLED
+from .utils import LRUCache
+
+logger = logging.getLogger(__name__)
+
+WS_MAX_CONNECTIONS = getattr(settings, 'WS_MAX_CONNECTIONS', 10000)
+WS_MAX_FRAME_BYTES = getattr(settings, 'WS_MAX_FRAME_BYTES', 65536)
+WS_CONNECTION_RATE = getattr(settings, 'WS_CONNECTION_RATE', (10, 30))
+WS_USER_RATE = getattr(settings, 'WS_USER_RATE', (20, 60))
+WS_SEND_QUEUE_SIZE = getattr(settings, 'WS_SEND_QUEUE_SIZE', 256)
+DB_TASK_LIMIT = getattr(settings, 'DB_TASK_LIMIT', 16)
+
+USER_BUCKETS_SIZE = 100000
+
+# Frame types a client can do without: later frames or a reload bring it up to date
+DROPPABLE_FRAMES = frozenset({'status', 'unread', 'typing', 'presence'})
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average and bursts of up to `burst`."""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._updated = clock()
+
+    def take(self, n=1):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens < n:
+            return False
+        self._tokens -= n
+        return True
+
+
+_user_buckets = LRUCache(USER_BUCKETS_SIZE)
+
+
+def user_bucket(user_id):
+    bucket = _user_buckets.get(user_id)
+    if bucket is None:
+        bucket = TokenBucket(*WS_USER_RATE)
+        _user_buckets.set(user_id, bucket)
+    return bucket
+
+
+def frame_size(data):
+    """Size in bytes of a raw frame: its UTF-8 length for a text frame."""
+    return len(data) if isinstance(data, bytes) else len(data.encode())
+
+
+def frame_limit(data, connection_bucket, user_id):
+    """The limit a raw frame exceeds ('size', 'connection' or 'user'), or None to handle it."""
+    if frame_size(data) > WS_MAX_FRAME_BYTES:
+        limit = 'size'
+    elif not connection_bucket.take():
+        limit = 'connection'
+    elif user_id is not None and not user_bucket(user_id).take():
+        limit = 'user'
+    else:
+        return None
+    WS_THROTTLED.inc(limit)
+    return limit
+
+
+def admit_connection():
+    """Count a new socket in, unless this worker is full. Returns whether it was admitted."""
+    if WS_CONNECTIONS.value() >= WS_MAX_CONNECTIONS:
+        WS_REFUSED.inc('capacity')
+        return False
+    WS_CONNECTIONS.inc()
+    return True
+
+
+def release_connection():
+    WS_CONNECTIONS.inc(amount=-1)
+
+
+def coalesce_key(frame):
+    """Frames with the same key carry state the latest of them supersedes; None for any other frame."""
+    kind = frame.get('type')
+    if kind == 'unread':
+        return kind, frame.get('chat_id')
+    if kind == 'typing':
+        return kind, frame.get('chat_id'), frame['user_id']
+    if kind == 'presence':
+        return kind, frame['user_id']
+    if kind == 'status' and 'up_to' in frame:
+        # Watermarks only grow; per-message receipts do not coalesce
+        return kind, frame.get('chat_id'), frame['status'], frame['reader']
+    return None
+
+
+class SendQueue:
+    """
+    Frames waiting to be written to one client, oldest first, written by a
+    task of their own so that handlers never wait on a slow socket. Frames
+    are encoded as they are written, unless they come already encoded.
+    """
+
+    def __init__(self, send, maxsize=WS_SEND_QUEUE_SIZE, encoding=JSON):
+        self._send = send
+        self.maxsize = maxsize
+        self.encoding = encoding
+        self._frames = OrderedDict()
+        self._ids = itertools.count()
+        self._ready = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._frames)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def put(self, frame, encoded=None):
+        """
+        Queue `frame`, with its {encoding: data} if already encoded. Returns
+        False if the queue is full of frames that may not be dropped, and the
+        client has to be disconnected.
+        """
+        key = coalesce_key(frame)
+        if key is not None and self._frames.pop(key, None) is not None:
+            WS_DROPPED.inc(frame['type'], 'coalesced')
+        elif len(self._frames) >= self.maxsize:
+            if frame['type'] in DROPPABLE_FRAMES:
+                WS_DROPPED.inc(frame['type'], 'queue_full')
+                return True
+            for queued_key, (queued, _) in self._frames.items():
+                if queued['type'] in DROPPABLE_FRAMES:
+                    del self._frames[queued_key]
+                    WS_DROPPED.inc(queued['type'], 'queue_full')
+                    break
+            else:
+                WS_DROPPED.inc(frame['type'], 'overflow')
+                return False
+        self._frames[key if key is not None else next(self._ids)] = (frame, encoded)
+        self._ready.set()
+        return True
+
+    async def _run(self):
+        try:
+            while True:
+                await self._ready.wait()
+                while self._frames:
+                    _, (frame, encoded) = self._frames.popitem(last=False)
+                    await self._send(encoded[self.encoding] if encoded else encode(frame, self.encoding))
+                self._ready.clear()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The socket is gone; disconnect() cleans up
+            logger.debug("Stopped writing to a closed socket", exc_info=True)
+
+
+_db_slots = None
+
+
+def db_slots():
+    global _db_slots
+    loop = asyncio.get_running_loop()
+    if _db_slots is None or _db_slots[0] is not loop:
+        _db_slots = (loop, asyncio.Semaphore(DB_TASK_LIMIT))
+    return _db_slots[1]
+
+
+class database_sync_to_async(metrics.database_sync_to_async):
+    """metrics.database_sync_to_async that runs in one of DB_TASK_LIMIT slots."""
+
+    async def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        async with db_slots():
+            DB_SLOT_WAIT.observe(time.perf_counter() - start)
+            DB_TASKS.inc()
+            try:
+                return await super().__call__(*args, **kwargs)
+            finally:
+                DB_TASKS.inc(amount=-1)
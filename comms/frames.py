@@ -0,0 +1,147 @@
+"""
+WebSocket frame encodings.
+
+Frames are JSON text by default. A client that offers the MSGPACK_SUBPROTOCOL
+when it opens the socket gets binary msgpack frames instead, with field names
+and frame types replaced by the short codes below, and may send its own
+frames either way. Clients that offer nothing see no change.
+
+Broadcast frames are built from channel-layer events by `build_frame`, and
+`encode_all` encodes a frame once for every encoding; comms.consumers
+attaches those bytes to the event, so each recipient socket sends them as
+they are instead of encoding the frame again.
+"""
+import json
+
+import msgpack
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+ENCODINGS = (JSON, MSGPACK)
+
+MSGPACK_SUBPROTOCOL = 'messenger.msgpack.v1'
+
+FIELD_CODES = {
+    'type': 't',
+    'chat_id': 'c',
+    'message': 'm',
+    'sender': 's',
+    'timestamp': 'ts',
+    'message_id': 'i',
+    'message_ids': 'is',
+    'client_msg_id': 'k',
+    'delivered': 'd',
+    'read': 'r',
+    'unread_count': 'u',
+    'status': 'st',
+    'reader': 'rd',
+    'up_to': 'ut',
+    'user_id': 'ui',
+    'username': 'un',
+    'online': 'o',
+    'last_seen': 'ls',
+    'error': 'e',
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+TYPE_CODES = {
+    'message': 1,
+    'status': 2,
+    'unread': 3,
+    'ack': 4,
+    'typing': 5,
+    'presence': 6,
+    'error': 7,
+    'delivered': 8,
+    'read': 9,
+    'heartbeat': 10,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+
+def encode(frame, encoding=JSON):
+    """`frame` as text (JSON) or bytes (msgpack)."""
+    if encoding == JSON:
+        return json.dumps(frame)
+    return msgpack.packb({
+        FIELD_CODES.get(name, name): TYPE_CODES.get(value, value) if name == 'type' else value
+        for name, value in frame.items()
+    })
+
+
+def encode_all(frame):
+    return {encoding: encode(frame, encoding) for encoding in ENCODINGS}
+
+
+class FrameError(ValueError):
+    """A client frame that is not a JSON object or msgpack map."""
+
+
+def decode(text_data=None, bytes_data=None):
+    """A client frame as a dict, from JSON text or a msgpack binary frame. Raises FrameError."""
+    try:
+        frame = json.loads(text_data) if text_data is not None else msgpack.unpackb(bytes_data)
+    except (ValueError, TypeError, msgpack.UnpackException) as e:
+        raise FrameError(str(e)) from e
+    if not isinstance(frame, dict):
+        raise FrameError(f"Expected a map, not {type(frame).__name__}")
+    # Frame types are looked up in sets and dicts
+    if not isinstance(frame.get('type' if text_data is not None else FIELD_CODES['type']), (str, int, type(None))):
+        raise FrameError("Bad frame type")
+    if text_data is None:
+        frame = {FIELD_NAMES.get(code, code): value for code, value in frame.items()}
+        if 'type' in frame:
+            frame['type'] = TYPE_NAMES.get(frame['type'], frame['type'])
+    return frame
+
+
+def _message_frame(event):
+    frame = {
+        'type': 'message',
+        'message': event['message'],
+        'sender': event['sender'],
+        'timestamp': event['timestamp'],
+        'message_id': event['message_id'],
+        'client_msg_id': event.get('client_msg_id'),
+        'delivered': event['delivered'],
+        'read': event['read'],
+    }
+    if 'chat_id' in event:
+        frame['unread_count'] = event.get('unread_count')
+    return frame
+
+
+def _status_frame(event):
+    # Tick updates for the messages acknowledged by `reader`
+    return {
+        'type': 'status',
+        'status': event['status'],
+        'reader': event['reader'],
+        **({'up_to': event['up_to']} if 'up_to' in event else {'message_ids': event['message_ids']}),
+    }
+
+
+def _typing_frame(event):
+    return {
+        'type': 'typing',
+        'user_id': event['user_id'],
+        'username': event['username'],
+    }
+
+
+FRAME_BUILDERS = {
+    'chat_message': _message_frame,
+    'receipt_status': _status_frame,
+    'typing_status': _typing_frame,
+}
+
+
+def build_frame(event):
+    """
+    The client frame for a broadcast chat event. Events sent to user groups
+    carry the chat_id and so does their frame; chat-group events do not.
+    """
+    frame = FRAME_BUILDERS[event['type']](event)
+    if 'chat_id' in event:
+        frame = {'type': frame.pop('type'), 'chat_id': event['chat_id'], **frame}
+    return frame
@@ -0,0 +1,221 @@
+"""
+Receipts and unread counts of group chats, kept per member instead of per message.
+
+One-to-one chats flip Message.delivered and Message.read, and bump every
+member's unread counter on each send (see comms.membership). That is a row
+write per member per message, which rooms of thousands cannot afford, and one
+boolean cannot say which of many recipients has read a message. Group chats
+keep instead:
+
+  Chat.message_count                    messages stored in the chat
+  Chat.last_message                     the newest of them
+  ChatMembership.last_delivered_message the member's watermarks: every message
+  ChatMembership.last_read_message      up to that id has reached / been read
+                                        by them
+  ChatMembership.read_count             message_count as of the read watermark
+  Chat.delivered_watermark              the lowest of the members' watermarks
+  Chat.read_watermark
+
+So a send is one UPDATE of the chat row plus one of the sender's membership
+(sending marks the chat read for its sender), whatever the room size. A
+member's unread count is message_count - read_count. "Read by k of n" is how
+many of the other members' watermarks reach a message. Message.delivered and
+Message.read mean that every member has got that far. They are flipped when
+the chat's watermark moves, which is also the only time a receipt is broadcast.
+"""
+from bisect import bisect_left
+
+from django.db import transaction
+from django.db.models import (
+    BigIntegerField, Case, Count, Exists, F, Min, PositiveBigIntegerField, Q, Subquery, Value, When,
+)
+from django.db.models.functions import Coalesce, Greatest
+
+from .chat_list import invalidate_chat_lists, invalidate_group_chat_lists
+from .models import Chat, ChatMembership, Message
+
+DELIVERED = 'delivered'
+READ = 'read'
+
+# Per receipt status: the member's watermark, the chat's, and the Message flags it sets
+WATERMARKS = {
+    DELIVERED: ('last_delivered_message', 'delivered_watermark', {'delivered': True}),
+    READ: ('last_read_message', 'read_watermark', {'delivered': True, 'read': True}),
+}
+
+
+def group_chat_ids(chat_ids):
+    return set(Chat.objects.filter(pk__in=chat_ids, is_group=True).values_list('pk', flat=True))
+
+
+def unread_count_expression():
+    """
+    ChatMembership annotation with the member's unread count: measured from
+    the read watermark in group chats, the stored counter in any other.
+    """
+    return Case(
+        When(chat__is_group=True, then=Greatest(
+            F('chat__message_count') - F('read_count'), Value(0), output_field=PositiveBigIntegerField(),
+        )),
+        default=F('unread_count'),
+        output_field=PositiveBigIntegerField(),
+    )
+
+
+def _count_up_to(chat_id, up_to):
+    """Expression: how many messages of the chat have ids up to `up_to`."""
+    total = Chat.objects.filter(pk=chat_id).values('message_count')
+    # Only the tail after the watermark is counted, which stays short
+    after = Message.objects.filter(chat_id=chat_id, id__gt=up_to).order_by() \
+        .values('chat_id').annotate(n=Count('id')).values('n')
+    return Greatest(
+        Subquery(total) - Coalesce(Subquery(after), Value(0)), Value(0), output_field=PositiveBigIntegerField(),
+    )
+
+
+def _advance(chat_id, user_id, status, up_to):
+    """
+    Move a member's `status` watermark up to `up_to`, never back; a read
+    watermark takes the delivered one along. `up_to` has to be a stored
+    message of the chat: an id past the newest one would leave the watermark
+    ahead of messages yet to be sent. Returns whether it moved.
+    """
+    field = WATERMARKS[status][0]
+    changes = {
+        'last_delivered_message_id': Greatest(
+            Coalesce('last_delivered_message_id', Value(0), output_field=BigIntegerField()), Value(up_to),
+            output_field=BigIntegerField(),
+        ),
+    }
+    if status == READ:
+        changes.update(last_read_message_id=Value(up_to), read_count=_count_up_to(chat_id, up_to))
+    behind = Q(**{f'{field}__isnull': True}) | Q(**{f'{field}__lt': up_to})
+    stored = Exists(Message.objects.filter(pk=up_to, chat_id=chat_id))
+    return ChatMembership.objects.filter(behind, stored, chat_id=chat_id, user_id=user_id).update(**changes) > 0
+
+
+def record_group_messages(chat_id, messages):
+    """
+    Count a batch of new messages of a group chat in: one UPDATE of the chat
+    and one per sender, whose watermarks move to the newest message they
+    sent. The other members' rows are not written.
+    """
+    Chat.objects.filter(pk=chat_id).update(
+        message_count=F('message_count') + len(messages),
+        last_message=max(messages, key=lambda m: (m.timestamp, m.id)),
+    )
+    newest_sent = {}
+    for message in messages:
+        newest_sent[message.sender_id] = max(message.id, newest_sent.get(message.sender_id, message.id))
+    for sender_id, message_id in newest_sent.items():
+        _advance(chat_id, sender_id, READ, message_id)
+    invalidate_group_chat_lists(chat_id)
+
+
+def apply_receipt(chat_id, reader, status, up_to):
+    """
+    Move `reader`'s delivered or read watermark in a group chat up to message
+    `up_to`, which is ignored unless it is a message of the chat. Returns (whether the reader's watermark moved, the chat's new
+    watermark for `status` if this moved it too, else None): everything up to
+    the chat's watermark has reached, or been read by, every member.
+
+    While any member is still at the chat's watermark, a receipt costs two
+    short statements and the members' rows are not scanned. Two receipts
+    that race to move it may each see the other still behind; the next
+    receipt in the chat moves it then.
+    """
+    field, chat_field, flags = WATERMARKS[status]
+    with transaction.atomic():
+        if not _advance(chat_id, reader.id, status, up_to):
+            return False, None
+        if status == READ:
+            invalidate_chat_lists([reader.id])
+
+        members = ChatMembership.objects.filter(chat_id=chat_id)
+        current = Chat.objects.filter(pk=chat_id).values(chat_field)
+        if members.filter(Q(**{f'{field}__isnull': True}) | Q(**{f'{field}__lte': Subquery(current)})).exists():
+            return True, None
+
+        chat = Chat.objects.select_for_update().only(chat_field).get(pk=chat_id)
+        previous = getattr(chat, chat_field)
+        watermark = members.aggregate(low=Min(field))['low']
+        if watermark is None or watermark <= previous:
+            return True, None
+        Message.objects.filter(chat_id=chat_id, id__gt=previous, id__lte=watermark).update(**flags)
+        Chat.objects.filter(pk=chat_id).update(**{chat_field: watermark})
+    return True, watermark
+
+
+def join_state(chat):
+    """
+    ChatMembership fields for someone joining a group chat: its history
+    counts as delivered and read.
+    """
+    return {
+        'last_delivered_message_id': chat.last_message_id,
+        'last_read_message_id': chat.last_message_id,
+        'read_count': chat.message_count,
+    }
+
+
+def _receipt_counts(messages, watermarks):
+    delivered = sorted(d for d, _ in watermarks.values())
+    read = sorted(r for _, r in watermarks.values())
+    counts = {}
+    for message in messages:
+        own = watermarks.get(message.sender_id)
+        # The sender is always past their own message
+        others = len(watermarks) - (own is not None)
+        counts[message.id] = {
+            'delivered_to': len(delivered) - bisect_left(delivered, message.id) - (own is not None and own[0] >= message.id),
+            'read_by': len(read) - bisect_left(read, message.id) - (own is not None and own[1] >= message.id),
+            'recipients': others,
+        }
+    return counts
+
+
+def _watermarks_query(chat_id):
+    return ChatMembership.objects.filter(chat_id=chat_id) \
+        .values_list('user_id', 'last_delivered_message_id', 'last_read_message_id')
+
+
+def receipt_counts(chat_id, messages):
+    """
+    {message id: {'delivered_to', 'read_by', 'recipients'}} for messages of a
+    group chat: of the members other than the sender, how many have each
+    watermark at or past the message. One query, however many messages.
+    """
+    return _receipt_counts(messages, {
+        user_id: (delivered or 0, read or 0) for user_id, delivered, read in _watermarks_query(chat_id)
+    })
+
+
+async def areceipt_counts(chat_id, messages):
+    return _receipt_counts(messages, {
+        user_id: (delivered or 0, read or 0) async for user_id, delivered, read in _watermarks_query(chat_id)
+    })
+
+
+def rebuild_group_chats(chat_ids):
+    """
+    Recompute the counters and watermarks of group chats from Message and
+    the members' read and delivered pointers, which are kept as they are.
+    """
+    for chat in Chat.objects.filter(pk__in=chat_ids, is_group=True):
+        messages = Message.objects.filter(chat=chat).order_by()
+        memberships = list(ChatMembership.objects.filter(chat=chat))
+        for membership in memberships:
+            read_up_to = membership.last_read_message_id
+            if read_up_to and (membership.last_delivered_message_id or 0) < read_up_to:
+                membership.last_delivered_message_id = read_up_to
+            membership.read_count = messages.filter(id__lte=read_up_to).count() if read_up_to else 0
+            membership.unread_count = 0
+        ChatMembership.objects.bulk_update(memberships, ['last_delivered_message', 'read_count', 'unread_count'])
+
+        chat.message_count = messages.count()
+        chat.last_message = messages.order_by('-timestamp', '-id').first()
+        chat.delivered_watermark = min((m.last_delivered_message_id or 0 for m in memberships), default=0)
+        chat.read_watermark = min((m.last_read_message_id or 0 for m in memberships), default=0)
+        chat.save(update_fields=['message_count', 'last_message', 'delivered_watermark', 'read_watermark'])
+        messages.filter(id__lte=chat.delivered_watermark, delivered=False).update(delivered=True)
+        messages.filter(id__lte=chat.read_watermark, read=False).update(read=True)
@@ -0,0 +1,108 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Q
+
+from .cold_archive import archive_horizon, archived_page, find_archived_cursor
+from .models import Message
+
+DEFAULT_PAGE_SIZE = getattr(settings, 'MESSAGE_PAGE_SIZE', 50)
+MAX_PAGE_SIZE = getattr(settings, 'MESSAGE_MAX_PAGE_SIZE', 200)
+
+
+def clamp_page_size(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def _cursor_query(chat, cursor_id):
+    return Message.objects.filter(chat=chat, pk=cursor_id).values('timestamp', 'id')
+
+
+def _page_query(chat, cursor, before_id=None, after_id=None):
+    """
+    The ordered queryset one page is sliced from; ordered oldest first when
+    paging forward (after_id) and newest first otherwise.
+    """
+    messages = Message.objects.filter(chat=chat).select_related('sender')
+    if after_id is not None:
+        return messages.filter(
+            Q(timestamp__gt=cursor['timestamp']) | Q(timestamp=cursor['timestamp'], id__gt=cursor['id'])
+        ).order_by('timestamp', 'id')
+    if before_id is not None:
+        messages = messages.filter(
+            Q(timestamp__lt=cursor['timestamp']) | Q(timestamp=cursor['timestamp'], id__lt=cursor['id'])
+        )
+    return messages.order_by('-timestamp', '-id')
+
+
+def _may_reach_archive(page, limit):
+    """
+    Could archived messages belong on this page? Only if the live table ran
+    out of messages in the paging direction, or the page reaches back past
+    the archive horizon (older messages kept live can sit among archived ones).
+    """
+    if len(page) <= limit:
+        return True
+    horizon = archive_horizon()
+    return horizon is not None and page[-1].timestamp < horizon
+
+
+def _merge_archived(page, archived, limit, forward):
+    if not archived:
+        return page
+    return sorted(page + archived, key=lambda m: (m.timestamp, m.id), reverse=not forward)[:limit + 1]
+
+
+def _page_result(page, limit, forward):
+    has_more = len(page) > limit
+    page = page[:limit]
+    return (page if forward else page[::-1]), has_more
+
+
+def get_message_page(chat, before_id=None, after_id=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Return (messages, has_more) for one page of `chat`'s history, oldest first.
+
+    Pages are keyed on (timestamp, id) so each one is a single range scan on the
+    (chat, timestamp, id) index however long the chat is:
+      - no cursor: the newest `limit` messages
+      - before_id: the `limit` messages immediately older than that message
+      - after_id: the `limit` messages immediately newer than that message
+    `has_more` tells whether further messages exist in the direction paged.
+    A cursor that is not a message of this chat yields an empty page.
+    Archived messages (comms.cold_archive) are merged in where they belong.
+    """
+    forward = after_id is not None
+    cursor_id = before_id if before_id is not None else after_id
+    cursor = None
+    if cursor_id is not None:
+        cursor = _cursor_query(chat, cursor_id).first() or find_archived_cursor(chat, cursor_id)
+        if cursor is None:
+            return [], False
+
+    page = list(_page_query(chat, cursor, before_id, after_id)[:limit + 1])
+    if _may_reach_archive(page, limit):
+        page = _merge_archived(page, archived_page(chat, cursor, forward, limit + 1), limit, forward)
+    return _page_result(page, limit, forward)
+
+
+async def aget_message_page(chat, before_id=None, after_id=None, limit=DEFAULT_PAGE_SIZE):
+    """Async version of get_message_page."""
+    forward = after_id is not None
+    cursor_id = before_id if before_id is not None else after_id
+    cursor = None
+    if cursor_id is not None:
+        cursor = await _cursor_query(chat, cursor_id).afirst()
+        if cursor is None:
+            cursor = await sync_to_async(find_archived_cursor)(chat, cursor_id)
+        if cursor is None:
+            return [], False
+
+    page = [message async for message in _page_query(chat, cursor, before_id, after_id)[:limit + 1]]
+    if _may_reach_archive(page, limit):
+        archived = await sync_to_async(archived_page)(chat, cursor, forward, limit + 1)
+        page = _merge_archived(page, archived, limit, forward)
+    return _page_result(page, limit, forward)
@@ -0,0 +1,126 @@
+"""
+Snowflake-style message ids, assigned without a database round trip.
+
+An id packs the milliseconds since ID_EPOCH (41 bits), the worker id (10 bits)
+and a per-millisecond sequence (12 bits) into a positive 63-bit integer, so ids
+from one worker strictly increase and ids from different workers are ordered
+to the millisecond. They are the default of Message.id, so every insert path
+takes its ids from here. Rows from before that keep their sequence ids, which
+are all below any of these: id order stays the order messages were created in,
+which receipts and read watermarks rely on.
+
+Each process leases a worker id in the shared cache on first use: it holds
+the key of the first free id for MESSAGE_ID_LEASE seconds, and renews it
+whenever a third of that has gone by before minting more ids. A process that
+finds its lease taken over (it stalled for longer than the lease) moves to a
+free id, so no two live processes mint with the same one. Without a shared
+cache there is nothing to lease from, and settings.MESSAGE_ID_WORKER has to
+pin the id instead.
+"""
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+ID_EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+LEASE_SECONDS = getattr(settings, 'MESSAGE_ID_LEASE', 60)
+
+
+def _lease_key(worker_id):
+    return f'message_ids:worker:{worker_id}'
+
+
+def pinned_worker_id():
+    """settings.MESSAGE_ID_WORKER, checked, or None to lease one."""
+    worker = getattr(settings, 'MESSAGE_ID_WORKER', None)
+    if worker is None:
+        return None
+    if not 0 <= int(worker) <= MAX_WORKER:
+        raise ImproperlyConfigured(f"MESSAGE_ID_WORKER must be between 0 and {MAX_WORKER}, not {worker}")
+    return int(worker)
+
+
+def lease_worker_id(owner, start=0):
+    """Lease the first free worker id from `start` on for `owner`. Returns it."""
+    if isinstance(caches['default'], (LocMemCache, DummyCache)):
+        raise ImproperlyConfigured(
+            "Message ids need a worker id per process: set REDIS_URL so that processes lease "
+            "distinct ones from the shared cache, or pin one with MESSAGE_ID_WORKER"
+        )
+    for offset in range(MAX_WORKER + 1):
+        worker_id = (start + offset) & MAX_WORKER
+        if cache.add(_lease_key(worker_id), owner, LEASE_SECONDS):
+            return worker_id
+    raise RuntimeError(f"All {MAX_WORKER + 1} message id workers are leased")
+
+
+def renew_worker_id(worker_id, owner):
+    """Extend `owner`'s lease of `worker_id`. Returns False if it is no longer theirs."""
+    return cache.get(_lease_key(worker_id)) == owner and cache.touch(_lease_key(worker_id), LEASE_SECONDS)
+
+
+class SnowflakeGenerator:
+    def __init__(self, worker_id=None, clock=time.time, monotonic=time.monotonic):
+        self._pinned = worker_id
+        self._worker_id = None
+        self._clock = clock
+        self._monotonic = monotonic
+        self._renewed = None
+        self._owner = uuid.uuid4().hex
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    @property
+    def worker_id(self):
+        with self._lock:
+            return self._current_worker_id()
+
+    def _current_worker_id(self):
+        if self._pinned is None:
+            self._pinned = pinned_worker_id()
+        if self._pinned is not None:
+            return self._pinned
+        now = self._monotonic()
+        if self._worker_id is None:
+            self._worker_id = lease_worker_id(self._owner, start=uuid.UUID(self._owner).int & MAX_WORKER)
+            self._renewed = now
+        elif now - self._renewed > LEASE_SECONDS / 3:
+            if not renew_worker_id(self._worker_id, self._owner):
+                self._worker_id = lease_worker_id(self._owner, start=self._worker_id + 1)
+            self._renewed = now
+        return self._worker_id
+
+    def next_id(self):
+        with self._lock:
+            worker_id = self._current_worker_id()
+            ms = int(self._clock() * 1000) - ID_EPOCH_MS
+            if ms < self._last_ms:
+                # The clock stepped back: keep counting in the last millisecond seen
+                ms = self._last_ms
+            if ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # 4096 ids this millisecond already; borrow the next one
+                    ms += 1
+            else:
+                self._sequence = 0
+            self._last_ms = ms
+            return (ms << (WORKER_BITS + SEQUENCE_BITS)) | (worker_id << SEQUENCE_BITS) | self._sequence
+
+
+message_ids = SnowflakeGenerator()
+
+
+def next_message_id():
+    return message_ids.next_id()
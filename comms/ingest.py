@@ -0,0 +1,264 @@
+"""
+Bulk import of message history, e.g. when moving users over from another system.
+
+Records are streamed from JSONL or CSV, resolved to user and chat ids through
+in-memory maps and written in chunks: COPY on Postgres, bulk_create elsewhere.
+Original send times are kept. Nothing denormalized is maintained per row;
+ChatMembership counters and pointers (and with them the chat-list caches) are
+rebuilt once for the imported chats at the end.
+
+Record fields:
+  sender      phone number of the sender (required)
+  recipient   phone number of the other user of a one-to-one chat, created if
+              it does not exist yet
+  chat        id of an existing chat the sender belongs to, instead of recipient
+  text        message text (required)
+  timestamp   ISO 8601 send time, or Unix seconds (required); naive times are
+              in settings.TIME_ZONE
+  delivered, read
+              optional booleans, false by default
+
+Messages get their ids as they are read (see comms.ids), and receipts and
+read watermarks take id order to be send order. So history can only go into
+chats with no messages yet, and each chat's records have to come in send
+order: records for a chat that already had messages are skipped ('chat has
+messages'), and so are records older than the one before them in their chat
+('out of order'). Sort the input by time first if needed.
+
+Users must exist already. Records that cannot be resolved are skipped and
+counted by reason. Each chunk commits on its own, so an interrupted import can
+be resumed by trimming the input rather than starting over.
+"""
+import csv
+import json
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .direct_chats import get_or_create_direct_chat, pair_key
+from .membership import rebuild_memberships
+from .models import Chat, ColdMessageBlock, Message, User
+from .partitions import create_missing_partitions, is_partitioned, month_start
+
+DEFAULT_BATCH_SIZE = 5000
+FORMATS = ('jsonl', 'csv')
+COPY_FIELDS = ('id', 'chat', 'sender', 'text', 'timestamp', 'delivered', 'read')
+TRUE_STRINGS = {'1', 'true', 't', 'yes', 'y'}
+
+
+class ImportStats:
+    """Running totals of one import."""
+
+    def __init__(self):
+        self.rows = 0
+        self.skipped = Counter()
+        self.chats_created = 0
+        self.started = time.perf_counter()
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def stop(self):
+        self.seconds = time.perf_counter() - self.started
+
+
+def read_records(stream, fmt):
+    """Yield one dict per record of a JSONL or CSV text stream."""
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+    elif fmt == 'jsonl':
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raise ValueError(f"Unknown format {fmt!r}; expected one of {', '.join(FORMATS)}")
+
+
+def open_records(path, fmt=None):
+    """
+    Open `path` ('-' for stdin) and return (stream, records). The format is
+    taken from the extension unless given.
+    """
+    if fmt is None:
+        fmt = 'csv' if path.endswith('.csv') else 'jsonl'
+    stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+    return stream, read_records(stream, fmt)
+
+
+def parse_timestamp(value):
+    if isinstance(value, (int, float)) or (isinstance(value, str) and value.replace('.', '', 1).isdigit()):
+        return datetime.fromtimestamp(float(value), tz=dt_timezone.utc)
+    parsed = parse_datetime(value) if isinstance(value, str) else None
+    if parsed is not None and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def parse_flag(value):
+    if isinstance(value, str):
+        return value.strip().lower() in TRUE_STRINGS
+    return bool(value)
+
+
+class _Resolver:
+    """Phone, pair and membership maps, loaded once per import."""
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.user_ids = dict(User.objects.values_list('phone', 'id').iterator(chunk_size=DEFAULT_BATCH_SIZE))
+        self.direct_chats = {
+            (low, high): chat_id
+            for low, high, chat_id in Chat.objects.filter(pair_low__isnull=False)
+            .values_list('pair_low_id', 'pair_high_id', 'id').iterator(chunk_size=DEFAULT_BATCH_SIZE)
+        }
+        self._participants = None
+        # Whether each chat seen had messages before the import; the send time of its last record
+        self._had_messages = {}
+        self._last_sent = {}
+
+    def participants(self):
+        # Only needed for records that name a chat id
+        if self._participants is None:
+            links = Chat.participants.through.objects.values_list('chat_id', 'user_id')
+            self._participants = set(links.iterator(chunk_size=DEFAULT_BATCH_SIZE))
+        return self._participants
+
+    def chat_id(self, record, sender_id):
+        if record.get('chat') not in (None, ''):
+            try:
+                chat_id = int(record['chat'])
+            except (TypeError, ValueError):
+                return None, 'bad chat'
+            if (chat_id, sender_id) not in self.participants():
+                return None, 'sender not in chat'
+            return chat_id, None
+
+        other_id = self.user_ids.get(str(record.get('recipient') or '').strip())
+        if other_id is None:
+            return None, 'unknown recipient'
+        key = pair_key(sender_id, other_id)
+        chat_id = self.direct_chats.get(key)
+        if chat_id is None:
+            users = User.objects.in_bulk(key)
+            chat, created = get_or_create_direct_chat(users[key[0]], users[key[1]])
+            chat_id = self.direct_chats[key] = chat.id
+            if self._participants is not None:
+                self._participants.update({(chat_id, key[0]), (chat_id, key[1])})
+            self.stats.chats_created += created
+        return chat_id, None
+
+    def had_messages(self, chat_id):
+        if chat_id not in self._had_messages:
+            self._had_messages[chat_id] = (
+                Message.objects.filter(chat_id=chat_id).exists()
+                or ColdMessageBlock.objects.filter(chat_id=chat_id).exists()
+            )
+        return self._had_messages[chat_id]
+
+    def message(self, record):
+        """Return (Message, None), or (None, reason) for a record that is skipped."""
+        sender_id = self.user_ids.get(str(record.get('sender') or '').strip())
+        if sender_id is None:
+            return None, 'unknown sender'
+        text = record.get('text')
+        if not text:
+            return None, 'empty text'
+        try:
+            sent_at = parse_timestamp(record.get('timestamp'))
+        except (TypeError, ValueError, OverflowError):
+            sent_at = None
+        if sent_at is None:
+            return None, 'bad timestamp'
+        chat_id, reason = self.chat_id(record, sender_id)
+        if chat_id is None:
+            return None, reason
+        if self.had_messages(chat_id):
+            return None, 'chat has messages'
+        if sent_at < self._last_sent.get(chat_id, sent_at):
+            return None, 'out of order'
+        self._last_sent[chat_id] = sent_at
+        return Message(
+            chat_id=chat_id,
+            sender_id=sender_id,
+            text=text,
+            timestamp=sent_at,
+            delivered=parse_flag(record.get('delivered', False)),
+            read=parse_flag(record.get('read', False)),
+        ), None
+
+
+def _copy_messages(messages):
+    """Write `messages` with a single COPY (Postgres only)."""
+    columns = ', '.join(connection.ops.quote_name(Message._meta.get_field(name).column) for name in COPY_FIELDS)
+    table = connection.ops.quote_name(Message._meta.db_table)
+    with connection.cursor() as cursor:
+        with cursor.copy(f'COPY {table} ({columns}) FROM STDIN') as copy:
+            for m in messages:
+                copy.write_row((m.id, m.chat_id, m.sender_id, m.text, m.timestamp, m.delivered, m.read))
+
+
+def _write_chunk(messages, use_copy):
+    with transaction.atomic():
+        if use_copy:
+            _copy_messages(messages)
+        else:
+            Message.objects.bulk_create(messages)
+
+
+def import_messages(records, batch_size=DEFAULT_BATCH_SIZE, use_copy=None, progress=None):
+    """
+    Insert the messages described by `records` (an iterable of dicts, see the
+    module docstring) and rebuild the memberships of every chat they touched.
+
+    `use_copy` defaults to True on Postgres. `progress`, if given, is called
+    with the running ImportStats after each chunk. Returns the ImportStats.
+    """
+    if use_copy is None:
+        use_copy = connection.vendor == 'postgresql'
+    stats = ImportStats()
+    resolver = _Resolver(stats)
+    touched = set()
+    batch = []
+    # Months with a partition, so old history does not pile up in the default partition
+    partitioned_months = set() if is_partitioned() else None
+
+    def flush():
+        if partitioned_months is not None:
+            months = {month_start(m.timestamp) for m in batch} - partitioned_months
+            if months:
+                create_missing_partitions(months)
+                partitioned_months.update(months)
+        _write_chunk(batch, use_copy)
+        stats.rows += len(batch)
+        touched.update(m.chat_id for m in batch)
+        batch.clear()
+        stats.stop()
+        if progress is not None:
+            progress(stats)
+
+    try:
+        for record in records:
+            message, reason = resolver.message(record)
+            if message is None:
+                stats.skipped[reason] += 1
+                continue
+            batch.append(message)
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+    finally:
+        # Rebuild whatever was committed, even if a later chunk failed
+        chat_ids = sorted(touched)
+        for start in range(0, len(chat_ids), batch_size):
+            rebuild_memberships(chat_ids=chat_ids[start:start + batch_size], batch_size=batch_size)
+        stats.stop()
+
+    return stats
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from comms.models import User
+from comms.thumbnails import build_thumbnails
+from comms.utils import file_checksum
+
+
+class Command(BaseCommand):
+    help = ("Record avatar checksums for profile pictures uploaded before they were tracked, "
+            "clear pictures missing from storage, and build any missing thumbnails.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="Recompute checksums and thumbnails that already exist, too.")
+
+    def handle(self, *args, **options):
+        users = User.objects.exclude(profile_picture='').exclude(profile_picture__isnull=True)
+        if not options['all']:
+            users = users.filter(avatar_checksum='')
+
+        updated = missing = 0
+        for user in users.iterator():
+            storage = user.profile_picture.storage
+            if storage.exists(user.profile_picture.name):
+                with user.profile_picture.open('rb') as f:
+                    User.objects.filter(pk=user.pk).update(avatar_checksum=file_checksum(f))
+                updated += 1
+            else:
+                # Served as the default avatar from now on
+                User.objects.filter(pk=user.pk).update(profile_picture='', avatar_checksum='')
+                missing += 1
+
+        stale = User.objects.exclude(avatar_checksum='')
+        if not options['all']:
+            stale = stale.exclude(avatar_thumbnails_checksum=F('avatar_checksum'))
+        thumbnails = 0
+        for user_id, checksum in stale.values_list('pk', 'avatar_checksum').iterator():
+            build_thumbnails(user_id, checksum)
+            thumbnails += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Recorded {updated} avatar checksums (cleared {missing} pictures missing from storage); "
+            f"built thumbnails for {thumbnails} users."))
@@ -0,0 +1,45 @@
+import csv
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from comms.ingest import DEFAULT_BATCH_SIZE, FORMATS, import_messages, open_records
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk-load message history from JSONL or CSV, keeping the original timestamps, "
+        "then rebuild the unread counters of the imported chats. See comms.ingest for the record fields."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Input file, or - for stdin.")
+        parser.add_argument('--format', choices=FORMATS, dest='fmt',
+                            help="Input format; taken from the file extension by default.")
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--no-copy', action='store_true',
+                            help="Use bulk_create instead of COPY on Postgres.")
+
+    def handle(self, *args, path, fmt=None, batch_size=DEFAULT_BATCH_SIZE, no_copy=False, **options):
+        try:
+            stream, records = open_records(path, fmt)
+        except OSError as e:
+            raise CommandError(e)
+
+        def progress(stats):
+            if options['verbosity'] > 1:
+                self.stdout.write(f"{stats.rows} messages, {stats.rows_per_second:,.0f} rows/s")
+
+        with stream:
+            try:
+                stats = import_messages(records, batch_size=batch_size, use_copy=False if no_copy else None,
+                                        progress=progress)
+            except (json.JSONDecodeError, csv.Error) as e:
+                raise CommandError(f"Malformed input: {e}")
+
+        for reason, count in sorted(stats.skipped.items()):
+            self.stdout.write(self.style.WARNING(f"Skipped {count} records: {reason}."))
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {stats.rows} messages ({stats.chats_created} new chats) in {stats.seconds:.1f}s, "
+            f"{stats.rows_per_second:,.0f} rows/s."
+        ))
@@ -0,0 +1,38 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from comms.cold_archive import ARCHIVE_AFTER_DAYS, archive_messages
+from comms.partitions import MONTHS_AHEAD, ensure_partitions, is_partitioned
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the monthly message partitions for the coming months and, with --archive, "
+        "move old read messages into the compressed cold archive. Run it daily."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=MONTHS_AHEAD,
+                            help="Months after the current one to have partitions for.")
+        parser.add_argument('--archive', action='store_true',
+                            help="Archive messages older than MESSAGE_ARCHIVE_AFTER_DAYS.")
+        parser.add_argument('--archive-after-days', type=int, default=ARCHIVE_AFTER_DAYS,
+                            help="Override MESSAGE_ARCHIVE_AFTER_DAYS for this run.")
+
+    def handle(self, *args, months_ahead=MONTHS_AHEAD, archive=False, archive_after_days=None, **options):
+        if is_partitioned():
+            created = ensure_partitions(months_ahead=months_ahead)
+            if created:
+                self.stdout.write(self.style.SUCCESS(f"Created partitions: {', '.join(created)}."))
+            else:
+                self.stdout.write("Partitions are in place.")
+        else:
+            self.stdout.write("The message table is not partitioned; skipping partitions.")
+
+        if archive:
+            if archive_after_days is None:
+                raise CommandError("Set MESSAGE_ARCHIVE_AFTER_DAYS or pass --archive-after-days.")
+            total = archive_messages(before=timezone.now() - timedelta(days=archive_after_days))
+            self.stdout.write(self.style.SUCCESS(f"Archived {total} messages."))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from comms.membership import rebuild_memberships
+
+
+class Command(BaseCommand):
+    help = "Rebuild per-user unread counters and last-message pointers from Message."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chat', type=int, action='append', dest='chat_ids',
+                            help="Only rebuild this chat id (may be repeated).")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, chat_ids=None, batch_size=1000, **options):
+        total = rebuild_memberships(chat_ids=chat_ids, batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {total} chat memberships."))
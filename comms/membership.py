@@ -0,0 +1,298 @@
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Case, Count, Exists, F, Max, OuterRef, PositiveIntegerField, Q, Subquery, Value, When
+from django.db.models.functions import Greatest
+
+from .chat_list import invalidate_chat_lists
+from .groups import (
+    READ, apply_receipt, group_chat_ids, join_state, rebuild_group_chats, record_group_messages, unread_count_expression,
+)
+from .models import Chat, ChatMembership, Message
+
+
+def _counts_as_unread(chat_id, sender_id):
+    """
+    Condition on ChatMembership rows of `chat_id`: does a message from `sender_id`
+    count towards that member's unread badge? Messages from others always do; in a
+    self chat (no other participants) the user's own messages count too.
+    """
+    other_participants = Chat.participants.through.objects.filter(chat_id=chat_id).exclude(user_id=sender_id)
+    return ~Q(user_id=sender_id) | ~Exists(other_participants)
+
+
+def ensure_memberships(chat, user_ids=None):
+    """Create the missing ChatMembership rows of the chat's participants, or of `user_ids` only."""
+    if user_ids is None:
+        user_ids = chat.participants.values_list('id', flat=True)
+    state = join_state(chat) if chat.is_group else {}
+    ChatMembership.objects.bulk_create(
+        [ChatMembership(user_id=user_id, chat=chat, **state) for user_id in user_ids],
+        ignore_conflicts=True,
+    )
+
+
+def _unread_count_query(user, chat):
+    return ChatMembership.objects.filter(user=user, chat=chat) \
+        .annotate(unread=unread_count_expression()).values_list('unread', flat=True)
+
+
+def get_unread_count(user, chat):
+    return _unread_count_query(user, chat).first() or 0
+
+
+async def aget_unread_count(user, chat):
+    return await _unread_count_query(user, chat).afirst() or 0
+
+
+def record_message(message, is_group=None):
+    """
+    Bump unread counters and the last-message pointer for every member of the
+    message's chat in a single UPDATE. Returns {user_id: unread_count} for the
+    chat's members, or {} for a group chat (see comms.groups). Pass `is_group`
+    if known, to save looking it up.
+    """
+    group_ids = None if is_group is None else {message.chat_id} if is_group else set()
+    return record_messages([message], group_ids)[message.chat_id]
+
+
+def record_messages(messages, group_ids=None):
+    """
+    record_message for a batch of new messages: one UPDATE per chat however
+    many of its messages are in the batch, each member's counter growing by
+    the messages that count as unread for them. The newest message of each
+    chat becomes its last message. Returns {chat_id: {user_id: unread_count}};
+    group chats count messages without writing their members' rows, and
+    map to {}. `group_ids` are the group chats among the messages' chats, if
+    the caller knows them.
+    """
+    by_chat = defaultdict(list)
+    for message in messages:
+        by_chat[message.chat_id].append(message)
+
+    if group_ids is None:
+        group_ids = group_chat_ids(list(by_chat)) if by_chat else set()
+
+    unread_counts = {}
+    for chat_id, chat_messages in by_chat.items():
+        if chat_id in group_ids:
+            record_group_messages(chat_id, chat_messages)
+            unread_counts[chat_id] = {}
+            continue
+        total = len(chat_messages)
+        members = ChatMembership.objects.filter(chat_id=chat_id)
+        members.update(
+            unread_count=F('unread_count') + Case(
+                # A sender's own messages only count in a self chat
+                *[
+                    When(~_counts_as_unread(chat_id, sender_id) & Q(user_id=sender_id), then=Value(total - n))
+                    for sender_id, n in Counter(m.sender_id for m in chat_messages).items()
+                ],
+                default=Value(total),
+                output_field=PositiveIntegerField(),
+            ),
+            last_message=max(chat_messages, key=lambda m: (m.timestamp, m.id)),
+        )
+        unread_counts[chat_id] = dict(members.values_list('user_id', 'unread_count'))
+    invalidate_chat_lists(user_id for counts in unread_counts.values() for user_id in counts)
+    return unread_counts
+
+
+def mark_message_read(message, reader=None):
+    """
+    Flip `message.read` and decrement the affected unread counters, only if the
+    message was not already read. Advances `reader`'s read pointer; in a group
+    chat that is all it does (see comms.groups).
+    """
+    if reader is not None and message.chat.is_group:
+        moved, _ = apply_receipt(message.chat_id, reader, READ, message.pk)
+        return moved
+
+    with transaction.atomic():
+        flipped = Message.objects.filter(pk=message.pk, read=False).update(read=True)
+        if flipped:
+            message.read = True
+            ChatMembership.objects.filter(
+                _counts_as_unread(message.chat_id, message.sender_id),
+                chat_id=message.chat_id,
+                unread_count__gt=0,
+            ).update(unread_count=F('unread_count') - 1)
+            invalidate_chat_lists(
+                ChatMembership.objects.filter(chat_id=message.chat_id).values_list('user_id', flat=True)
+            )
+
+        if reader is not None:
+            ChatMembership.objects.filter(chat_id=message.chat_id, user=reader).filter(
+                Q(last_read_message__isnull=True) | Q(last_read_message_id__lt=message.pk)
+            ).update(last_read_message=message)
+
+    return flipped
+
+
+def _received_messages(chat_id, reader, message_ids=None, up_to=None):
+    """
+    Messages of `chat_id` that `reader` can acknowledge: the listed ids, or every
+    id up to and including the `up_to` watermark. Receipts only apply to messages
+    the reader received, except in a self chat where they cover everything.
+    """
+    messages = Message.objects.filter(chat_id=chat_id)
+    if up_to is not None:
+        messages = messages.filter(id__lte=up_to)
+    else:
+        messages = messages.filter(id__in=message_ids)
+    others = Chat.participants.through.objects.filter(chat_id=chat_id).exclude(user_id=reader.id)
+    return messages.filter(~Q(sender=reader) | ~Exists(others))
+
+
+def mark_messages_delivered(chat_id, reader, message_ids=None, up_to=None):
+    """
+    Bulk-apply delivered receipts from `reader`. Returns the ids that changed.
+    """
+    with transaction.atomic():
+        pending = _received_messages(chat_id, reader, message_ids, up_to).filter(delivered=False)
+        flipped = list(pending.select_for_update().values_list('id', flat=True))
+        if flipped:
+            Message.objects.filter(id__in=flipped).update(delivered=True)
+    return flipped
+
+
+def mark_messages_read(chat_id, reader, message_ids=None, up_to=None):
+    """
+    Bulk-apply read receipts from `reader` with one UPDATE on Message and one on
+    ChatMembership, however many messages are acknowledged. Returns the ids that
+    changed.
+    """
+    with transaction.atomic():
+        pending = _received_messages(chat_id, reader, message_ids, up_to).filter(read=False)
+        flipped = list(pending.select_for_update().values_list('id', 'sender_id'))
+        if not flipped:
+            return []
+
+        flipped_ids = [message_id for message_id, _ in flipped]
+        # A read message has necessarily been delivered
+        Message.objects.filter(id__in=flipped_ids).update(read=True, delivered=True)
+
+        # Each member loses the flipped messages they did not send themselves
+        # (all of them in a self chat, where the reader is the only member).
+        total = len(flipped)
+        members = ChatMembership.objects.filter(chat_id=chat_id)
+        if members.exclude(user=reader).exists():
+            decrement = Case(
+                *[When(user_id=sender_id, then=Value(total - n)) for sender_id, n in Counter(s for _, s in flipped).items()],
+                default=Value(total),
+            )
+        else:
+            decrement = Value(total)
+        members.update(unread_count=Greatest(F('unread_count') - decrement, Value(0)))
+        invalidate_chat_lists(members.values_list('user_id', flat=True))
+
+        members.filter(user=reader).filter(
+            Q(last_read_message__isnull=True) | Q(last_read_message_id__lt=max(flipped_ids))
+        ).update(last_read_message_id=max(flipped_ids))
+
+    return flipped_ids
+
+
+def mark_chat_unread(chat_id):
+    """
+    Flip every read message of a one-to-one chat back to unread, adding them
+    to the counters of the members they count for, with one UPDATE on Message
+    and one on ChatMembership. Returns the ids that changed.
+    """
+    with transaction.atomic():
+        flipped = list(
+            Message.objects.filter(chat_id=chat_id, read=True).select_for_update().values_list('id', 'sender_id')
+        )
+        if not flipped:
+            return []
+
+        flipped_ids = [message_id for message_id, _ in flipped]
+        Message.objects.filter(id__in=flipped_ids).update(read=False)
+
+        total = len(flipped)
+        members = ChatMembership.objects.filter(chat_id=chat_id)
+        members.update(
+            unread_count=F('unread_count') + Case(
+                *[
+                    When(~_counts_as_unread(chat_id, sender_id) & Q(user_id=sender_id), then=Value(total - n))
+                    for sender_id, n in Counter(s for _, s in flipped).items()
+                ],
+                default=Value(total),
+                output_field=PositiveIntegerField(),
+            ),
+            # Nothing of the chat is read any more
+            last_read_message=None,
+        )
+        invalidate_chat_lists(members.values_list('user_id', flat=True))
+
+    return flipped_ids
+
+
+def rebuild_memberships(chat_ids=None, batch_size=1000):
+    """
+    Recompute ChatMembership rows from Chat.participants and Message.
+    Limit to `chat_ids` when given; otherwise rebuild every chat.
+    Returns the number of memberships rebuilt.
+    """
+    pairs = Chat.participants.through.objects.all()
+    memberships = ChatMembership.objects.all()
+    messages = Message.objects.order_by()
+    if chat_ids is not None:
+        pairs = pairs.filter(chat_id__in=chat_ids)
+        memberships = memberships.filter(chat_id__in=chat_ids)
+        messages = messages.filter(chat_id__in=chat_ids)
+
+    members = defaultdict(set)
+    for chat_id, user_id in pairs.values_list('chat_id', 'user_id').iterator(chunk_size=batch_size):
+        members[chat_id].add(user_id)
+
+    # Per (chat, sender) aggregates; each member sums over the senders that count for them
+    unread = defaultdict(dict)
+    for chat_id, sender_id, n in messages.filter(read=False).values_list('chat_id', 'sender_id').annotate(n=Count('id')):
+        unread[chat_id][sender_id] = n
+    last_read = defaultdict(dict)
+    for chat_id, sender_id, last_id in messages.filter(read=True).values_list('chat_id', 'sender_id').annotate(m=Max('id')):
+        last_read[chat_id][sender_id] = last_id
+
+    def counted(per_sender, chat_id, user_id):
+        self_chat = members[chat_id] == {user_id}
+        return [v for sender_id, v in per_sender[chat_id].items() if self_chat or sender_id != user_id]
+
+    with transaction.atomic():
+        stale = [
+            pk for pk, chat_id, user_id in memberships.values_list('pk', 'chat_id', 'user_id')
+            if user_id not in members.get(chat_id, ())
+        ]
+        ChatMembership.objects.filter(pk__in=stale).delete()
+
+        ChatMembership.objects.bulk_create(
+            [ChatMembership(chat_id=chat_id, user_id=user_id) for chat_id, users in members.items() for user_id in users],
+            ignore_conflicts=True,
+            batch_size=batch_size,
+        )
+
+        memberships.update(last_message=Subquery(
+            Message.objects.filter(chat=OuterRef('chat_id')).order_by('-timestamp', '-id').values('id')[:1]
+        ))
+
+        # Group chats keep their members' read pointers: per-message flags
+        # there only say what everyone has read
+        groups = group_chat_ids(list(members))
+        batch = []
+        total = 0
+        for membership in memberships.exclude(chat_id__in=groups).only('pk', 'chat_id', 'user_id').iterator(chunk_size=batch_size):
+            membership.unread_count = sum(counted(unread, membership.chat_id, membership.user_id))
+            membership.last_read_message_id = max(counted(last_read, membership.chat_id, membership.user_id), default=None)
+            batch.append(membership)
+            if len(batch) >= batch_size:
+                ChatMembership.objects.bulk_update(batch, ['unread_count', 'last_read_message'])
+                total += len(batch)
+                batch = []
+        ChatMembership.objects.bulk_update(batch, ['unread_count', 'last_read_message'])
+        total += len(batch)
+        rebuild_group_chats(groups)
+        total += ChatMembership.objects.filter(chat_id__in=groups).count()
+
+        invalidate_chat_lists(user_id for users in members.values() for user_id in users)
+
+    return total
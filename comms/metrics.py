@@ -0,0 +1,283 @@
+"""
+Request metrics in Prometheus text format.
+
+MetricsMiddleware records, for every HTTP request, the duration, the number
+and total time of database queries and the response size, labelled with the
+URL name. WebSocket frames are recorded by `ws_frame`, labelled with the
+frame type, together with the number of database_sync_to_async hops they
+took. Requests that run more queries than their budget
+(settings.METRICS_QUERY_BUDGETS) are logged as warnings.
+
+Queries are attributed through a context variable and an execute wrapper
+installed on every new database connection, so queries an async view runs
+in sync_to_async threads count towards the request as well.
+
+Metrics live in process memory: each worker serves its own on /metrics.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+HOP_BUCKETS = (0, 1, 2, 3, 5, 8, 13)
+
+# Request methods are client-controlled: anything else is counted as 'other'
+# so a client cannot create label sets at will
+HTTP_METHODS = frozenset({'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'})
+
+QUERY_BUDGETS = getattr(settings, 'METRICS_QUERY_BUDGETS', {})
+DEFAULT_QUERY_BUDGET = getattr(settings, 'METRICS_DEFAULT_QUERY_BUDGET', None)
+
+
+class Histogram:
+    """A Prometheus histogram with one label set per distinct label tuple."""
+
+    def __init__(self, name, documentation, labelnames, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            return sum(series[0]) if series else 0
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        for labels, counts, total in series:
+            label_text = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, labels))
+            bucket_prefix = f'{label_text},' if label_text else ''
+            label_text = f'{{{label_text}}}' if label_text else ''
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{bucket_prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{label_text} {total}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return '\n'.join(lines)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Counter:
+    """A Prometheus counter with one value per distinct label tuple."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            label_text = ','.join(f'{name}="{_escape(v)}"' for name, v in zip(self.labelnames, labels))
+            lines.append(f'{self.name}{{{label_text}}} {value}' if label_text else f'{self.name} {value}')
+        return '\n'.join(lines)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Gauge(Counter):
+    """A Prometheus gauge; `inc` with a negative amount to decrease it."""
+
+    kind = 'gauge'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+HTTP_DURATION = Histogram(
+    'messenger_http_request_duration_seconds', 'HTTP request duration.', ('view', 'method'), DURATION_BUCKETS)
+HTTP_QUERIES = Histogram(
+    'messenger_http_db_queries', 'Database queries per HTTP request.', ('view',), QUERY_COUNT_BUCKETS)
+HTTP_QUERY_DURATION = Histogram(
+    'messenger_http_db_query_duration_seconds', 'Database time per HTTP request.', ('view',), DURATION_BUCKETS)
+HTTP_RESPONSE_SIZE = Histogram(
+    'messenger_http_response_size_bytes', 'HTTP response body size.', ('view',), SIZE_BUCKETS)
+WS_DURATION = Histogram(
+    'messenger_ws_frame_duration_seconds', 'Time to handle a WebSocket frame.', ('type',), DURATION_BUCKETS)
+WS_QUERIES = Histogram(
+    'messenger_ws_db_queries', 'Database queries per WebSocket frame.', ('type',), QUERY_COUNT_BUCKETS)
+WS_QUERY_DURATION = Histogram(
+    'messenger_ws_db_query_duration_seconds', 'Database time per WebSocket frame.', ('type',), DURATION_BUCKETS)
+WS_SYNC_HOPS = Histogram(
+    'messenger_ws_sync_hops', 'database_sync_to_async calls per WebSocket frame.', ('type',), HOP_BUCKETS)
+
+WS_THROTTLED = Counter(
+    'messenger_ws_frames_throttled_total', 'WebSocket frames refused by a rate or size limit, or malformed.',
+    ('limit',))
+WS_DROPPED = Counter(
+    'messenger_ws_events_dropped_total', 'Outbound WebSocket frames dropped or coalesced for slow clients.',
+    ('type', 'reason'))
+WS_REFUSED = Counter(
+    'messenger_ws_connections_refused_total', 'WebSocket connections refused or closed under load.', ('reason',))
+WS_CONNECTIONS = Gauge('messenger_ws_connections', 'Open WebSocket connections.', ())
+DB_TASKS = Gauge('messenger_db_tasks_running', 'database_sync_to_async calls holding a slot.', ())
+DB_SLOT_WAIT = Histogram(
+    'messenger_db_slot_wait_seconds', 'Time spent waiting for a database task slot.', (), DURATION_BUCKETS)
+
+REGISTRY = (
+    HTTP_DURATION, HTTP_QUERIES, HTTP_QUERY_DURATION, HTTP_RESPONSE_SIZE,
+    WS_DURATION, WS_QUERIES, WS_QUERY_DURATION, WS_SYNC_HOPS,
+    WS_THROTTLED, WS_DROPPED, WS_REFUSED, WS_CONNECTIONS, DB_TASKS, DB_SLOT_WAIT,
+)
+
+
+def render():
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+class Stats:
+    __slots__ = ('queries', 'query_time', 'hops')
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        self.hops = 0
+
+
+_current = ContextVar('comms_metrics_stats', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Execute wrapper: attribute the query to the request or frame being handled."""
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.query_time += time.perf_counter() - start
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """connection_created handler."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def check_budget(key, queries):
+    budget = QUERY_BUDGETS.get(key, DEFAULT_QUERY_BUDGET)
+    if budget is not None and queries > budget:
+        logger.warning("%s ran %d queries (budget %d)", key, queries, budget)
+
+
+class database_sync_to_async(DatabaseSyncToAsync):
+    """channels.db.database_sync_to_async that counts its calls towards ws_frame."""
+
+    async def __call__(self, *args, **kwargs):
+        stats = _current.get()
+        if stats is not None:
+            stats.hops += 1
+        return await super().__call__(*args, **kwargs)
+
+
+@asynccontextmanager
+async def ws_frame(frame_type):
+    """Record the handling of one WebSocket frame of `frame_type`."""
+    stats = Stats()
+    token = _current.set(stats)
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+        frame_type = frame_type or 'unknown'
+        WS_DURATION.observe(time.perf_counter() - start, frame_type)
+        WS_QUERIES.observe(stats.queries, frame_type)
+        WS_QUERY_DURATION.observe(stats.query_time, frame_type)
+        WS_SYNC_HOPS.observe(stats.hops, frame_type)
+        check_budget(f'ws:{frame_type}', stats.queries)
+
+
+class MetricsMiddleware:
+    """Record duration, queries and response size of every HTTP request."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = Stats()
+        token = _current.set(stats)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.record(request, response, stats, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        stats = Stats()
+        token = _current.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.record(request, response, stats, time.perf_counter() - start)
+        return response
+
+    def record(self, request, response, stats, duration):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unmatched'
+        method = request.method if request.method in HTTP_METHODS else 'other'
+        HTTP_DURATION.observe(duration, view, method)
+        HTTP_QUERIES.observe(stats.queries, view)
+        HTTP_QUERY_DURATION.observe(stats.query_time, view)
+        if not response.streaming:
+            HTTP_RESPONSE_SIZE.observe(len(response.content), view)
+        check_budget(view, stats.queries)
@@ -0,0 +1,73 @@
+from collections import defaultdict
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_memberships(apps, schema_editor):
+    """
+    Create the memberships of existing chats with their counters, as
+    comms.membership.rebuild_memberships would, so chat lists show them.
+    """
+    Chat = apps.get_model('comms', 'Chat')
+    ChatMembership = apps.get_model('comms', 'ChatMembership')
+    Message = apps.get_model('comms', 'Message')
+
+    members = defaultdict(set)
+    for chat_id, user_id in Chat.participants.through.objects.values_list('chat_id', 'user_id').iterator(chunk_size=1000):
+        members[chat_id].add(user_id)
+
+    # Per (chat, sender) aggregates; each member sums over the senders that count for them
+    messages = Message.objects.order_by()
+    unread = defaultdict(dict)
+    for chat_id, sender_id, n in messages.filter(read=False).values_list('chat_id', 'sender_id').annotate(n=models.Count('id')):
+        unread[chat_id][sender_id] = n
+    last_read = defaultdict(dict)
+    for chat_id, sender_id, last_id in messages.filter(read=True).values_list('chat_id', 'sender_id').annotate(m=models.Max('id')):
+        last_read[chat_id][sender_id] = last_id
+
+    def counted(per_sender, chat_id, user_id):
+        self_chat = members[chat_id] == {user_id}
+        return [v for sender_id, v in per_sender[chat_id].items() if self_chat or sender_id != user_id]
+
+    ChatMembership.objects.bulk_create(
+        [
+            ChatMembership(
+                chat_id=chat_id, user_id=user_id,
+                unread_count=sum(counted(unread, chat_id, user_id)),
+                last_read_message_id=max(counted(last_read, chat_id, user_id), default=None),
+            )
+            for chat_id, users in members.items() for user_id in users
+        ],
+        batch_size=1000,
+    )
+    ChatMembership.objects.update(last_message=models.Subquery(
+        Message.objects.filter(chat=models.OuterRef('chat_id')).order_by('-timestamp', '-id').values('id')[:1]
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMembership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='comms.chat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to=settings.AUTH_USER_MODEL)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='comms.message')),
+                ('last_read_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='comms.message')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='chatmembership',
+            unique_together={('user', 'chat')},
+        ),
+        migrations.RunPython(backfill_memberships, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms', '0004_user_avatar_checksum'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='avatar_thumbnails_checksum',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+    ]
@@ -0,0 +1,54 @@
+from collections import defaultdict
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_pair_keys(apps, schema_editor):
+    """
+    Set the pair key on existing one-to-one chats, so that lookups by pair
+    find them. Where several chats share a pair, the oldest gets the key.
+    """
+    Chat = apps.get_model('comms', 'Chat')
+    participants = defaultdict(set)
+    links = Chat.participants.through.objects.filter(chat__is_group=False)
+    for chat_id, user_id in links.values_list('chat_id', 'user_id').order_by('chat_id').iterator(chunk_size=1000):
+        participants[chat_id].add(user_id)
+
+    taken = set()
+    updates = []
+    for chat_id, user_ids in sorted(participants.items()):
+        if len(user_ids) > 2:
+            continue
+        key = (min(user_ids), max(user_ids))
+        if key in taken:
+            continue
+        taken.add(key)
+        updates.append(Chat(id=chat_id, pair_low_id=key[0], pair_high_id=key[1]))
+    Chat.objects.bulk_update(updates, ['pair_low', 'pair_high'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms', '0005_user_avatar_thumbnails_checksum'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='pair_high',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='pair_low',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='chat',
+            constraint=models.UniqueConstraint(fields=('pair_low', 'pair_high'), name='chat_direct_pair_uniq'),
+        ),
+        migrations.RunPython(backfill_pair_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms', '0006_chat_pair_keys'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('read', False)), fields=['chat', 'sender'], name='message_unread_idx'),
+        ),
+    ]
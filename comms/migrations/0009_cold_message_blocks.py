@@ -0,0 +1,42 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms', '0008_message_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatmembership',
+            name='last_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='comms.message'),
+        ),
+        migrations.AlterField(
+            model_name='chatmembership',
+            name='last_read_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='comms.message'),
+        ),
+        migrations.CreateModel(
+            name='ColdMessageBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_timestamp', models.DateTimeField()),
+                ('first_message_id', models.BigIntegerField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('last_message_id', models.BigIntegerField()),
+                ('min_message_id', models.BigIntegerField()),
+                ('max_message_id', models.BigIntegerField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('payload', models.BinaryField()),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cold_blocks', to='comms.chat')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['chat', 'last_timestamp', 'last_message_id'], name='coldblock_chat_last_idx'), models.Index(fields=['chat', 'first_timestamp', 'first_message_id'], name='coldblock_chat_first_idx')],
+            },
+        ),
+    ]
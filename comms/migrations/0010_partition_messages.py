@@ -0,0 +1,125 @@
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import migrations
+from django.utils import timezone
+
+# A frozen copy of the partitioning SQL as it stood when this migration was
+# written; comms.partitions keeps the live partition helpers.
+MESSAGE_TABLE = 'comms_message'
+DEFAULT_PARTITION = f'{MESSAGE_TABLE}_default'
+SEQUENCE = f'{MESSAGE_TABLE}_id_seq'
+MONTHS_AHEAD = 3
+
+
+def month_start(value):
+    value = value.astimezone(dt_timezone.utc)
+    return datetime(value.year, value.month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def create_partition(cursor, qn, month):
+    name, table = qn(f'{MESSAGE_TABLE}_p{month:%Y_%m}'), qn(MESSAGE_TABLE)
+    start, end = month, add_months(month, 1)
+    cursor.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    cursor.execute(
+        f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    )
+
+
+def rebuild_message_table(schema_editor, partitioned):
+    """
+    Recreate the message table, partitioned by month or as a plain table,
+    copying its rows, indexes and foreign keys. Nothing may hold a foreign key
+    to the table while this runs.
+
+    Before Postgres 17 a partitioned table cannot have an identity column, so
+    the new table's id comes from a sequence it owns (the layout of a serial
+    column) in both directions. Ids are assigned by comms.ids from 0014 on,
+    which drops the sequence.
+    """
+    conn = schema_editor.connection
+    qn = conn.ops.quote_name
+    table = qn(MESSAGE_TABLE)
+    old = qn(f'{MESSAGE_TABLE}_old')
+
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT i.relname, pg_get_indexdef(i.oid) FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid "
+            "WHERE x.indrelid = to_regclass(%s) AND NOT x.indisprimary",
+            [MESSAGE_TABLE],
+        )
+        indexes = cursor.fetchall()
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = to_regclass(%s) AND contype = 'f'",
+            [MESSAGE_TABLE],
+        )
+        foreign_keys = cursor.fetchall()
+
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {old}")
+        for name, _ in indexes:
+            cursor.execute(f"DROP INDEX {qn(name)}")
+        # An identity column's sequence goes with its table; a serial one is
+        # kept apart from the old table, so that dropping it leaves the sequence
+        cursor.execute(f"ALTER TABLE {old} ALTER COLUMN id DROP IDENTITY IF EXISTS")
+        cursor.execute(f"ALTER SEQUENCE IF EXISTS {qn(SEQUENCE)} OWNED BY NONE")
+        cursor.execute(f"ALTER TABLE {old} ALTER COLUMN id DROP DEFAULT")
+
+        if partitioned:
+            cursor.execute(
+                f'CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS, '
+                f'PRIMARY KEY (id, "timestamp")) PARTITION BY RANGE ("timestamp")'
+            )
+            cursor.execute(f"CREATE TABLE {qn(DEFAULT_PARTITION)} PARTITION OF {table} DEFAULT")
+            cursor.execute(f'SELECT MIN("timestamp") FROM {old}')
+            oldest = cursor.fetchone()[0]
+            current = month_start(timezone.now())
+            month = month_start(oldest) if oldest and oldest < current else current
+            while month <= add_months(current, MONTHS_AHEAD):
+                create_partition(cursor, qn, month)
+                month = add_months(month, 1)
+        else:
+            cursor.execute(f"CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS, PRIMARY KEY (id))")
+
+        cursor.execute(f"INSERT INTO {table} SELECT * FROM {old}")
+        cursor.execute(f"DROP TABLE {old}")
+
+        cursor.execute(f"CREATE SEQUENCE IF NOT EXISTS {qn(SEQUENCE)}")
+        cursor.execute(f"ALTER SEQUENCE {qn(SEQUENCE)} OWNED BY {table}.id")
+        cursor.execute(f"SELECT setval(%s, (SELECT COALESCE(MAX(id), 0) + 1 FROM {table}), false)", [SEQUENCE])
+        cursor.execute(f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval('{SEQUENCE}'::regclass)")
+
+        for name, definition in foreign_keys:
+            cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {qn(name)} {definition}")
+        for _, definition in indexes:
+            cursor.execute(definition)
+
+
+def partition_messages(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        rebuild_message_table(schema_editor, partitioned=True)
+
+
+def unpartition_messages(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        rebuild_message_table(schema_editor, partitioned=False)
+
+
+class Migration(migrations.Migration):
+    """
+    Range-partition comms_message by month on Postgres (see comms.partitions).
+    Rows are copied into the new table, which holds an exclusive lock for as
+    long as that takes; schedule it accordingly on a large table.
+    """
+
+    dependencies = [
+        ('comms', '0009_cold_message_blocks'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_messages, unpartition_messages),
+    ]
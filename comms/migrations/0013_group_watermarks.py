@@ -0,0 +1,75 @@
+# Generated by Django 5.2.4 on 2026-10-18 19:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_group_chats(apps, schema_editor):
+    # Group chats used to keep receipts per message: start the members'
+    # watermarks at their read pointers (see comms.groups)
+    Chat = apps.get_model('comms', 'Chat')
+    ChatMembership = apps.get_model('comms', 'ChatMembership')
+    Message = apps.get_model('comms', 'Message')
+    for chat in Chat.objects.filter(is_group=True).iterator():
+        messages = Message.objects.filter(chat_id=chat.pk)
+        watermarks = []
+        for membership in ChatMembership.objects.filter(chat_id=chat.pk):
+            read_up_to = membership.last_read_message_id
+            membership.last_delivered_message_id = read_up_to
+            membership.read_count = messages.filter(id__lte=read_up_to).count() if read_up_to else 0
+            membership.unread_count = 0
+            membership.save(update_fields=['last_delivered_message', 'read_count', 'unread_count'])
+            watermarks.append(read_up_to or 0)
+        chat.message_count = messages.count()
+        chat.last_message = messages.order_by('-timestamp', '-id').first()
+        chat.read_watermark = chat.delivered_watermark = min(watermarks, default=0)
+        chat.save(update_fields=['message_count', 'last_message', 'read_watermark', 'delivered_watermark'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms', '0012_user_last_seen'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='delivered_watermark',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='comms.message'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='message_count',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='read_watermark',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatmembership',
+            name='last_delivered_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='comms.message'),
+        ),
+        migrations.AddField(
+            model_name='chatmembership',
+            name='read_count',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='chatmembership',
+            index=models.Index(fields=['chat', 'last_read_message'], name='membership_chat_read_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmembership',
+            index=models.Index(fields=['chat', 'last_delivered_message'], name='membership_chat_delivered_idx'),
+        ),
+        migrations.RunPython(backfill_group_chats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.4 on 2026-10-18 19:35
+
+import comms.ids
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms', '0013_group_watermarks'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='id',
+            field=models.BigIntegerField(default=comms.ids.next_message_id, editable=False, primary_key=True, serialize=False),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2026-10-18 19:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms', '0014_message_snowflake_ids'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('client_msg_id__isnull', False)), fields=['sender', 'client_msg_id'], name='message_client_msg_idx'),
+        ),
+    ]
@@ -0,0 +1,121 @@
+import logging
+
+from django.db import migrations
+
+logger = logging.getLogger(__name__)
+
+# Full-text indexes for message search (see comms.search). They used to be
+# created after every migrate, so each statement tolerates finding them there.
+#
+# On SQLite the triggers belong to comms_message: a later migration that
+# rebuilds that table (most AlterField/RemoveField do) drops them, and has to
+# create them again.
+
+
+class RunSQLIf(migrations.RunSQL):
+    """
+    RunSQL for one database vendor, both ways. With a `condition`, it is also
+    skipped, with the `skipped` warning, where condition(connection) fails.
+    """
+
+    def __init__(self, vendor, sql, reverse_sql, condition=None, skipped=None, **kwargs):
+        self.vendor = vendor
+        self.condition = condition
+        self.skipped = skipped
+        super().__init__(sql, reverse_sql, **kwargs)
+
+    def _applies(self, schema_editor):
+        connection = schema_editor.connection
+        if connection.vendor != self.vendor:
+            return False
+        if self.condition is not None and not self.condition(connection):
+            logger.warning(self.skipped)
+            return False
+        return True
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if self._applies(schema_editor):
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if self._applies(schema_editor):
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+def has_fts5(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA compile_options")
+        return ('ENABLE_FTS5',) in cursor.fetchall()
+
+
+def can_create_trigram_extension(connection):
+    # pg_trgm is a trusted extension: CREATE on the database is enough
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') "
+            "OR has_database_privilege(current_database(), 'CREATE')"
+        )
+        return cursor.fetchone()[0]
+
+
+SQLITE_FTS = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS comms_message_fts USING fts5("
+    "text, content='comms_message', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS comms_message_fts_ai AFTER INSERT ON comms_message BEGIN "
+    "INSERT INTO comms_message_fts(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS comms_message_fts_ad AFTER DELETE ON comms_message BEGIN "
+    "INSERT INTO comms_message_fts(comms_message_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS comms_message_fts_au AFTER UPDATE OF text ON comms_message BEGIN "
+    "INSERT INTO comms_message_fts(comms_message_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+    "INSERT INTO comms_message_fts(rowid, text) VALUES (new.id, new.text); END",
+    # Index the messages written before
+    "INSERT INTO comms_message_fts(comms_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_FTS_REVERSE = [
+    "DROP TRIGGER IF EXISTS comms_message_fts_au",
+    "DROP TRIGGER IF EXISTS comms_message_fts_ad",
+    "DROP TRIGGER IF EXISTS comms_message_fts_ai",
+    "DROP TABLE IF EXISTS comms_message_fts",
+]
+
+# The expression has to match comms.search._search_postgres for the index to be used
+POSTGRES_FTS = (
+    "CREATE INDEX IF NOT EXISTS comms_message_text_fts_idx ON comms_message "
+    "USING gin (to_tsvector('simple'::regconfig, COALESCE(text, ''::text)))"
+)
+
+POSTGRES_FTS_REVERSE = "DROP INDEX IF EXISTS comms_message_text_fts_idx"
+
+# Trigram indexes make the name/phone icontains lookups of user search
+# (UPPER(col) LIKE UPPER(%q%) on Postgres) index scans
+POSTGRES_TRIGRAMS = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS comms_user_name_trgm_idx ON comms_user USING gin ((UPPER(name::text)) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS comms_user_phone_trgm_idx ON comms_user USING gin ((UPPER(phone::text)) gin_trgm_ops)",
+]
+
+POSTGRES_TRIGRAMS_REVERSE = [
+    "DROP INDEX IF EXISTS comms_user_phone_trgm_idx",
+    "DROP INDEX IF EXISTS comms_user_name_trgm_idx",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comms', '0015_message_client_msg_index'),
+    ]
+
+    operations = [
+        RunSQLIf(
+            'sqlite', SQLITE_FTS, SQLITE_FTS_REVERSE,
+            condition=has_fts5, skipped="SQLite FTS5 unavailable, message search falls back to LIKE",
+        ),
+        RunSQLIf('postgresql', POSTGRES_FTS, POSTGRES_FTS_REVERSE),
+        RunSQLIf(
+            'postgresql', POSTGRES_TRIGRAMS, POSTGRES_TRIGRAMS_REVERSE,
+            condition=can_create_trigram_extension,
+            skipped="No CREATE privilege for pg_trgm; skipping trigram indexes for user search",
+        ),
+    ]
@@ -1,13 +1,22 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.utils import timezone
+
+from .ids import next_message_id
 
 
 class User(AbstractUser):
     phone = models.CharField(max_length=15, unique=True)
     profile_picture = models.ImageField(upload_to='profile_pics/', blank=True, null=True)
+    # Content hash of profile_picture, set when it is saved; empty for pictures uploaded before it was recorded
+    avatar_checksum = models.CharField(max_length=40, blank=True, default='')
+    # avatar_checksum of the upload the thumbnails on disk were built from
+    avatar_thumbnails_checksum = models.CharField(max_length=40, blank=True, default='')
     about = models.CharField(max_length=255, blank=True, default="Hey there! I am using Messenger.")
     name = models.CharField(max_length=100, blank=True, null=True)
     favourite_chats = models.ManyToManyField('Chat', related_name='favourited_by', blank=True)
+    # Written in batches by comms.presence; the cache there is fresher
+    last_seen = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.username} ({self.phone})"
@@ -18,6 +27,26 @@ class Chat(models.Model):
     is_group = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # Canonical key of a one-to-one chat: the participants' ids, lowest first.
+    # Both point at the same user for a self chat; null for group chats.
+    pair_low = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    pair_high = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+
+    # Group chats only (see comms.groups): messages stored, the newest of them,
+    # and the message ids every member has had delivered and has read up to.
+    # One-to-one chats keep these per member in ChatMembership instead.
+    message_count = models.PositiveBigIntegerField(default=0)
+    last_message = models.ForeignKey(
+        'Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+', db_constraint=False
+    )
+    delivered_watermark = models.BigIntegerField(default=0)
+    read_watermark = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['pair_low', 'pair_high'], name='chat_direct_pair_uniq'),
+        ]
+
     def __str__(self):
         if self.is_group:
             return f"Group Chat {self.id}"
@@ -26,16 +55,39 @@ class Chat(models.Model):
 
 
 class Message(models.Model):
+    # Snowflake ids from comms.ids; the table's own sequence is not used
+    id = models.BigIntegerField(primary_key=True, default=next_message_id, editable=False)
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     text = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # A default rather than auto_now_add, so imported history keeps its send times
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
 
     delivered = models.BooleanField(default=False)
     read = models.BooleanField(default=False)
 
+    # Id the sending client chose for the message, to recognise its retries
+    client_msg_id = models.CharField(max_length=64, null=True, blank=True)
+
+    # On Postgres the table is range-partitioned by month on timestamp (see
+    # comms.partitions), with (id, timestamp) as its primary key: any unique
+    # constraint added here has to include timestamp, and no foreign key can
+    # point at a message.
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Keyset pagination of chat history (see comms.history), and the newest
+            # message per chat (a backward scan of the same index)
+            models.Index(fields=['chat', 'timestamp', 'id'], name='message_chat_ts_id_idx'),
+            # Unread messages of a chat by sender: receipts, unread counts excluding
+            # the reader's own messages. Partial, so it only holds the unread tail.
+            models.Index(fields=['chat', 'sender'], condition=models.Q(read=False), name='message_unread_idx'),
+            # Resends found by their client id (see comms.write_behind)
+            models.Index(
+                fields=['sender', 'client_msg_id'], condition=models.Q(client_msg_id__isnull=False),
+                name='message_client_msg_idx',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.sender.username}: {self.text[:30]} ({self.timestamp.strftime('%Y-%m-%d %H:%M')})"
@@ -50,3 +102,67 @@ class ArchivedChat(models.Model):
 
     def __str__(self):
         return f"{self.user.username} archived Chat {self.chat.id}"
+
+
+class ChatMembership(models.Model):
+    """
+    Per-(user, chat) counters kept in step with Message writes so that chat lists
+    and unread badges never have to aggregate over the messages table.
+    Rebuild with `manage.py rebuild_chat_memberships`.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='memberships')
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='memberships')
+    unread_count = models.PositiveIntegerField(default=0)
+    # No database constraint: Message is partitioned on Postgres, so its id alone
+    # is not a unique key a foreign key could reference
+    last_read_message = models.ForeignKey(
+        Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+', db_constraint=False
+    )
+    last_message = models.ForeignKey(
+        Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+', db_constraint=False
+    )
+    # Group chats only (see comms.groups): the member's delivered watermark, and
+    # Chat.message_count as of their read watermark. unread_count stays at zero.
+    last_delivered_message = models.ForeignKey(
+        Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+', db_constraint=False
+    )
+    read_count = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'chat')
+        indexes = [
+            # The lowest watermarks of a group chat, and the members still below one
+            models.Index(fields=['chat', 'last_read_message'], name='membership_chat_read_idx'),
+            models.Index(fields=['chat', 'last_delivered_message'], name='membership_chat_delivered_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} in Chat {self.chat_id} ({self.unread_count} unread)"
+
+
+class ColdMessageBlock(models.Model):
+    """
+    Cold storage for old messages, written by comms.cold_archive: up to
+    MESSAGE_ARCHIVE_BLOCK_SIZE consecutive messages of one chat as
+    zlib-compressed JSON. History and exports read these transparently.
+    """
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='cold_blocks')
+    # (timestamp, id) of the oldest and newest message in the block
+    first_timestamp = models.DateTimeField()
+    first_message_id = models.BigIntegerField()
+    last_timestamp = models.DateTimeField()
+    last_message_id = models.BigIntegerField()
+    # Id range, to find the block holding a given message
+    min_message_id = models.BigIntegerField()
+    max_message_id = models.BigIntegerField()
+    message_count = models.PositiveIntegerField()
+    payload = models.BinaryField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'last_timestamp', 'last_message_id'], name='coldblock_chat_last_idx'),
+            models.Index(fields=['chat', 'first_timestamp', 'first_message_id'], name='coldblock_chat_first_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.message_count} archived messages of Chat {self.chat_id}"
@@ -0,0 +1,100 @@
+"""
+Chat participants as the WebSocket consumers see them.
+
+Member ids are cached in the shared cache per chat, so fanning out a message
+or receipt does not query the database. Whenever Chat.participants changes,
+`participants_changed` drops the cached ids once the transaction commits and
+sends a `chat_members_changed` event with the new member ids to the chat's
+group and to the user group of everyone added, removed or still a member,
+so open sockets update (or close) without reconnecting. ChatMembership rows
+are added and removed with the participants, as the watermarks of group
+chats (see comms.groups) are taken over every row of the chat.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .chat_list import invalidate_group_memberships
+from .membership import ensure_memberships
+from .models import Chat, ChatMembership
+
+MEMBERS_CACHE_TIMEOUT = getattr(settings, 'CHAT_MEMBERS_CACHE_TIMEOUT', 3600)
+
+Participant = Chat.participants.through
+
+
+def _members_key(chat_id):
+    return f'chat:members:{chat_id}'
+
+
+def load_chat_members(chat_id):
+    """(chat, member ids) in one query, or (None, set()) for a chat without participants."""
+    links = list(Participant.objects.filter(chat_id=chat_id).select_related('chat'))
+    if not links:
+        return None, set()
+    member_ids = {link.user_id for link in links}
+    cache.set(_members_key(chat_id), member_ids, MEMBERS_CACHE_TIMEOUT)
+    return links[0].chat, member_ids
+
+
+async def aget_member_ids(chat_id):
+    member_ids = await cache.aget(_members_key(chat_id))
+    if member_ids is None:
+        links = Participant.objects.filter(chat_id=chat_id).values_list('user_id', flat=True)
+        member_ids = {user_id async for user_id in links}
+        if member_ids:
+            await cache.aset(_members_key(chat_id), member_ids, MEMBERS_CACHE_TIMEOUT)
+    return member_ids
+
+
+def _broadcast(chat_id, affected_ids):
+    cache.delete(_members_key(chat_id))
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    from .consumers import chat_group, user_group  # consumers import this module
+
+    member_ids = sorted(Participant.objects.filter(chat_id=chat_id).values_list('user_id', flat=True))
+    event = {
+        'type': 'chat_members_changed',
+        'chat_id': chat_id,
+        'member_ids': member_ids,
+        'is_group': Chat.objects.filter(pk=chat_id, is_group=True).exists(),
+    }
+    async_to_sync(channel_layer.group_send)(chat_group(chat_id), event)
+    for user_id in set(affected_ids) | set(member_ids):
+        async_to_sync(channel_layer.group_send)(user_group(user_id), event)
+
+
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """m2m_changed receiver for Chat.participants."""
+    if action == 'pre_clear':
+        # The cleared ids are gone by post_clear
+        if reverse:
+            instance._cleared_chat_ids = set(Participant.objects.filter(user_id=instance.pk).values_list('chat_id', flat=True))
+        else:
+            instance._cleared_user_ids = set(Participant.objects.filter(chat_id=instance.pk).values_list('user_id', flat=True))
+        return
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_cleared_chat_ids' if reverse else '_cleared_user_ids', set())
+    elif action not in ('post_add', 'post_remove'):
+        return
+    if not pk_set:
+        return
+
+    if reverse:
+        # user.chats.add(...): one user, several chats
+        changes = [(chat_id, {instance.pk}) for chat_id in pk_set]
+        chats = Chat.objects.in_bulk(pk_set) if action == 'post_add' else {}
+    else:
+        changes = [(instance.pk, set(pk_set))]
+        chats = {instance.pk: instance}
+    invalidate_group_memberships({user_id for _, user_ids in changes for user_id in user_ids})
+    for chat_id, user_ids in changes:
+        if action == 'post_add':
+            ensure_memberships(chats[chat_id], user_ids)
+        else:
+            ChatMembership.objects.filter(chat_id=chat_id, user_id__in=user_ids).delete()
+        transaction.on_commit(lambda chat_id=chat_id, user_ids=user_ids: _broadcast(chat_id, user_ids))
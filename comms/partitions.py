@@ -0,0 +1,111 @@
+"""
+Monthly range partitions of the message table (Postgres only).
+
+Migration 0010 turns comms_message into a table partitioned by RANGE
+("timestamp"), with one partition per calendar month (UTC) named
+comms_message_pYYYY_MM and a default partition that catches anything outside
+them. Queries on recent messages then only touch the last few partitions and
+their indexes, and old months can be detached and moved to the cold archive
+(comms.cold_archive) or dropped without a bulk DELETE.
+
+`ensure_partitions` creates the partitions for the coming months; run it
+regularly through `manage.py maintain_message_storage`. The default partition
+should stay (almost) empty: it only holds messages that arrive for a month
+with no partition yet, and those kept hot when their month is archived.
+"""
+import re
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+MESSAGE_TABLE = 'comms_message'
+DEFAULT_PARTITION = f'{MESSAGE_TABLE}_default'
+MONTHS_AHEAD = getattr(settings, 'MESSAGE_PARTITION_MONTHS_AHEAD', 3)
+
+PARTITION_RE = re.compile(rf'^{MESSAGE_TABLE}_p(\d{{4}})_(\d{{2}})$')
+
+
+def month_start(value):
+    if timezone.is_aware(value):
+        value = value.astimezone(dt_timezone.utc)
+    return datetime(value.year, value.month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def partition_name(month):
+    return f'{MESSAGE_TABLE}_p{month:%Y_%m}'
+
+
+def is_partitioned(conn=connection):
+    if conn.vendor != 'postgresql':
+        return False
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))",
+            [MESSAGE_TABLE],
+        )
+        return cursor.fetchone()[0]
+
+
+def monthly_partitions(conn=connection):
+    """[(month, partition name)] of the attached monthly partitions, oldest first."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = to_regclass(%s)",
+            [MESSAGE_TABLE],
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    partitions = []
+    for name in names:
+        match = PARTITION_RE.match(name)
+        if match:
+            partitions.append((datetime(int(match[1]), int(match[2]), 1, tzinfo=dt_timezone.utc), name))
+    return sorted(partitions)
+
+
+def create_partition(cursor, month):
+    """
+    Create and attach the partition for `month`. Rows already in the default
+    partition for that month are moved into it first, since ATTACH refuses a
+    range the default partition has rows for.
+    """
+    qn = cursor.db.ops.quote_name
+    name, table, default = qn(partition_name(month)), qn(MESSAGE_TABLE), qn(DEFAULT_PARTITION)
+    start, end = month, add_months(month, 1)
+    cursor.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    cursor.execute(
+        f'WITH moved AS (DELETE FROM {default} WHERE "timestamp" >= %s AND "timestamp" < %s RETURNING *) '
+        f'INSERT INTO {name} SELECT * FROM moved',
+        [start, end],
+    )
+    cursor.execute(
+        f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    )
+
+
+def ensure_partitions(months_ahead=MONTHS_AHEAD, now=None):
+    """
+    Make sure the current month and the next `months_ahead` have partitions.
+    Returns the names of the partitions created.
+    """
+    current = month_start(now or timezone.now())
+    return create_missing_partitions(add_months(current, n) for n in range(months_ahead + 1))
+
+
+def create_missing_partitions(months):
+    """Create the partitions of `months` (month starts) that do not exist yet; returns their names."""
+    existing = {month for month, _ in monthly_partitions()}
+    created = []
+    for month in sorted(set(months) - existing):
+        with transaction.atomic(), connection.cursor() as cursor:
+            create_partition(cursor, month)
+        created.append(partition_name(month))
+    return created
+
@@ -0,0 +1,221 @@
+"""
+Online, last-seen and typing state.
+
+Presence lives in the shared cache (Redis when REDIS_URL is set, else a
+per-process memory cache), never in the database on the hot path:
+
+  presence:online:<user>   set while the user has a socket open; expires
+                           PRESENCE_TTL seconds after the last heartbeat, so a
+                           worker that dies without disconnecting cannot keep
+                           anyone online for long
+  presence:sockets:<user>  number of open sockets, so closing one of several
+                           tabs does not take the user offline
+  presence:seen:<user>     when the user was last seen, for LAST_SEEN_CACHE_TTL
+
+Clients send a heartbeat frame every PRESENCE_HEARTBEAT_INTERVAL seconds.
+`User.last_seen` is only written by a per-process buffer that flushes every
+LAST_SEEN_FLUSH_INTERVAL seconds, with one UPDATE for every user seen since
+the last flush. Chat lists overlay the cached state on the rows they serve.
+
+Typing frames are relayed to a chat at most once per TYPING_THROTTLE seconds
+per user, however fast they arrive; clients show the indicator for a little
+longer than that.
+"""
+import asyncio
+import logging
+import time
+import zlib
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, DateTimeField, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from .flow_control import database_sync_to_async
+from .models import Chat, ChatMembership, User
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_TTL = getattr(settings, 'PRESENCE_TTL', 60)
+PRESENCE_HEARTBEAT_INTERVAL = getattr(settings, 'PRESENCE_HEARTBEAT_INTERVAL', 25)
+LAST_SEEN_FLUSH_INTERVAL = getattr(settings, 'LAST_SEEN_FLUSH_INTERVAL', 30)
+LAST_SEEN_CACHE_TTL = 86400
+TYPING_THROTTLE = getattr(settings, 'TYPING_THROTTLE', 3)
+
+
+def _online_key(user_id):
+    return f'presence:online:{user_id}'
+
+
+def _sockets_key(user_id):
+    return f'presence:sockets:{user_id}'
+
+
+def _seen_key(user_id):
+    return f'presence:seen:{user_id}'
+
+
+class LastSeenBuffer:
+    """
+    Latest last-seen time of each user since the last flush, written by a
+    background task on the event loop with one UPDATE per flush.
+    """
+
+    def __init__(self, interval=LAST_SEEN_FLUSH_INTERVAL):
+        self.interval = interval
+        self._pending = {}
+        self._loop = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def record(self, user_id, seen):
+        self._pending[user_id] = max(seen, self._pending.get(user_id, seen))
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while self._pending:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            await database_sync_to_async(write_last_seen)(pending)
+        except Exception:
+            logger.exception("Writing last_seen of %d users failed; will retry", len(pending))
+            for user_id, seen in pending.items():
+                self._pending[user_id] = max(seen, self._pending.get(user_id, seen))
+
+
+def write_last_seen(last_seen):
+    """Store {user_id: datetime} in User.last_seen, never moving a value back."""
+    if not last_seen:
+        return
+    User.objects.filter(id__in=last_seen).update(
+        last_seen=Case(
+            *[
+                When(id=user_id, then=Greatest(Coalesce('last_seen', Value(seen)), Value(seen)))
+                for user_id, seen in last_seen.items()
+            ],
+            output_field=DateTimeField(),
+        )
+    )
+
+
+last_seen_buffer = LastSeenBuffer()
+
+
+def _now():
+    return datetime.now(dt_timezone.utc)
+
+
+async def connected(user_id):
+    """Count a new socket of the user. Returns True if this brought them online."""
+    await cache.aadd(_sockets_key(user_id), 0, PRESENCE_TTL)
+    try:
+        await cache.aincr(_sockets_key(user_id))
+    except ValueError:
+        # Expired between the two calls
+        await cache.aset(_sockets_key(user_id), 1, PRESENCE_TTL)
+    return await cache.aadd(_online_key(user_id), time.time(), PRESENCE_TTL)
+
+
+async def heartbeat(user_id):
+    """Keep the user online for another PRESENCE_TTL seconds."""
+    if not await cache.atouch(_online_key(user_id), PRESENCE_TTL):
+        await cache.aset(_online_key(user_id), time.time(), PRESENCE_TTL)
+    await cache.atouch(_sockets_key(user_id), PRESENCE_TTL)
+    last_seen_buffer.record(user_id, _now())
+
+
+async def disconnected(user_id):
+    """
+    Forget one socket of the user. Returns their last-seen time if that was
+    their last socket, else None.
+    """
+    try:
+        remaining = await cache.adecr(_sockets_key(user_id))
+    except ValueError:
+        remaining = 0
+    if remaining > 0:
+        return None
+    seen = _now()
+    await cache.adelete_many([_online_key(user_id), _sockets_key(user_id)])
+    await cache.aset(_seen_key(user_id), seen, LAST_SEEN_CACHE_TTL)
+    last_seen_buffer.record(user_id, seen)
+    return seen
+
+
+async def typing_allowed(user_id, chat_id):
+    """True at most once per TYPING_THROTTLE seconds for a user in a chat."""
+    return await cache.aadd(f'typing:{chat_id}:{user_id}', 1, TYPING_THROTTLE)
+
+
+def _presence(user_ids, values):
+    presence = {}
+    for user_id in user_ids:
+        seen = values.get(_seen_key(user_id))
+        presence[user_id] = {
+            'online': _online_key(user_id) in values,
+            'last_seen': seen,
+        }
+    return presence
+
+
+def _keys(user_ids):
+    return [key for user_id in user_ids for key in (_online_key(user_id), _seen_key(user_id))]
+
+
+def get_presence(user_ids):
+    """{user_id: {'online', 'last_seen'}} from the cache, in one round trip."""
+    user_ids = set(user_ids)
+    return _presence(user_ids, cache.get_many(_keys(user_ids)))
+
+
+async def aget_presence(user_ids):
+    user_ids = set(user_ids)
+    return _presence(user_ids, await cache.aget_many(_keys(user_ids)))
+
+
+def _overlay(chats, presence):
+    rows = []
+    for chat in chats:
+        state = presence[chat['user_id']]
+        # The row's value is as old as the cached list; the cache may know better
+        last_seen = chat['last_seen']
+        if state['last_seen'] and (last_seen is None or state['last_seen'] > datetime.fromisoformat(last_seen)):
+            last_seen = state['last_seen'].isoformat()
+        rows.append({**chat, 'online': state['online'], 'last_seen': last_seen})
+    return rows
+
+
+def with_presence(chats):
+    """Chat-list rows (see comms.chat_list) with the other user's `online` and `last_seen`."""
+    return _overlay(chats, get_presence(chat['user_id'] for chat in chats))
+
+
+async def awith_presence(chats):
+    return _overlay(chats, await aget_presence(chat['user_id'] for chat in chats))
+
+
+def presence_stamp(chats):
+    """Short digest of the presence in chat-list rows, for their ETag."""
+    state = sorted((chat['user_id'], chat['online'], chat['last_seen'] or '') for chat in chats)
+    return f'{zlib.crc32(repr(state).encode()):08x}'
+
+
+def get_contact_ids(user_id):
+    """Ids of everyone who shares a chat with the user, themselves excluded."""
+    chat_ids = Chat.participants.through.objects.filter(user_id=user_id).values('chat_id')
+    return set(
+        ChatMembership.objects.filter(chat_id__in=chat_ids).exclude(user_id=user_id)
+        .values_list('user_id', flat=True).distinct()
+    )
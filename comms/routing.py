@@ -4,6 +4,7 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<chat_id>\d+)/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/chats/$', consumers.UserConsumer.as_asgi()),
 ]
 
 # CHANGE THIS LINE:
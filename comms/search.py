@@ -0,0 +1,156 @@
+"""
+Full-text search over message text.
+
+Postgres uses a GIN index on to_tsvector('simple', text) plus trigram indexes
+for user name/phone lookups; SQLite (tests, local dev) uses an FTS5 table kept
+in sync by triggers. Both indexes are maintained by the database on every
+insert/update, so saving a Message is all it takes to make it searchable.
+The indexes are created by migration 0016.
+"""
+import html
+import re
+
+from django.conf import settings
+from django.db import connection, connections
+
+from .models import Chat, Message
+
+DEFAULT_PAGE_SIZE = getattr(settings, 'SEARCH_PAGE_SIZE', 20)
+MAX_PAGE_SIZE = getattr(settings, 'SEARCH_MAX_PAGE_SIZE', 50)
+SNIPPET_WORDS = 12
+MAX_TERMS = 8
+
+# Control characters used as highlight markers so the snippet can be HTML-escaped
+# before the markers are turned into <mark> tags.
+MARK_START = '\x02'
+MARK_STOP = '\x03'
+
+FTS_TABLE = f'{Message._meta.db_table}_fts'
+
+
+def search_terms(query):
+    return re.findall(r'\w+', query.lower())[:MAX_TERMS]
+
+
+def clamp_page_size(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def render_snippet(raw):
+    return html.escape(raw).replace(MARK_START, '<mark>').replace(MARK_STOP, '</mark>')
+
+
+def search_messages(user, query, page=1, limit=DEFAULT_PAGE_SIZE):
+    """
+    Ranked full-text search over messages in the chats `user` belongs to.
+
+    Returns (messages, has_more). Each message carries `search_rank` (higher is
+    better) and `search_snippet`, an HTML-safe excerpt with matches in <mark>.
+    Terms are prefix-matched and ANDed so results narrow as the user types.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return [], False
+
+    offset = (max(page, 1) - 1) * limit
+    if connection.vendor == 'postgresql':
+        hits = _search_postgres(user, terms, offset, limit + 1)
+    elif connection.vendor == 'sqlite' and _fts_table_exists():
+        hits = _search_sqlite(user, terms, offset, limit + 1)
+    else:
+        hits = _search_fallback(user, terms, offset, limit + 1)
+
+    for message in hits:
+        message.search_snippet = render_snippet(message.search_snippet)
+    return hits[:limit], len(hits) > limit
+
+
+def _user_messages(user):
+    return Message.objects.filter(chat__in=Chat.objects.filter(participants=user).values('id')).select_related('chat')
+
+
+def _search_postgres(user, terms, offset, limit):
+    from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVector
+
+    # Must match the expression of the GIN index (migration 0016) for it to be used
+    vector = SearchVector('text', config='simple')
+    tsquery = SearchQuery(' & '.join(f'{term}:*' for term in terms), config='simple', search_type='raw')
+
+    hits = _user_messages(user) \
+        .annotate(search=vector) \
+        .filter(search=tsquery) \
+        .annotate(
+            search_rank=SearchRank(vector, tsquery),
+            search_snippet=SearchHeadline(
+                'text', tsquery, config='simple',
+                start_sel=MARK_START, stop_sel=MARK_STOP,
+                max_words=SNIPPET_WORDS, min_words=SNIPPET_WORDS // 2,
+            ),
+        ) \
+        .order_by('-search_rank', '-timestamp', '-id')
+    return list(hits[offset:offset + limit])
+
+
+def _fts_match_expression(terms):
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def _search_sqlite(user, terms, offset, limit):
+    message_table = Message._meta.db_table
+    participants_table = Chat.participants.through._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT {FTS_TABLE}.rowid, -bm25({FTS_TABLE}),
+                   snippet({FTS_TABLE}, 0, %s, %s, '…', %s)
+            FROM {FTS_TABLE}
+            JOIN {message_table} m ON m.id = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH %s
+              AND m.chat_id IN (SELECT chat_id FROM {participants_table} WHERE user_id = %s)
+            ORDER BY bm25({FTS_TABLE}), m.timestamp DESC, m.id DESC
+            LIMIT %s OFFSET %s
+            """,
+            [MARK_START, MARK_STOP, SNIPPET_WORDS, _fts_match_expression(terms), user.id, limit, offset],
+        )
+        rows = cursor.fetchall()
+
+    messages = Message.objects.select_related('chat').in_bulk([row[0] for row in rows])
+    hits = []
+    for message_id, rank, snippet in rows:
+        message = messages[message_id]
+        message.search_rank = rank
+        message.search_snippet = snippet
+        hits.append(message)
+    return hits
+
+
+def _highlight(text, terms, width=60):
+    pattern = re.compile('|'.join(r'\b' + re.escape(term) for term in terms), re.IGNORECASE)
+    first = pattern.search(text)
+    start = max(first.start() - width // 2, 0) if first else 0
+    excerpt = text[start:start + width * 2]
+    excerpt = pattern.sub(lambda m: f'{MARK_START}{m.group(0)}{MARK_STOP}', excerpt)
+    return ('…' if start else '') + excerpt + ('…' if start + width * 2 < len(text) else '')
+
+
+def _search_fallback(user, terms, offset, limit):
+    # No full-text index available: every term must appear somewhere, newest first
+    hits = _user_messages(user)
+    for term in terms:
+        hits = hits.filter(text__icontains=term)
+    hits = list(hits.order_by('-timestamp', '-id')[offset:offset + limit])
+    for message in hits:
+        message.search_rank = 0
+        message.search_snippet = _highlight(message.text, terms)
+    return hits
+
+
+def _fts_table_exists(using='default'):
+    with connections[using].cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+        return cursor.fetchone() is not None
+
@@ -18,4 +18,4 @@ class MessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        fields = ['id', 'text', 'timestamp', 'sender_username', 'delivered', 'read']
+        fields = ['id', 'text', 'timestamp', 'sender_username', 'delivered', 'read', 'client_msg_id']
@@ -42,9 +42,8 @@ function createObserverForPhone(phone) {
             if (entry.isIntersecting) {
                 const messageId = entry.target.dataset.messageId;
                 if (messageId && !readMessageIds.has(messageId)) {
-                    console.log('Marking message as read:', messageId);
                     readMessageIds.add(messageId);
-                    markMessageRead(messageId, phone); // ✅ Now has phone
+                    queueReadReceipt(messageId, phone);
                 }
             }
         });
@@ -54,6 +53,69 @@ function createObserverForPhone(phone) {
     });
 }
 
+// Read receipts are collected while messages scroll into view and sent as
+// one WebSocket frame per flush instead of one request per message.
+const pendingReadIds = new Set();
+let readFlushTimer = null;
+let readFlushPhone = null;
+let readFlushChatId = null;
+
+function queueReadReceipt(messageId, phone) {
+    pendingReadIds.add(Number(messageId));
+    readFlushPhone = phone;
+    readFlushChatId = historyState.chatId;
+    if (!readFlushTimer) readFlushTimer = setTimeout(flushReadReceipts, 300);
+}
+
+function flushReadReceipts() {
+    clearTimeout(readFlushTimer);
+    readFlushTimer = null;
+    const ids = [...pendingReadIds];
+    pendingReadIds.clear();
+    if (!ids.length) return;
+
+    if (window.chatSocket && window.chatSocket.readyState === WebSocket.OPEN) {
+        window.chatSocket.send(JSON.stringify({
+            type: 'read',
+            chat_id: readFlushChatId,
+            message_ids: ids
+        }));
+    } else {
+        // No live socket: fall back to the per-message HTTP endpoint
+        ids.forEach(id => markMessageRead(id, readFlushPhone));
+    }
+}
+
+function tickHtml(status) {
+    if (status === 'read') {
+        return '<i class="fas fa-check-double" style="color: #53bdeb;"></i>'; // blue double tick
+    } else if (status === 'delivered') {
+        return '<i class="fas fa-check-double" style="color: gray;"></i>'; // grey double tick
+    }
+    return '<i class="fas fa-check" style="color: gray;"></i>'; // single grey tick
+}
+
+function messageStatus(msg) {
+    return msg.read ? 'read' : msg.delivered ? 'delivered' : 'sent';
+}
+
+// Apply a compact receipt event ({status, reader, message_ids | up_to}) to the open chat
+function applyReceiptStatus(event) {
+    // Our own receipts come back as `unread` frames for the badge instead
+    if (event.reader === window.currentUser) return;
+
+    const ids = event.message_ids ? new Set(event.message_ids) : null;
+    bottomDiv.querySelectorAll('.chat-bubble.sent').forEach(bubble => {
+        const id = Number(bubble.dataset.messageId);
+        if (ids ? !ids.has(id) : id > event.up_to) return;
+        if (bubble.dataset.status === 'read') return; // never downgrade blue ticks
+
+        bubble.dataset.status = event.status;
+        const tick = bubble.querySelector('.chat-times i');
+        if (tick) tick.outerHTML = tickHtml(event.status);
+    });
+}
+
 
 document.querySelector('.theform').addEventListener('submit', e => {
     e.preventDefault();
@@ -521,8 +583,299 @@ async function refreshUnreadBadge(phone) {
 }
 
 
+// Paging state for the open chat's history (older pages load on scroll-up)
+const historyState = {
+    chatId: null,
+    phone: null,
+    oldestId: null,
+    newestReceivedId: null,
+    hasMore: false,
+    loading: false,
+};
+
+function buildHistoryBubble(msg, isFirstInGroup, phone) {
+    const isSent = msg.sender_username === window.currentUser;
+    const bubble = document.createElement('div');
+    bubble.classList.add('chat-bubble', isSent ? 'sent' : 'received');
+    if (isFirstInGroup) bubble.classList.add('first');
+
+    // Add tick icons for sent messages
+    const ticks = isSent ? tickHtml(messageStatus(msg)) : '';
+
+    bubble.innerHTML = `
+    <div class="chat-text">${msg.text}</div>
+    <div class="chat-times">
+      ${new Date(msg.timestamp).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' })}
+      ${ticks}
+    </div>
+  `;
+    bubble.dataset.messageId = msg.id;
+    bubble.dataset.sender = msg.sender_username;
+    bubble.dataset.status = messageStatus(msg);
+    if (isSent && msg.recipients !== undefined) {
+        // Group chats: ticks turn blue once everyone has read; the count says how far it got
+        bubble.title = `Read by ${msg.read_by} of ${msg.recipients}`;
+    }
+    // Only observe messages NOT sent by the current user (received messages)
+    if (!isSent) {
+        const observer = createObserverForPhone(phone);
+        observer.observe(bubble);
+    }
+    return bubble;
+}
+
+async function loadOlderMessages() {
+    if (!historyState.hasMore || historyState.loading || historyState.oldestId === null) return;
+    historyState.loading = true;
+    const chatId = historyState.chatId;
+
+    try {
+        const res = await fetch(`/api/chats/${chatId}/messages/?before_id=${historyState.oldestId}`);
+        if (!res.ok) throw new Error('Failed to load older messages');
+        const data = await res.json();
+        if (chatId !== historyState.chatId) return; // user switched chats meanwhile
+
+        const firstBubble = bottomDiv.firstElementChild;
+        const previousHeight = bottomDiv.scrollHeight;
+        const fragment = document.createDocumentFragment();
+
+        data.messages.forEach((msg, index) => {
+            const prevMsg = data.messages[index - 1];
+            const isFirstInGroup = !prevMsg || prevMsg.sender_username !== msg.sender_username;
+            fragment.appendChild(buildHistoryBubble(msg, isFirstInGroup, historyState.phone));
+        });
+
+        // The old first bubble may now continue the last loaded sender's group
+        const lastLoaded = data.messages[data.messages.length - 1];
+        if (firstBubble && lastLoaded && firstBubble.dataset.sender === lastLoaded.sender_username) {
+            firstBubble.classList.remove('first');
+        }
+
+        bottomDiv.insertBefore(fragment, firstBubble);
+        // Keep the viewport anchored on what the user was reading
+        bottomDiv.scrollTop += bottomDiv.scrollHeight - previousHeight;
+
+        if (data.messages.length) historyState.oldestId = data.messages[0].id;
+        historyState.hasMore = data.has_more;
+    } catch (err) {
+        console.error(err);
+    } finally {
+        historyState.loading = false;
+    }
+}
+
+bottomDiv.addEventListener('scroll', () => {
+    if (bottomDiv.scrollTop < 80) loadOlderMessages();
+});
+
+
+// A single multiplexed socket (ws/chats/) carries every chat: frames are tagged
+// with chat_id, so switching chats costs no handshake and the sidebar stays live.
+let socketRetries = 0;
+let heartbeatTimer = null;
+// Keep in step with PRESENCE_HEARTBEAT_INTERVAL and TYPING_THROTTLE (comms.presence)
+const HEARTBEAT_INTERVAL_MS = 25000;
+const TYPING_THROTTLE_MS = 3000;
+const TYPING_SHOWN_MS = 5000;
+
+function connectUserSocket() {
+    const wsProtocol = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
+    const socket = new WebSocket(wsProtocol + window.location.host + '/ws/chats/');
+    window.chatSocket = socket;
+
+    socket.onopen = () => {
+        console.log('WebSocket connected');
+        socketRetries = 0;
+        resendOutbox();
+        sendDeliveredWatermark();
+        clearInterval(heartbeatTimer);
+        heartbeatTimer = setInterval(() => {
+            if (socket.readyState === WebSocket.OPEN) socket.send(JSON.stringify({ type: 'heartbeat' }));
+        }, HEARTBEAT_INTERVAL_MS);
+    };
+    socket.onmessage = (e) => {
+        handleSocketFrame(JSON.parse(e.data));
+    };
+    socket.onclose = () => {
+        clearInterval(heartbeatTimer);
+        // Reconnect with capped exponential backoff
+        const delay = Math.min(1000 * 2 ** socketRetries, 30000);
+        socketRetries += 1;
+        console.log(`WebSocket closed, reconnecting in ${delay}ms`);
+        setTimeout(connectUserSocket, delay);
+    };
+    socket.onerror = (error) => {
+        console.error('WebSocket error:', error);
+    };
+}
+
+function sendDeliveredWatermark() {
+    if (historyState.chatId === null || historyState.newestReceivedId === null) return;
+    if (!window.chatSocket || window.chatSocket.readyState !== WebSocket.OPEN) return;
+    window.chatSocket.send(JSON.stringify({
+        type: 'delivered',
+        chat_id: historyState.chatId,
+        up_to: historyState.newestReceivedId
+    }));
+}
+
+function handleSocketFrame(frame) {
+    if (frame.type === 'message') {
+        updateChatRow(frame);
+    } else if (frame.type === 'unread') {
+        updateChatBadge(frame.chat_id, frame.unread_count);
+    } else if (frame.type === 'ack') {
+        outbox.delete(frame.client_msg_id);
+    } else if (frame.type === 'presence') {
+        updatePresence(frame);
+        return;
+    } else if (frame.type === 'error') {
+        console.error('WebSocket error frame:', frame);
+    }
+
+    if (frame.chat_id !== historyState.chatId) return;
+
+    if (frame.type === 'message') {
+        appendLiveMessage(frame, historyState.phone);
+    } else if (frame.type === 'status') {
+        applyReceiptStatus(frame);
+    } else if (frame.type === 'typing' && frame.username !== window.currentUser) {
+        showTyping();
+    }
+}
+
+// The other participant of the open chat: {id, online, last_seen}
+let chatPeer = null;
+let typingTimer = null;
+
+function renderPeerStatus() {
+    const status = document.getElementById('chat-top-status');
+    if (!status || !chatPeer) return;
+    if (typingTimer) {
+        status.textContent = 'typing…';
+    } else if (chatPeer.online) {
+        status.textContent = 'online';
+    } else if (chatPeer.last_seen) {
+        const seen = new Date(chatPeer.last_seen);
+        status.textContent = `last seen ${seen.toLocaleDateString()} ${seen.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' })}`;
+    } else {
+        status.textContent = '';
+    }
+}
+
+function showTyping() {
+    clearTimeout(typingTimer);
+    typingTimer = setTimeout(() => {
+        typingTimer = null;
+        renderPeerStatus();
+    }, TYPING_SHOWN_MS);
+    renderPeerStatus();
+}
+
+function updatePresence(frame) {
+    document.querySelectorAll(`.chat-item[data-user-id="${frame.user_id}"]`).forEach(row => {
+        row.classList.toggle('online', frame.online);
+    });
+    if (chatPeer && chatPeer.id === frame.user_id) {
+        chatPeer.online = frame.online;
+        chatPeer.last_seen = frame.last_seen || chatPeer.last_seen;
+        renderPeerStatus();
+    }
+}
+
+let lastTypingSent = 0;
+
+function sendTyping() {
+    if (historyState.chatId === null || Date.now() - lastTypingSent < TYPING_THROTTLE_MS) return;
+    if (!window.chatSocket || window.chatSocket.readyState !== WebSocket.OPEN) return;
+    lastTypingSent = Date.now();
+    window.chatSocket.send(JSON.stringify({ type: 'typing', chat_id: historyState.chatId }));
+}
+
+function sidebarRowsForChat(chatId) {
+    const rolls = document.querySelectorAll('#chatRoll, #chatRollUnread, #chatRollFavourites, #view-archive .chat-roll');
+    return [...rolls].flatMap(roll => [...roll.querySelectorAll(`.chat-item[data-chat-id="${chatId}"]`)]);
+}
+
+function updateChatBadge(chatId, unreadCount) {
+    sidebarRowsForChat(chatId).forEach(row => {
+        let badge = row.querySelector('.unread-badge');
+        if (unreadCount > 0) {
+            if (!badge) {
+                badge = document.createElement('div');
+                badge.className = 'unread-badge';
+                row.appendChild(badge);
+            }
+            badge.textContent = unreadCount;
+            badge.style.display = 'block';
+        } else if (badge) {
+            badge.style.display = 'none';
+        }
+    });
+}
+
+// Bring a chat's sidebar rows up to date with a new message and move them to the top
+function updateChatRow(frame) {
+    const rows = sidebarRowsForChat(frame.chat_id);
+    if (!rows.length) {
+        // A chat we have not listed yet (e.g. someone messaged us first)
+        loadChats();
+        return;
+    }
+
+    const time = new Date(frame.timestamp).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit', hourCycle: 'h23' });
+    rows.forEach(row => {
+        row.querySelector('.chat-preview').textContent = frame.message;
+        row.querySelector('.chat-time').textContent = time;
+        row.parentElement.prepend(row);
+    });
+    if (frame.unread_count !== undefined && frame.unread_count !== null) {
+        updateChatBadge(frame.chat_id, frame.unread_count);
+    } else if (frame.sender !== window.currentUser && frame.chat_id !== historyState.chatId) {
+        // Group chats send no per-member count; an `unread` frame corrects it whenever one comes
+        const badge = rows[0].querySelector('.unread-badge');
+        const current = badge && badge.style.display !== 'none' ? Number(badge.textContent) || 0 : 0;
+        updateChatBadge(frame.chat_id, current + 1);
+    }
+}
+
+function appendLiveMessage(messageData, phone) {
+    // A resent message is echoed again if its first echo was missed; show it once
+    if (messageData.message_id && bottomDiv.querySelector(`.chat-bubble[data-message-id="${messageData.message_id}"]`)) return;
+    const isSent = messageData.sender === window.currentUser;
+    const lastMsg = bottomDiv.lastElementChild;
+    const isFirstInGroup = !lastMsg || !lastMsg.classList.contains(isSent ? 'sent' : 'received');
+
+    const bubble = document.createElement('div');
+    bubble.classList.add('chat-bubble', isSent ? 'sent' : 'received');
+    if (isFirstInGroup) bubble.classList.add('first');
+
+    const ticks = isSent ? tickHtml(messageStatus(messageData)) : '';
+
+    bubble.innerHTML = `
+    <div class="chat-text">${messageData.message}</div>
+    <div class="chat-times">
+      ${new Date(messageData.timestamp).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' })}
+      ${ticks}
+    </div>
+  `;
+    bubble.dataset.messageId = messageData.message_id || '';
+    bubble.dataset.sender = messageData.sender;
+    bubble.dataset.status = messageStatus(messageData);
+    bottomDiv.appendChild(bubble);
+    if (!isSent) {
+        historyState.newestReceivedId = messageData.message_id;
+        createObserverForPhone(phone).observe(bubble);
+    }
+    bottomDiv.scrollTop = bottomDiv.scrollHeight;
+}
+
+connectUserSocket();
+
+
 async function startChatWithUser(phone) {
     console.log('startChatWithUser called with phone:', phone);
+    flushReadReceipts(); // receipts still queued belong to the previous chat
     try {
         console.log('Sending fetch POST /api/get_or_create_chat/ ...');
         const res = await fetch('/api/get_or_create_chat/', {
@@ -561,7 +914,10 @@ async function startChatWithUser(phone) {
 </button>
       ` : ''}
       <img src="${user.profile_pic}" id="${profilePicId}" style="cursor: pointer; width: 40px; height: 40px; border-radius: 50%; object-fit: cover;">
-      <div id="${profileNameId}" style="cursor: pointer; font-weight: 400; font-size:16px;">${user.username}</div>
+      <div>
+        <div id="${profileNameId}" style="cursor: pointer; font-weight: 400; font-size:16px;">${user.username}</div>
+        <div class="chat-top-status" id="chat-top-status"></div>
+      </div>
     </div>
     <div style="display: flex; align-items: center; gap: 10px; padding: 0px;">
       <button class="right-top-icons-two" style="cursor: pointer; font-size: 1.1rem;">
@@ -577,6 +933,10 @@ async function startChatWithUser(phone) {
     </div>
   </div>
 `;
+chatPeer = { id: user.id, online: user.online, last_seen: user.last_seen };
+clearTimeout(typingTimer);
+typingTimer = null;
+renderPeerStatus();
 const profilePanel = document.querySelector('.right-right');
 profilePanel.innerHTML = `
   <div class="view-chat-profile">
@@ -671,100 +1031,23 @@ document.getElementById('right-close-button')?.addEventListener('click', () => {
         bottomDiv.innerHTML = ''; // Clear previous chat
 
         data.messages.forEach((msg, index) => {
-            const isSent = msg.sender_username === window.currentUser;
             const prevMsg = data.messages[index - 1];
             const isFirstInGroup = !prevMsg || prevMsg.sender_username !== msg.sender_username;
-            const bubble = document.createElement('div');
-            bubble.classList.add('chat-bubble', isSent ? 'sent' : 'received');
-            if (isFirstInGroup) bubble.classList.add('first');
-
-            // Add tick icons for sent messages
-            let ticks = '';
-            if (isSent) {
-                if (msg.read) {
-                    ticks = '<i class="fas fa-check-double" style="color: #53bdeb;"></i>'; // blue double tick
-                } else if (msg.delivered) {
-                    ticks = '<i class="fas fa-check-double" style="color: gray;"></i>'; // grey double tick
-                } else {
-                    ticks = '<i class="fas fa-check" style="color: gray;"></i>'; // single grey tick
-                }
-            }
-
-            bubble.innerHTML = `
-    <div class="chat-text">${msg.text}</div>
-    <div class="chat-times">
-      ${new Date(msg.timestamp).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' })}
-      ${ticks}
-    </div>
-  `;
-            bubble.dataset.messageId = msg.id;
-            bottomDiv.appendChild(bubble);
-            // Only observe messages NOT sent by the current user (received messages)
-if (!isSent) {
-    const observer = createObserverForPhone(phone); // ✅ Create one for this phone
-    observer.observe(bubble);
-}
+            bottomDiv.appendChild(buildHistoryBubble(msg, isFirstInGroup, phone));
         });
 
-        bottomDiv.scrollTop = bottomDiv.scrollHeight;
-        // Setup WebSocket connection for this chat
-        console.log('Setting up WebSocket connection');
-        if (window.chatSocket) {
-            console.log('Closing old WebSocket connection');
-            window.chatSocket.close(); // Close old socket if any
-        }
-        const chatId = data.chat_id;
-        const wsProtocol = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
-        const wsUrl = wsProtocol + window.location.host + '/ws/chat/' + chatId + '/';
-        console.log('Connecting to WebSocket URL:', wsUrl);
-
-        window.chatSocket = new WebSocket(wsUrl);
-
-        window.chatSocket.onopen = () => {
-            console.log('WebSocket connected for chat', chatId);
-        };
-        window.chatSocket.onmessage = (e) => {
-            console.log('WebSocket message received:', e.data);
-            const messageData = JSON.parse(e.data);
-
-            const isSent = messageData.sender === window.currentUser;
-            const lastMsg = bottomDiv.lastElementChild;
-            const isFirstInGroup = !lastMsg || !lastMsg.classList.contains(isSent ? 'sent' : 'received');
-
-            const bubble = document.createElement('div');
-            bubble.classList.add('chat-bubble', isSent ? 'sent' : 'received');
-            if (isFirstInGroup) bubble.classList.add('first');
-
-            let ticks = '';
-            if (isSent) {
-                if (messageData.read) {
-                    ticks = '<i class="fas fa-check-double" style="color: #53bdeb;"></i>'; // blue ticks
-                } else if (messageData.delivered) {
-                    ticks = '<i class="fas fa-check-double" style="color: gray;"></i>'; // double grey ticks
-                } else {
-                    ticks = '<i class="fas fa-check" style="color: gray;"></i>'; // single grey tick
-                }
-            }
-
-            bubble.innerHTML = `
-    <div class="chat-text">${messageData.message}</div>
-    <div class="chat-times">
-      ${new Date(messageData.timestamp).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' })}
-      ${ticks}
-    </div>
-  `;
-            bubble.dataset.messageId = messageData.id || '';
-            bottomDiv.appendChild(bubble);
-            bottomDiv.scrollTop = bottomDiv.scrollHeight;
-        };
+        historyState.chatId = data.chat_id;
+        historyState.phone = phone;
+        historyState.oldestId = data.messages.length ? data.messages[0].id : null;
+        historyState.hasMore = data.has_more;
+        historyState.loading = false;
 
-        window.chatSocket.onclose = () => {
-            console.log('WebSocket closed');
-        };
+        // Everything loaded so far has reached this client
+        const received = data.messages.filter(msg => msg.sender_username !== window.currentUser);
+        historyState.newestReceivedId = received.length ? received[received.length - 1].id : null;
+        sendDeliveredWatermark();
 
-        window.chatSocket.onerror = (error) => {
-            console.error('WebSocket error:', error);
-        };
+        bottomDiv.scrollTop = bottomDiv.scrollHeight;
         await refreshUnreadBadge(phone);
 
     } catch (err) {
@@ -805,6 +1088,7 @@ function handleSend() {
 }
 
 chatInput.addEventListener('input', updateSendUI);
+chatInput.addEventListener('input', sendTyping);
 
 chatInput.addEventListener('keydown', (event) => {
     if (event.key === 'Enter' && !event.shiftKey) {
@@ -814,16 +1098,30 @@ chatInput.addEventListener('keydown', (event) => {
 });
 
 
+// Messages sent but not yet acknowledged as stored, by client_msg_id. The
+// server echoes them at once and acks them once written; anything left here
+// is sent again on reconnect, and the server drops the duplicates.
+const outbox = new Map();
+
 function sendMessage(message) {
-    if (!window.chatSocket || window.chatSocket.readyState !== WebSocket.OPEN) {
-        alert('WebSocket not connected. Please select a chat first.');
+    if (historyState.chatId === null) {
+        alert('Please select a chat first.');
         return;
     }
-    window.chatSocket.send(JSON.stringify({
-        type: 'message', // <-- add this
-        message: message
-    }));
-    console.log('Message sent via WebSocket:', message);
+    const frame = {
+        type: 'message',
+        chat_id: historyState.chatId,
+        message: message,
+        client_msg_id: crypto.randomUUID()
+    };
+    outbox.set(frame.client_msg_id, frame);
+    if (window.chatSocket && window.chatSocket.readyState === WebSocket.OPEN) {
+        window.chatSocket.send(JSON.stringify(frame));
+    }
+}
+
+function resendOutbox() {
+    outbox.forEach(frame => window.chatSocket.send(JSON.stringify(frame)));
 }
 
 
@@ -1244,6 +1542,9 @@ async function loadChats() {
             const chatItem = document.createElement("div");
             chatItem.className = "chat-item";
             chatItem.dataset.phone = chat.phone;
+            chatItem.dataset.chatId = chat.id;
+            chatItem.dataset.userId = chat.user_id;
+            chatItem.classList.toggle('online', chat.online);
 
             chatItem.innerHTML = `
         <img src="${chat.avatar}" alt="${chat.name}" class="chat-avatar">
@@ -1286,6 +1587,9 @@ async function loadFavorites() {
             const chatItem = document.createElement("div");
             chatItem.className = "chat-item";
             chatItem.dataset.phone = chat.phone;
+            chatItem.dataset.chatId = chat.id;
+            chatItem.dataset.userId = chat.user_id;
+            chatItem.classList.toggle('online', chat.online);
 
             chatItem.innerHTML = `
         <img src="${chat.avatar}" alt="${chat.name}" class="chat-avatar">
@@ -1327,6 +1631,9 @@ async function loadArchive() {
             const chatItem = document.createElement('div');
             chatItem.className = 'chat-item';
             chatItem.dataset.phone = chat.phone;
+            chatItem.dataset.chatId = chat.id;
+            chatItem.dataset.userId = chat.user_id;
+            chatItem.classList.toggle('online', chat.online);
 
 chatItem.innerHTML = `
   <img src="${chat.avatar}" alt="${chat.name}" class="chat-avatar" />
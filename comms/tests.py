@@ -1,3 +1,1487 @@
-from django.test import TestCase
+import csv
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from io import BytesIO, StringIO
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import msgpack
+from PIL import Image
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models.query import QuerySet
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from . import presence
+from .chat_list import get_chat_list, get_chat_list_version, get_chat_queryset
+from .cold_archive import archive_messages
+from .direct_chats import get_or_create_direct_chat
+from .export import export_rows
+from .flow_control import WS_MAX_FRAME_BYTES, SendQueue, TokenBucket, frame_limit
+from .frames import MSGPACK_SUBPROTOCOL, TYPE_CODES
+from .groups import apply_receipt, receipt_counts
+from .history import _page_query, get_message_page
+from .ids import LEASE_SECONDS, MAX_WORKER, SEQUENCE_BITS, SnowflakeGenerator, message_ids
+from .membership import (
+    _unread_count_query, ensure_memberships, mark_messages_read, rebuild_memberships, record_message, record_messages,
+)
+from .metrics import HTTP_DURATION, HTTP_QUERIES
+from .models import ArchivedChat, Chat, ChatMembership, ColdMessageBlock, Message, User
+from .partitions import is_partitioned, month_start, monthly_partitions
+from .routing import websocket_urlpatterns
+from .search import _fts_table_exists, search_messages
+from .thumbnails import THUMBNAIL_SIZES, thumbnail_name
+from .utils import DEFAULT_AVATAR_URL, get_avatar_url
+from .write_behind import accept_message, dedup_key, persist_messages, write_behind
+
+
+class MigrationTestCase(TransactionTestCase):
+    """Runs a data migration over rows written with the models as they were before it."""
+    migrate_from = None
+    migrate_to = None
+
+    def setUp(self):
+        self.executor = MigrationExecutor(connection)
+        self.executor.migrate([('comms', self.migrate_from)])
+        self.executor.loader.build_graph()
+        self.apps = self.executor.loader.project_state([('comms', self.migrate_from)]).apps
+
+    def migrate(self):
+        self.executor.loader.build_graph()
+        self.executor.migrate([('comms', self.migrate_to)])
+        return self.executor.loader.project_state([('comms', self.migrate_to)]).apps
+
+    def tearDown(self):
+        self.executor.loader.build_graph()
+        self.executor.migrate(self.executor.loader.graph.leaf_nodes('comms'))
+
+
+class SearchUsersQueryCountTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user_+6500000000', phone='+6500000000',
+                                             password='pw', name='Me')
+        self.client.force_login(self.user)
+        self.contacts = 0
+
+    def add_contacts(self, n):
+        # Each contact matches the name query, shares a chat with the user and
+        # has one message that matches the text query.
+        for _ in range(n):
+            self.contacts += 1
+            other = User.objects.create_user(username=f'user_{self.contacts}', phone=f'+6590{self.contacts:06d}',
+                                             password='pw', name=f'Alice {self.contacts}')
+            chat = Chat.objects.create()
+            chat.participants.set([self.user, other])
+            ensure_memberships(chat)
+            record_message(Message.objects.create(chat=chat, sender=other, text='lunch at noon?'))
+
+    def search(self, q):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/search-users', {'q': q})
+        self.assertEqual(response.status_code, 200)
+        return response.json(), len(ctx.captured_queries)
+
+    def test_query_count_is_constant_in_number_of_results(self):
+        self.add_contacts(2)
+        data, small = self.search('alice')
+        self.assertEqual(len(data['chats']), 2)
+        data, small_messages = self.search('lunch')
+        self.assertEqual(len(data['messages']), 2)
+
+        self.add_contacts(15)
+        data, large = self.search('alice')
+        self.assertEqual(len(data['chats']), 17)
+        data, large_messages = self.search('lunch')
+        self.assertEqual(len(data['messages']), 17)
+
+        self.assertEqual(small, large)
+        self.assertEqual(small_messages, large_messages)
+
+    def test_chat_user_preview_and_message_participant(self):
+        self.add_contacts(1)
+        data, _ = self.search('alice')
+        [chat_user] = data['chats']
+        self.assertEqual(chat_user['last_message_preview'], 'lunch at noon?')
+        self.assertEqual(chat_user['unread_count'], 1)
+        self.assertEqual(data['people'], [])
+
+        data, _ = self.search('noon')
+        [hit] = data['messages']
+        self.assertEqual(hit['otherUser']['name'], 'Alice 1')
+        self.assertIn('<mark>noon</mark>', hit['snippet'])
+
+
+class ChatListQueryCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user_+6500000000', phone='+6500000000',
+                                             password='pw', name='Me')
+        self.client.force_login(self.user)
+        self.contacts = 0
+
+    def add_chats(self, n):
+        for _ in range(n):
+            self.contacts += 1
+            other = User.objects.create_user(username=f'user_{self.contacts}', phone=f'+6590{self.contacts:06d}',
+                                             password='pw', name=f'Contact {self.contacts}')
+            chat, _ = get_or_create_direct_chat(self.user, other)
+            record_message(Message.objects.create(chat=chat, sender=other, text='hi'))
+        cache.clear()
+
+    def test_query_count_is_constant_in_number_of_chats(self):
+        # Session, user, the user's group chats (list version), memberships, participants
+        self.add_chats(2)
+        with self.assertNumQueries(5):
+            data = self.client.get('/api/chats/').json()
+        self.assertEqual(len(data['chats']), 2)
+
+        self.add_chats(5)
+        with self.assertNumQueries(5):
+            data = self.client.get('/api/chats/').json()
+        self.assertEqual(len(data['chats']), 7)
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user_+6500000000', phone='+6500000000',
+                                             password='pw', name='Me')
+        self.other = User.objects.create_user(username='user_+6500000001', phone='+6500000001',
+                                              password='pw', name='Bob')
+        self.chat = Chat.objects.create()
+        self.chat.participants.set([self.user, self.other])
+        self.client.force_login(self.user)
+
+    def send(self, text):
+        return Message.objects.create(chat=self.chat, sender=self.other, text=text)
+
+    def found(self, query):
+        messages, _ = search_messages(self.user, query)
+        return [m.id for m in messages]
+
+    def test_migration_installs_the_full_text_index(self):
+        self.assertTrue(_fts_table_exists())
+
+    def test_triggers_index_inserted_updated_and_deleted_messages(self):
+        message = self.send('meet at the harbour')
+        self.assertEqual(self.found('harbour'), [message.id])
+
+        message.text = 'meet at the station'
+        message.save(update_fields=['text'])
+        self.assertEqual(self.found('harbour'), [])
+        self.assertEqual(self.found('station'), [message.id])
+
+        message.delete()
+        self.assertEqual(self.found('station'), [])
+
+    def test_results_are_ranked_then_newest_first(self):
+        once = self.send('the tea was cold and the biscuits were stale')
+        twice = self.send('tea tea')
+        older = self.send('green tea please')
+        newer = self.send('green tea please')
+        ids = self.found('tea')
+        self.assertEqual(ids[0], twice.id)
+        self.assertEqual(ids[-1], once.id)
+        self.assertLess(ids.index(newer.id), ids.index(older.id))
+
+        messages, _ = search_messages(self.user, 'tea')
+        ranks = [m.search_rank for m in messages]
+        self.assertEqual(ranks, sorted(ranks, reverse=True))
+
+    def test_terms_are_prefix_matched_and_anded(self):
+        both = self.send('lunch tomorrow')
+        self.send('lunch today')
+        self.assertEqual(self.found('lun tomo'), [both.id])
+
+    def test_only_chats_of_the_user_are_searched(self):
+        stranger = User.objects.create_user(username='user_+6500000002', phone='+6500000002', password='pw')
+        elsewhere = Chat.objects.create()
+        elsewhere.participants.set([self.other, stranger])
+        Message.objects.create(chat=elsewhere, sender=stranger, text='secret plans')
+        self.assertEqual(self.found('secret'), [])
+
+    def test_snippet_marks_matches_and_escapes_html(self):
+        self.send('<b>pizza</b> tonight?')
+        [message], _ = search_messages(self.user, 'pizza')
+        self.assertIn('<mark>pizza</mark>', message.search_snippet)
+        self.assertIn('&lt;b&gt;', message.search_snippet)
+        self.assertNotIn('<b>', message.search_snippet)
+
+    def test_pages_through_messages(self):
+        sent = [self.send(f'standup notes {i}') for i in range(5)]
+        newest_first = [m.id for m in reversed(sent)]
+
+        pages = []
+        for page in (1, 2, 3):
+            response = self.client.get('/api/search-users', {'q': 'standup', 'page': page, 'limit': 2})
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertEqual(data['messagesPage'], page)
+            pages.append(([m['messageId'] for m in data['messages']], data['messagesHasMore']))
+
+        self.assertEqual(pages, [
+            (newest_first[0:2], True),
+            (newest_first[2:4], True),
+            (newest_first[4:], False),
+        ])
+        self.assertIn('<mark>standup</mark>', data['messages'][0]['snippet'])
+
+
+class AvatarUrlTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='avatar', phone='+6573000000', password='pw')
+
+    def test_no_picture_is_the_default(self):
+        self.assertEqual(get_avatar_url(self.user), DEFAULT_AVATAR_URL)
+        self.assertEqual(get_avatar_url(self.user, 'small'), DEFAULT_AVATAR_URL)
+
+    def test_picture_from_before_checksums_is_served_unversioned(self):
+        self.user.profile_picture = 'profile_pics/old.jpg'
+        self.assertEqual(get_avatar_url(self.user), '/media/profile_pics/old.jpg')
+        self.assertEqual(get_avatar_url(self.user, 'small'), '/media/profile_pics/old.jpg')
+
+    def test_checksum_versions_the_original_until_thumbnails_exist(self):
+        self.user.profile_picture = 'profile_pics/new.jpg'
+        self.user.avatar_checksum = 'ab' * 20
+        self.assertEqual(get_avatar_url(self.user), f'/media/profile_pics/new.jpg?v={"ab" * 6}')
+        self.assertEqual(get_avatar_url(self.user, 'small'), f'/media/profile_pics/new.jpg?v={"ab" * 6}')
+
+        self.user.avatar_thumbnails_checksum = self.user.avatar_checksum
+        self.assertEqual(get_avatar_url(self.user, 'small'),
+                         '/media/' + thumbnail_name(self.user.pk, self.user.avatar_checksum, 'small'))
+        self.assertEqual(get_avatar_url(self.user), f'/media/profile_pics/new.jpg?v={"ab" * 6}')
+
+        # A new upload whose thumbnails are not built yet
+        self.user.avatar_checksum = 'cd' * 20
+        self.assertEqual(get_avatar_url(self.user, 'small'), f'/media/profile_pics/new.jpg?v={"cd" * 6}')
+
+    def test_backfill_records_checksums_and_clears_missing_pictures(self):
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            os.makedirs(os.path.join(media, 'profile_pics'))
+            with open(os.path.join(media, 'profile_pics', 'old.jpg'), 'wb') as f:
+                f.write(b'not really a jpeg')
+            User.objects.filter(pk=self.user.pk).update(profile_picture='profile_pics/old.jpg')
+            gone = User.objects.create_user(username='avatar_gone', phone='+6573000001', password='pw',
+                                            profile_picture='profile_pics/gone.jpg')
+            with self.assertLogs('comms.thumbnails', 'WARNING'):
+                # Not an image, so no thumbnails; the checksum is still recorded
+                call_command('backfill_avatar_checksums', stdout=StringIO())
+
+        self.user.refresh_from_db()
+        self.assertEqual(len(self.user.avatar_checksum), 40)
+        self.assertTrue(get_avatar_url(self.user).endswith(f'?v={self.user.avatar_checksum[:12]}'))
+        gone.refresh_from_db()
+        self.assertFalse(gone.profile_picture)
+        self.assertEqual(get_avatar_url(gone), DEFAULT_AVATAR_URL)
+
+
+class InlineExecutor:
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+class ThumbnailTests(TransactionTestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = override_settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        # Builds run as soon as they are submitted, so one submitted before
+        # the upload is saved fails every time rather than now and then
+        patcher = mock.patch('comms.thumbnails._get_executor', return_value=InlineExecutor())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user(username='thumbs', phone='+6574000000', password='pw', name='Thumbs')
+        self.client.force_login(self.user)
+
+    def upload(self, color):
+        buffer = BytesIO()
+        Image.new('RGB', (400, 300), color).save(buffer, 'PNG')
+        return SimpleUploadedFile('me.png', buffer.getvalue(), content_type='image/png')
+
+    def assert_thumbnails_built(self):
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.avatar_checksum)
+        self.assertEqual(self.user.avatar_thumbnails_checksum, self.user.avatar_checksum)
+        storage = self.user.profile_picture.storage
+        for size in THUMBNAIL_SIZES:
+            name = thumbnail_name(self.user.pk, self.user.avatar_checksum, size)
+            self.assertTrue(storage.exists(name))
+            with storage.open(name) as f:
+                self.assertEqual(Image.open(f).size, (THUMBNAIL_SIZES[size],) * 2)
+            self.assertEqual(get_avatar_url(self.user, size), storage.url(name))
+
+    def test_setup_page_upload_builds_thumbnails(self):
+        response = self.client.post('/setup/', {'name': 'Thumbs', 'profile_picture': self.upload('red')})
+        self.assertEqual(response.status_code, 302)
+        self.assert_thumbnails_built()
+
+    def test_api_upload_builds_thumbnails(self):
+        response = self.client.post('/api/setup/', {'profile_picture': self.upload('blue')})
+        self.assertEqual(response.status_code, 200)
+        self.assert_thumbnails_built()
+
+
+class ChatMembershipTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob = [
+            User.objects.create_user(username=f'member_{i}', phone=f'+6572000{i:03d}', password='pw') for i in range(2)
+        ]
+        self.chat, _ = get_or_create_direct_chat(self.alice, self.bob)
+        self.notes, _ = get_or_create_direct_chat(self.alice, self.alice)
+
+    def counts(self, chat):
+        return dict(ChatMembership.objects.filter(chat=chat).values_list('user_id', 'unread_count'))
+
+    def send(self, chat, *senders):
+        messages = [Message.objects.create(chat=chat, sender=sender, text='hi') for sender in senders]
+        record_messages(messages)
+        return messages
+
+    def test_record_messages_counts_what_each_member_received(self):
+        with CaptureQueriesContext(connection) as ctx:
+            counts = record_messages([
+                Message.objects.create(chat=self.chat, sender=sender, text='hi')
+                for sender in (self.alice, self.alice, self.bob)
+            ])
+        self.assertEqual(counts, {self.chat.id: {self.alice.id: 1, self.bob.id: 2}})
+        updates = [q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "comms_chatmembership"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(ChatMembership.objects.get(chat=self.chat, user=self.bob).last_message.sender, self.bob)
+
+    def test_self_chat_counts_own_messages(self):
+        self.send(self.notes, self.alice, self.alice)
+        self.assertEqual(self.counts(self.notes), {self.alice.id: 2})
+        last = Message.objects.filter(chat=self.notes).latest('id')
+        self.assertEqual(len(mark_messages_read(self.notes.id, self.alice, up_to=last.id)), 2)
+        self.assertEqual(self.counts(self.notes), {self.alice.id: 0})
+
+    def test_mark_messages_read_in_one_counter_update(self):
+        first, second, own = self.send(self.chat, self.bob, self.bob, self.alice)
+        with CaptureQueriesContext(connection) as ctx:
+            flipped = mark_messages_read(self.chat.id, self.alice, message_ids=[first.id, second.id, own.id])
+        # Alice cannot acknowledge her own message
+        self.assertEqual(sorted(flipped), [first.id, second.id])
+        self.assertEqual(self.counts(self.chat), {self.alice.id: 0, self.bob.id: 1})
+        updates = [q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "comms_chatmembership" SET "unread_count"')]
+        self.assertEqual(len(updates), 1)
+        membership = ChatMembership.objects.get(chat=self.chat, user=self.alice)
+        self.assertEqual(membership.last_read_message_id, second.id)
+
+    def test_toggle_reads_then_unreads_without_rebuilding(self):
+        self.send(self.chat, self.bob, self.bob, self.alice)
+        self.client.force_login(self.alice)
+
+        def toggle():
+            response = self.client.post(
+                '/api/chat-toggle/', json.dumps({'phone': self.bob.phone, 'action': 'mark-read'}),
+                content_type='application/json',
+            )
+            return response.json()['unread_count']
+
+        with mock.patch('comms.membership.rebuild_memberships') as rebuild:
+            self.assertEqual(toggle(), 0)
+            self.assertEqual(self.counts(self.chat), {self.alice.id: 0, self.bob.id: 1})
+            self.assertEqual(toggle(), 2)
+        rebuild.assert_not_called()
+        # Bob's message to Alice was read; unread again it counts for her only
+        self.assertEqual(self.counts(self.chat), {self.alice.id: 2, self.bob.id: 1})
+
+
+class ChatMembershipMigrationTests(MigrationTestCase):
+    migrate_from = '0001_initial'
+    migrate_to = '0002_chat_memberships'
+
+    def test_existing_chats_get_their_memberships(self):
+        User, Chat, Message = [self.apps.get_model('comms', name) for name in ('User', 'Chat', 'Message')]
+        alice, bob = [User.objects.create(username=f'legacy_{i}', phone=f'+6573000{i:03d}') for i in range(2)]
+        chat, notes = Chat.objects.create(), Chat.objects.create()
+        chat.participants.set([alice, bob])
+        notes.participants.set([alice])
+        read = Message.objects.create(chat=chat, sender=bob, text='read', read=True)
+        Message.objects.create(chat=chat, sender=bob, text='unread')
+        last = Message.objects.create(chat=chat, sender=alice, text='unread too')
+        Message.objects.create(chat=notes, sender=alice, text='note')
+
+        ChatMembership = self.migrate().get_model('comms', 'ChatMembership')
+        rows = {
+            (m.chat_id, m.user_id): (m.unread_count, m.last_read_message_id, m.last_message_id)
+            for m in ChatMembership.objects.all()
+        }
+        self.assertEqual(rows[chat.id, alice.id], (1, read.id, last.id))
+        self.assertEqual(rows[chat.id, bob.id], (1, None, last.id))
+        self.assertEqual(rows[notes.id, alice.id][0], 1)
+
+
+try:
+    from fakeredis import TcpFakeServer
+except ImportError:  # fakeredis[lua], from requirements-dev.txt, is only needed for these tests
+    TcpFakeServer = None
+
+
+def start_fake_redis(test):
+    """Serve an in-process Redis stand-in for the duration of `test`; returns its URL."""
+    server = TcpFakeServer(('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    host, port = server.server_address
+    return f'redis://{host}:{port}/0'
+
+# A stand-alone worker process: join a chat group on the Redis channel layer,
+# report readiness, then print the first event it receives.
+CHANNEL_LAYER_WORKER = '''
+import asyncio, json, sys
+import django
+django.setup()
+from channels.layers import get_channel_layer
+
+async def main():
+    layer = get_channel_layer()
+    channel = await layer.new_channel()
+    await layer.group_add(sys.argv[1], channel)
+    print("ready", flush=True)
+    message = await asyncio.wait_for(layer.receive(channel), timeout=20)
+    print(json.dumps(message), flush=True)
+
+asyncio.run(main())
+'''
+
+
+@skipUnless(TcpFakeServer is not None, "fakeredis is not installed")
+class RedisChannelLayerFanOutTests(SimpleTestCase):
+    """
+    Two worker processes subscribe to the same chat group through a local
+    Redis stand-in; one group_send from a third process must reach both.
+    """
+
+    def setUp(self):
+        self.redis_url = start_fake_redis(self)
+
+    def start_worker(self, group):
+        env = {**os.environ, 'REDIS_URL': self.redis_url}
+        worker = subprocess.Popen(
+            [sys.executable, '-c', CHANNEL_LAYER_WORKER, group],
+            cwd=settings.BASE_DIR, env=env, stdout=subprocess.PIPE, text=True,
+        )
+        self.addCleanup(worker.kill)
+        self.assertEqual(worker.stdout.readline().strip(), 'ready')
+        return worker
+
+    def test_group_send_reaches_every_worker(self):
+        workers = [self.start_worker('chat_1') for _ in range(2)]
+
+        layer = RedisChannelLayer(hosts=[self.redis_url])
+        event = {'type': 'chat_message', 'message': 'hello', 'message_id': 1}
+        async_to_sync(layer.group_send)('chat_1', event)
+
+        for worker in workers:
+            self.assertEqual(json.loads(worker.stdout.readline()), event)
+            self.assertEqual(worker.wait(timeout=20), 0)
+
+
+@skipUnless(TcpFakeServer is not None, "fakeredis is not installed")
+class RedisChannelLayerWebsocketTests(TransactionTestCase):
+    """
+    Two server instances, each with its own Redis channel layer, hold one
+    socket of the same chat; a message sent on one socket must reach the other.
+    """
+
+    def setUp(self):
+        self.redis_url = start_fake_redis(self)
+        self.alice = User.objects.create_user(username='user_+6530303030', phone='+6530303030', password='pw')
+        self.bob = User.objects.create_user(username='user_+6540404040', phone='+6540404040', password='pw')
+        self.chat, _ = get_or_create_direct_chat(self.alice, self.bob)
+
+    async def connect(self, user, layer):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.chat.id}/')
+        communicator.scope['user'] = user
+        # The consumer takes its channel layer when the connection starts
+        with mock.patch('channels.consumer.get_channel_layer', return_value=layer):
+            connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_message_reaches_a_socket_on_another_instance(self):
+        layers = [RedisChannelLayer(hosts=[self.redis_url]) for _ in range(2)]
+        alice = await self.connect(self.alice, layers[0])
+        bob = await self.connect(self.bob, layers[1])
+
+        await alice.send_json_to({'type': 'message', 'message': 'hi'})
+        received = await bob.receive_json_from(timeout=5)
+        self.assertEqual((received['message'], received['sender']), ('hi', self.alice.username))
+        self.assertEqual((await alice.receive_json_from(timeout=5))['message'], 'hi')
+
+        await alice.disconnect()
+        await bob.disconnect()
+        for layer in layers:
+            await layer.flush()
+
+
+class ChatPairKeyMigrationTests(MigrationTestCase):
+    migrate_from = '0005_user_avatar_thumbnails_checksum'
+    migrate_to = '0006_chat_pair_keys'
+
+    def test_existing_direct_chats_get_their_pair_key(self):
+        User, Chat = self.apps.get_model('comms', 'User'), self.apps.get_model('comms', 'Chat')
+        alice, bob, carol = [User.objects.create(username=f'pair_{i}', phone=f'+6570000{i:03d}') for i in range(3)]
+        chats = [Chat.objects.create(is_group=is_group) for is_group in (False, False, False, True)]
+        for chat, members in zip(chats, [(bob, alice), (alice, bob), (carol,), (alice, bob, carol)]):
+            chat.participants.set(members)
+
+        Chat = self.migrate().get_model('comms', 'Chat')
+        keys = dict(Chat.objects.values_list('id', 'pair_low_id'))
+        # The oldest of two chats between the same pair keeps the key
+        self.assertEqual([keys[chat.id] for chat in chats], [alice.id, None, carol.id, None])
+
+
+@skipUnless(connection.vendor == 'postgresql', "Messages are only partitioned on Postgres")
+class PartitionMigrationTests(MigrationTestCase):
+    migrate_from = '0009_cold_message_blocks'
+    migrate_to = '0010_partition_messages'
+
+    def add_messages(self, apps, *timestamps):
+        User, Chat, Message = (apps.get_model('comms', name) for name in ('User', 'Chat', 'Message'))
+        user, _ = User.objects.get_or_create(username='partitioned', phone='+6575000000')
+        chat = Chat.objects.create()
+        return [Message.objects.create(chat=chat, sender=user, text='hi', timestamp=ts).id for ts in timestamps]
+
+    def test_rows_and_ids_survive_partitioning_both_ways(self):
+        now = datetime.now(dt_timezone.utc)
+        old_ids = self.add_messages(self.apps, now - timedelta(days=400), now)
+
+        apps = self.migrate()
+        self.assertTrue(is_partitioned())
+        months = [month for month, _ in monthly_partitions()]
+        self.assertEqual(months[0], month_start(now - timedelta(days=400)))
+        [new_id] = self.add_messages(apps, now)
+        self.assertGreater(new_id, max(old_ids))
+        self.assertEqual(apps.get_model('comms', 'Message').objects.count(), 3)
+
+        self.executor.loader.build_graph()
+        self.executor.migrate([('comms', self.migrate_from)])
+        apps = self.executor.loader.project_state([('comms', self.migrate_from)]).apps
+        self.assertFalse(is_partitioned())
+        [last_id] = self.add_messages(apps, now)
+        self.assertGreater(last_id, new_id)
+        self.assertEqual(apps.get_model('comms', 'Message').objects.count(), 4)
+
+    def test_messages_are_stored_after_the_later_migrations(self):
+        self.migrate()
+        # Up to the Snowflake ids of 0014, which replace the id sequence
+        self.executor.loader.build_graph()
+        self.executor.migrate(self.executor.loader.graph.leaf_nodes('comms'))
+        user = User.objects.create_user(username='partitioned', phone='+6575000000', password='pw')
+        chat, _ = get_or_create_direct_chat(user, user)
+        message = Message.objects.create(chat=chat, sender=user, text='hi')
+        self.assertTrue(is_partitioned())
+        self.assertEqual(Message.objects.get(pk=message.pk).text, 'hi')
+
+
+class DirectChatTests(TransactionTestCase):
+    def setUp(self):
+        self.alice, self.bob = [
+            User.objects.create_user(username=f'direct_{i}', phone=f'+6571000{i:03d}', password='pw') for i in range(2)
+        ]
+
+    def test_same_pair_twice_is_one_chat(self):
+        chat, created = get_or_create_direct_chat(self.alice, self.bob)
+        self.assertTrue(created)
+        self.assertEqual(get_or_create_direct_chat(self.bob, self.alice), (chat, False))
+        self.assertEqual(ChatMembership.objects.filter(chat=chat).count(), 2)
+
+    def test_creator_racing_another_gets_its_chat(self):
+        real_get = QuerySet.get
+        rivals = []
+
+        def get(queryset, *args, **kwargs):
+            # Another request creates the chat between our lookup and insert
+            if queryset.model is Chat and not rivals:
+                rivals.append(Chat.objects.create(pair_low=self.alice, pair_high=self.bob))
+                raise Chat.DoesNotExist
+            return real_get(queryset, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, 'get', get):
+            chat, created = get_or_create_direct_chat(self.bob, self.alice)
+        self.assertEqual((chat, created), (rivals[0], False))
+        self.assertEqual(Chat.objects.count(), 1)
+
+    @skipUnless(connection.vendor == 'postgresql', "SQLite's test database does not take concurrent writers")
+    def test_concurrent_creators_share_one_chat(self):
+        barrier = threading.Barrier(4)
+        results = []
+
+        def create():
+            barrier.wait()
+            try:
+                results.append(get_or_create_direct_chat(self.alice, self.bob)[0].id)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=create) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 4)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(Chat.objects.filter(is_group=False).count(), 1)
+
+
+class HotQueryPlanTests(TestCase):
+    """
+    The chat list, unread count and history queries must be index scans.
+    Postgres is told to avoid sequential scans, as it would rightly pick them
+    on a dataset this small; the test checks that an index can serve each query.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        users = User.objects.bulk_create(
+            [User(username=f'plan_{i}', phone=f'+6590000{i:03d}', name=f'Plan {i}') for i in range(20)]
+        )
+        cls.user = users[0]
+        chats = []
+        for other in users[1:]:
+            chat, _ = get_or_create_direct_chat(cls.user, other)
+            chats.append(chat)
+        Message.objects.bulk_create([
+            Message(chat=chat, sender=users[(i % 2) * (n + 1)], text=f'message {i}', read=i < 90)
+            for n, chat in enumerate(chats)
+            for i in range(100)
+        ])
+        rebuild_memberships()
+        ArchivedChat.objects.bulk_create(
+            [ArchivedChat(user=user, chat=chat) for user, chat in zip(users[1:], chats)] +
+            [ArchivedChat(user=cls.user, chat=chats[0])]
+        )
+        cls.chat = chats[0]
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def explain(self, queryset):
+        if connection.vendor == 'postgresql':
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                return queryset.explain()
+        return queryset.explain()
+
+    def assertIndexScan(self, queryset, table, index=None):
+        plan = self.explain(queryset)
+        if connection.vendor == 'postgresql':
+            self.assertNotIn(f'Seq Scan on {table}', plan)
+        else:
+            for line in plan.splitlines():
+                self.assertNotRegex(line, rf'\bSCAN {table}\b(?! USING)', plan)
+        if index:
+            self.assertIn(index, plan)
+
+    def test_chat_list(self):
+        self.assertIndexScan(get_chat_queryset(self.user), 'comms_chatmembership')
+        self.assertIndexScan(get_chat_queryset(self.user), 'comms_archivedchat')
+
+    def test_unread_count(self):
+        self.assertIndexScan(_unread_count_query(self.user, self.chat), 'comms_chatmembership')
+
+    def test_unread_messages_excluding_sender(self):
+        unread = Message.objects.filter(chat=self.chat, read=False).exclude(sender=self.user)
+        self.assertIndexScan(unread, 'comms_message', 'message_unread_idx')
+
+    def test_history_page(self):
+        page = _page_query(self.chat, None)[:51]
+        self.assertIndexScan(page, 'comms_message', 'message_chat_ts_id_idx')
+
+    def test_newest_message_per_chat(self):
+        newest = Message.objects.filter(chat=self.chat).order_by('-timestamp', '-id')[:1]
+        self.assertIndexScan(newest, 'comms_message', 'message_chat_ts_id_idx')
+
+    def test_archived_chats_by_user(self):
+        self.assertIndexScan(ArchivedChat.objects.filter(user=self.user), 'comms_archivedchat')
+
+
+class ImportMessagesTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='user_+6511111111', phone='+6511111111', password='pw')
+        self.bob = User.objects.create_user(username='user_+6522222222', phone='+6522222222', password='pw')
+
+    def run_import(self, content, suffix):
+        with tempfile.NamedTemporaryFile('w', suffix=suffix, delete=False) as f:
+            f.write(content)
+        self.addCleanup(os.remove, f.name)
+        out = StringIO()
+        call_command('import_messages', f.name, batch_size=2, stdout=out)
+        return out.getvalue()
+
+    def test_jsonl_keeps_timestamps_and_rebuilds_counters(self):
+        records = [
+            {'sender': '+6511111111', 'recipient': '+6522222222', 'text': 'hi', 'timestamp': '2019-03-01T10:00:00Z', 'read': True},
+            {'sender': '+6522222222', 'recipient': '+6511111111', 'text': 'hey', 'timestamp': '2019-03-01T10:01:00Z'},
+            {'sender': '+6522222222', 'recipient': '+6511111111', 'text': 'lunch?', 'timestamp': 1551434520},
+            {'sender': '+6599999999', 'recipient': '+6511111111', 'text': 'who?', 'timestamp': '2019-03-01T10:03:00Z'},
+        ]
+        out = self.run_import('\n'.join(json.dumps(r) for r in records), '.jsonl')
+
+        self.assertIn('Imported 3 messages (1 new chats)', out)
+        self.assertIn('Skipped 1 records: unknown sender', out)
+        chat = Chat.objects.get()
+        self.assertEqual(
+            [(m.text, m.timestamp.isoformat()) for m in chat.messages.order_by('timestamp')],
+            [('hi', '2019-03-01T10:00:00+00:00'), ('hey', '2019-03-01T10:01:00+00:00'),
+             ('lunch?', '2019-03-01T10:02:00+00:00')],
+        )
+        alice = ChatMembership.objects.get(chat=chat, user=self.alice)
+        self.assertEqual(alice.unread_count, 2)
+        self.assertEqual(alice.last_message.text, 'lunch?')
+        self.assertEqual(ChatMembership.objects.get(chat=chat, user=self.bob).unread_count, 0)
+
+    def test_csv_into_existing_chat(self):
+        chat, _ = get_or_create_direct_chat(self.alice, self.bob)
+        out = self.run_import(
+            'sender,chat,text,timestamp,read\n'
+            f'+6511111111,{chat.id},first,2020-01-01 09:00,true\n'
+            f'+6522222222,{chat.id},second,2020-01-01 09:05,false\n'
+            f'+6522222222,{chat.id + 1},elsewhere,2020-01-01 09:06,false\n',
+            '.csv',
+        )
+
+        self.assertIn('Imported 2 messages (0 new chats)', out)
+        self.assertIn('Skipped 1 records: sender not in chat', out)
+        self.assertEqual(list(chat.messages.values_list('text', 'read')), [('first', True), ('second', False)])
+        self.assertEqual(ChatMembership.objects.get(chat=chat, user=self.alice).unread_count, 1)
+
+    def test_history_only_goes_into_empty_chats_in_send_order(self):
+        chat, _ = get_or_create_direct_chat(self.alice, self.bob)
+        record_message(Message.objects.create(chat=chat, sender=self.bob, text='already here'))
+        carol = User.objects.create_user(username='user_+6533333333', phone='+6533333333', password='pw')
+        records = [
+            {'sender': '+6511111111', 'chat': chat.id, 'text': 'too late', 'timestamp': '2019-03-01T10:00:00Z'},
+            {'sender': '+6511111111', 'recipient': carol.phone, 'text': 'first', 'timestamp': '2019-03-01T10:00:00Z'},
+            {'sender': '+6511111111', 'recipient': carol.phone, 'text': 'earlier', 'timestamp': '2019-03-01T09:00:00Z'},
+            {'sender': '+6533333333', 'recipient': self.alice.phone, 'text': 'second', 'timestamp': '2019-03-01T10:00:00Z'},
+        ]
+        out = self.run_import('\n'.join(json.dumps(r) for r in records), '.jsonl')
+
+        self.assertIn('Imported 2 messages (1 new chats)', out)
+        self.assertIn('Skipped 1 records: chat has messages', out)
+        self.assertIn('Skipped 1 records: out of order', out)
+        self.assertEqual(list(chat.messages.values_list('text', flat=True)), ['already here'])
+        imported = Chat.objects.exclude(pk=chat.pk).get()
+        self.assertEqual(list(imported.messages.order_by('id').values_list('text', flat=True)), ['first', 'second'])
+
+
+class ChatMessagesApiTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user_+6533333333', phone='+6533333333', password='pw')
+        other = User.objects.create_user(username='user_+6544444444', phone='+6544444444', password='pw')
+        self.chat, _ = get_or_create_direct_chat(self.user, other)
+        # Three messages per timestamp, written out of timestamp order so that
+        # id order and (timestamp, id) order differ
+        start = datetime(2024, 6, 1, tzinfo=dt_timezone.utc)
+        for i, minute in enumerate([2, 0, 1, 0, 2, 1, 0, 1, 2]):
+            Message.objects.create(chat=self.chat, sender=other, text=f'message {i}',
+                                   timestamp=start + timedelta(minutes=minute))
+        self.history = list(self.chat.messages.order_by('timestamp', 'id').values_list('id', flat=True))
+        self.client.force_login(self.user)
+
+    def page(self, **params):
+        response = self.client.get(f'/api/chats/{self.chat.id}/messages/', params)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [m['id'] for m in data['messages']], data['has_more']
+
+    def test_pages_back_with_before_id(self):
+        self.assertEqual(self.page(limit=4), (self.history[5:], True))
+        self.assertEqual(self.page(before_id=self.history[5], limit=4), (self.history[1:5], True))
+        self.assertEqual(self.page(before_id=self.history[1], limit=4), (self.history[:1], False))
+
+    def test_pages_forward_with_after_id(self):
+        self.assertEqual(self.page(after_id=self.history[0], limit=4), (self.history[1:5], True))
+        self.assertEqual(self.page(after_id=self.history[4], limit=4), (self.history[5:], False))
+        self.assertEqual(self.page(after_id=self.history[-1], limit=4), ([], False))
+
+    def test_timestamp_ties_are_paged_by_timestamp_then_id(self):
+        self.assertNotEqual(self.history, sorted(self.history))
+        for limit in (1, 2, 4):
+            ids, before_id, has_more = [], None, True
+            while has_more:
+                page, has_more = get_message_page(self.chat, before_id=before_id, limit=limit)
+                ids = [m.id for m in page] + ids
+                before_id = page[0].id if page else None
+            self.assertEqual(ids, self.history)
+
+            ids, after_id, has_more = [], self.history[0], True
+            while has_more:
+                page, has_more = get_message_page(self.chat, after_id=after_id, limit=limit)
+                ids += [m.id for m in page]
+                after_id = page[-1].id if page else None
+            self.assertEqual(ids, self.history[1:])
+
+    def test_bad_cursors(self):
+        url = f'/api/chats/{self.chat.id}/messages/'
+        response = self.client.get(url, {'before_id': 'abc'})
+        self.assertEqual((response.status_code, response.json()['error']), (400, 'Invalid cursor'))
+        response = self.client.get(url, {'before_id': self.history[5], 'after_id': self.history[1]})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('not both', response.json()['error'])
+        # A cursor that is not a message of this chat gives an empty page
+        self.assertEqual(self.page(before_id=self.history[-1] + 10 ** 6), ([], False))
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user(username='user_+6511111111', phone='+6511111111', password='pw', name='Alice')
+        self.bob = User.objects.create_user(username='user_+6522222222', phone='+6522222222', password='pw', name='Bob')
+        self.carol = User.objects.create_user(username='user_+6533333333', phone='+6533333333', password='pw', name='Carol')
+        self.chat, _ = get_or_create_direct_chat(self.alice, self.bob)
+        self.other_chat, _ = get_or_create_direct_chat(self.alice, self.carol)
+        with self.captureOnCommitCallbacks(execute=True):
+            record_message(Message.objects.create(chat=self.chat, sender=self.alice, text='lunch?'))
+        self.async_client.force_login(self.bob)
+
+    async def test_anonymous_requests_are_sent_to_log_in(self):
+        client = self.async_client_class()
+        for url, params in (
+            ('/api/chats/', {}),
+            ('/api/chat-status/', {'phone': self.alice.phone}),
+            (f'/api/chats/{self.chat.id}/messages/', {}),
+            ('/api/search-users', {'q': 'lunch'}),
+        ):
+            response = await client.get(url, params)
+            self.assertEqual(response.status_code, 302, url)
+            self.assertTrue(response.url.startswith(settings.LOGIN_URL), url)
+
+    async def test_unknown_chats_are_not_found(self):
+        response = await self.async_client.get('/api/chat-status/', {'phone': self.carol.phone})
+        self.assertEqual(response.status_code, 404)
+        response = await self.async_client.get('/api/chat-status/', {'phone': '+6599999999'})
+        self.assertEqual(response.status_code, 404)
+        response = await self.async_client.get(f'/api/chats/{self.other_chat.id}/messages/')
+        self.assertEqual(response.status_code, 404)
+        response = await self.async_client.get('/api/chat-status/')
+        self.assertEqual(response.status_code, 400)
+
+    async def test_chat_list(self):
+        response = await self.async_client.get('/api/chats/')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['name'], 'Bob')
+        [chat] = data['chats']
+        self.assertEqual((chat['name'], chat['unread_count']), ('Alice', 1))
+
+        # Unchanged, the list is answered with 304 Not Modified
+        response = await self.async_client.get('/api/chats/', headers={'if-none-match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    async def test_chat_status(self):
+        response = await self.async_client.get('/api/chat-status/', {'phone': self.alice.phone})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            'is_archived': False, 'has_unread': True, 'unread_count': 1, 'is_favourite': False,
+        })
+
+    async def test_chat_messages(self):
+        response = await self.async_client.get(f'/api/chats/{self.chat.id}/messages/')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertFalse(data['has_more'])
+        [message] = data['messages']
+        self.assertEqual((message['text'], message['sender_username']), ('lunch?', self.alice.username))
+
+    async def test_search_users(self):
+        response = await self.async_client.get('/api/search-users', {'q': 'lunch'})
+        self.assertEqual(response.status_code, 200)
+        [hit] = response.json()['messages']
+        self.assertEqual((hit['chatId'], hit['otherUser']['name']), (self.chat.id, 'Alice'))
+
+        response = await self.async_client.get('/api/search-users', {'q': 'carol'})
+        data = response.json()
+        self.assertEqual([u['name'] for u in data['people']], ['Carol'])
+        self.assertEqual(data['chats'], [])
+
+
+class ChatExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user_+6533333333', phone='+6533333333', password='pw')
+        other = User.objects.create_user(username='user_+6544444444', phone='+6544444444', password='pw')
+        self.chat, _ = get_or_create_direct_chat(self.user, other)
+        Message.objects.bulk_create([
+            Message(chat=self.chat, sender=other if i % 2 else self.user, text=f'line {i}, "quoted"')
+            for i in range(25)
+        ])
+        self.client.force_login(self.user)
+        self.async_client.force_login(self.user)
+
+    async def export(self, fmt):
+        response = await self.async_client.get(f'/api/chats/{self.chat.id}/export/', {'format': fmt})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertIn(f'chat-{self.chat.id}.', response['Content-Disposition'])
+        return b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+    async def test_ndjson(self):
+        records = [json.loads(line) for line in (await self.export('ndjson')).splitlines()]
+        self.assertEqual(len(records), 25)
+        self.assertEqual(records[0]['text'], 'line 0, "quoted"')
+        self.assertEqual(records[1]['sender_username'], 'user_+6544444444')
+        self.assertEqual([r['id'] for r in records], sorted(r['id'] for r in records))
+
+    async def test_csv(self):
+        rows = list(csv.DictReader(StringIO(await self.export('csv'))))
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[-1]['text'], 'line 24, "quoted"')
+
+    def test_other_users_chat_and_bad_format(self):
+        self.assertEqual(self.client.get(f'/api/chats/{self.chat.id}/export/', {'format': 'xml'}).status_code, 400)
+        stranger = User.objects.create_user(username='user_+6555555555', phone='+6555555555', password='pw')
+        self.client.force_login(stranger)
+        self.assertEqual(self.client.get(f'/api/chats/{self.chat.id}/export/').status_code, 404)
+
+
+@mock.patch('comms.cold_archive.BLOCK_SIZE', 25)
+class ColdArchiveTests(TestCase):
+    def setUp(self):
+        alice = User.objects.create_user(username='user_+6566666666', phone='+6566666666', password='pw')
+        bob = User.objects.create_user(username='user_+6577777777', phone='+6577777777', password='pw')
+        self.chat, _ = get_or_create_direct_chat(alice, bob)
+        start = datetime(2020, 1, 1, tzinfo=dt_timezone.utc)
+        Message.objects.bulk_create([
+            Message(chat=self.chat, sender=bob if i % 2 else alice, text=f'message {i}',
+                    timestamp=start + timedelta(hours=i), read=i != 10)
+            for i in range(120)
+        ])
+        rebuild_memberships()
+        self.history = list(self.chat.messages.order_by('timestamp', 'id').values_list('id', flat=True))
+        self.cutoff = start + timedelta(days=30)
+
+    def page_back(self, limit=50):
+        ids = []
+        before_id = None
+        while True:
+            page, has_more = get_message_page(self.chat, before_id=before_id, limit=limit)
+            ids = [m.id for m in page] + ids
+            if not has_more:
+                return ids
+            before_id = page[0].id
+
+    def test_archived_history_reads_back_in_order(self):
+        self.assertEqual(archive_messages(before=self.cutoff), 118)
+
+        # The unread message and the chat's last message stay live
+        self.assertEqual(list(self.chat.messages.values_list('text', flat=True)), ['message 10', 'message 119'])
+        self.assertEqual(ColdMessageBlock.objects.filter(chat=self.chat).count(), 5)
+        self.assertEqual(self.page_back(), self.history)
+        self.assertEqual([row[0] for row in export_rows(self.chat)], self.history)
+
+        page, has_more = get_message_page(self.chat, after_id=self.history[30], limit=10)
+        self.assertEqual([m.id for m in page], self.history[31:41])
+        self.assertTrue(has_more)
+        self.assertEqual(page[0].sender.username, 'user_+6577777777')
+
+    def test_messages_archived_by_a_later_run_merge_into_place(self):
+        archive_messages(before=self.cutoff)
+        Message.objects.filter(text='message 10').update(read=True)
+        self.assertEqual(archive_messages(before=self.cutoff), 1)
+
+        self.assertEqual(self.page_back(limit=7), self.history)
+        self.assertEqual([row[0] for row in export_rows(self.chat)], self.history)
+
+
+@override_settings(MESSAGE_ID_WORKER=None)
+class MessageIdTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    @override_settings(MESSAGE_ID_WORKER=5)
+    def test_pinned_worker(self):
+        self.assertEqual(SnowflakeGenerator().next_id() >> SEQUENCE_BITS & MAX_WORKER, 5)
+        with override_settings(MESSAGE_ID_WORKER=MAX_WORKER + 1), self.assertRaises(ImproperlyConfigured):
+            SnowflakeGenerator().next_id()
+
+    def test_no_shared_cache_to_lease_from(self):
+        with self.assertRaises(ImproperlyConfigured):
+            SnowflakeGenerator().next_id()
+
+    @mock.patch('comms.ids.caches', {'default': cache})
+    def test_leases_are_distinct_and_move_when_taken_over(self):
+        now = [0.0]
+        first, second = SnowflakeGenerator(monotonic=lambda: now[0]), SnowflakeGenerator(monotonic=lambda: now[0])
+        self.assertNotEqual(first.worker_id, second.worker_id)
+
+        # The first stalls past its lease, and the id goes to someone else
+        taken = first.worker_id
+        cache.set(f'message_ids:worker:{taken}', 'another process')
+        now[0] += LEASE_SECONDS
+        self.assertNotIn(first.next_id() >> SEQUENCE_BITS & MAX_WORKER, {taken, second.worker_id})
+
+
+class WriteBehindTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(username='user_+6588888888', phone='+6588888888', password='pw')
+        self.bob = User.objects.create_user(username='user_+6599999999', phone='+6599999999', password='pw')
+        self.chat, _ = get_or_create_direct_chat(self.alice, self.bob)
+
+    async def test_resend_is_stored_once(self):
+        message, persisted, is_new = await accept_message(self.alice, self.chat.id, 'hi', 'c-1')
+        again, pending, is_new_again = await accept_message(self.alice, self.chat.id, 'hi', 'c-1')
+        self.assertTrue(is_new)
+        self.assertFalse(is_new_again)
+        self.assertIs(pending, persisted)
+        self.assertEqual((again.id, again.timestamp), (message.id, message.timestamp))
+
+        self.assertTrue(await write_behind.flush())
+        self.assertEqual(await persisted, {self.alice.id: 0, self.bob.id: 1})
+        self.assertEqual(await Message.objects.filter(client_msg_id='c-1').acount(), 1)
+
+        _, stored, is_new = await accept_message(self.alice, self.chat.id, 'hi', 'c-1')
+        self.assertIsNone(stored)
+        self.assertFalse(is_new)
+
+    async def test_every_send_path_takes_ids_from_one_source(self):
+        # Legacy sends without a client id, then one with
+        socket = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.chat.id}/')
+        socket.scope['user'] = self.bob
+        await socket.connect()
+        await socket.send_json_to({'type': 'message', 'message': 'first'})
+        first = (await socket.receive_json_from())['message_id']
+        await socket.disconnect()
+        second, persisted, _ = await accept_message(self.bob, self.chat.id, 'second', 'c-2')
+        await persisted
+        third = await Message.objects.acreate(chat=self.chat, sender=self.bob, text='third')
+        self.assertLess(first, second.id)
+        self.assertLess(second.id, third.id)
+
+        # A watermark at the optimistic message leaves the later one unread
+        await sync_to_async(mark_messages_read)(self.chat.id, self.alice, up_to=second.id)
+        unread = Message.objects.filter(chat=self.chat, read=False).values_list('text', flat=True)
+        self.assertEqual([text async for text in unread], ['third'])
+
+    async def test_resend_is_acked_from_the_database(self):
+        # Stored by a process whose dedup entry is gone; resends land here
+        stored = await Message.objects.acreate(chat=self.chat, sender=self.alice, text='hi', client_msg_id='c-3')
+        await cache.aset(dedup_key(self.alice.id, 'c-3'), (message_ids.next_id(), stored.timestamp))
+        message, persisted, is_new = await accept_message(self.alice, self.chat.id, 'hi', 'c-3')
+        self.assertEqual((message.id, persisted, is_new), (stored.id, None, False))
+
+        # A copy that is already queued is not written twice
+        copy = Message(chat=self.chat, sender=self.alice, text='hi', client_msg_id='c-3')
+        self.assertEqual(await sync_to_async(persist_messages)([copy]), ([], {}))
+        self.assertEqual(await Message.objects.filter(client_msg_id='c-3').acount(), 1)
+
+    def test_batch_counts_each_sender(self):
+        messages = [
+            Message(id=message_ids.next_id(), chat=self.chat, sender=sender, text=str(i))
+            for i, sender in enumerate([self.alice, self.alice, self.bob])
+        ]
+        stored, unread_counts = persist_messages(messages)
+        self.assertEqual(stored, [m.id for m in messages])
+        self.assertEqual(unread_counts[self.chat.id], {self.alice.id: 1, self.bob.id: 2})
+        membership = ChatMembership.objects.get(chat=self.chat, user=self.bob)
+        self.assertEqual(membership.last_message_id, messages[-1].id)
+        # Writing the same batch again changes nothing
+        self.assertEqual(persist_messages(messages), ([], {}))
+
+
+class PresenceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user(username='user_+6510101010', phone='+6510101010', password='pw', name='Alice')
+        self.bob = User.objects.create_user(username='user_+6520202020', phone='+6520202020', password='pw', name='Bob')
+        self.chat, _ = get_or_create_direct_chat(self.alice, self.bob)
+        record_message(Message.objects.create(chat=self.chat, sender=self.alice, text='hi'))
+        self.async_client.force_login(self.alice)
+
+    async def active_chats(self, **headers):
+        return await self.async_client.get('/api/chats/active/', headers=headers)
+
+    async def test_online_until_last_socket_closes(self):
+        self.assertTrue(await presence.connected(self.bob.id))
+        self.assertFalse(await presence.connected(self.bob.id))
+
+        response = await self.active_chats()
+        self.assertTrue(json.loads(response.content)[0]['online'])
+        self.assertEqual((await self.active_chats(if_none_match=response['ETag'])).status_code, 304)
+
+        self.assertIsNone(await presence.disconnected(self.bob.id))
+        seen = await presence.disconnected(self.bob.id)
+        self.assertIsNotNone(seen)
+
+        # The list version did not change, but presence did
+        row = json.loads((await self.active_chats(if_none_match=response['ETag'])).content)[0]
+        self.assertEqual((row['online'], row['last_seen']), (False, seen.isoformat()))
+
+        await presence.last_seen_buffer.flush()
+        await self.bob.arefresh_from_db()
+        self.assertEqual(self.bob.last_seen, seen)
+
+    async def test_typing_is_throttled(self):
+        self.assertTrue(await presence.typing_allowed(self.alice.id, self.chat.id))
+        self.assertFalse(await presence.typing_allowed(self.alice.id, self.chat.id))
+        self.assertTrue(await presence.typing_allowed(self.bob.id, self.chat.id))
+
+
+class ChatListETagTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user(username='user_+6511111111', phone='+6511111111', password='pw', name='Alice')
+        self.bob = User.objects.create_user(username='user_+6522222222', phone='+6522222222', password='pw', name='Bob')
+        self.chat, _ = get_or_create_direct_chat(self.alice, self.bob)
+        self.send()
+        self.client.force_login(self.bob)
+
+    def send(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            record_message(Message.objects.create(chat=self.chat, sender=self.alice, text='hi'))
+
+    def etag(self):
+        response = self.client.get('/api/chats/')
+        self.assertEqual(response.status_code, 200)
+        # Unchanged, the list is not sent again
+        self.assertEqual(self.client.get('/api/chats/', headers={'if-none-match': response['ETag']}).status_code, 304)
+        return response['ETag']
+
+    def toggle(self, action):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                '/api/chat-toggle/', json.dumps({'phone': self.alice.phone, 'action': action}),
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 200)
+
+    def rename_alice(self):
+        alice = Client()
+        alice.force_login(self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = alice.post('/api/setup/', json.dumps({'name': 'Alicia'}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_every_change_to_the_list_changes_its_etag(self):
+        etags = [self.etag()]
+        for change in (self.send, lambda: self.toggle('mark-read'), lambda: self.toggle('archive'),
+                       lambda: self.toggle('favourite'), self.rename_alice):
+            change()
+            etags.append(self.etag())
+        self.assertEqual(len(set(etags)), len(etags))
+
+        data = self.client.get('/api/chats/').json()
+        self.assertEqual(data['archived_chats'][0]['name'], 'Alicia')
+
+
+class FlowControlTests(SimpleTestCase):
+    def test_token_bucket_refills_at_its_rate(self):
+        now = [0.0]
+        bucket = TokenBucket(rate=2, burst=3, clock=lambda: now[0])
+        self.assertEqual([bucket.take() for _ in range(4)], [True, True, True, False])
+        now[0] = 0.5
+        self.assertEqual([bucket.take() for _ in range(2)], [True, False])
+
+    def test_slow_client_queue_coalesces_and_drops_state(self):
+        queue = SendQueue(send=None, maxsize=3)
+        self.assertTrue(queue.put({'type': 'unread', 'chat_id': 1, 'unread_count': 1}))
+        self.assertTrue(queue.put({'type': 'message', 'message_id': 1}))
+        self.assertTrue(queue.put({'type': 'unread', 'chat_id': 1, 'unread_count': 2}))
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(list(queue._frames.values())[-1][0]['unread_count'], 2)
+
+        self.assertTrue(queue.put({'type': 'message', 'message_id': 2}))
+        # Full: a message pushes out the unread frame, then nothing is left to drop
+        self.assertTrue(queue.put({'type': 'message', 'message_id': 3}))
+        self.assertTrue(queue.put({'type': 'typing', 'chat_id': 1, 'user_id': 2}))
+        self.assertFalse(queue.put({'type': 'message', 'message_id': 4}))
+        self.assertEqual([f['message_id'] for f, _ in queue._frames.values()], [1, 2, 3])
+
+    def test_oversized_frames_are_refused_unparsed(self):
+        bucket = TokenBucket(rate=1, burst=1)
+        self.assertEqual(frame_limit('x' * (WS_MAX_FRAME_BYTES + 1), bucket, None), 'size')
+        self.assertEqual(frame_limit(b'x' * (WS_MAX_FRAME_BYTES + 1), bucket, None), 'size')
+        # Within the limit in characters, over it in bytes
+        self.assertEqual(frame_limit('é' * (WS_MAX_FRAME_BYTES // 2 + 1), bucket, None), 'size')
+        self.assertIsNone(frame_limit('{}', bucket, None))
+        self.assertEqual(frame_limit('{}', bucket, None), 'connection')
+
+
+class MetricsMiddlewareTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='user_+6500000000', phone='+6500000000', password='pw')
+        self.client.force_login(self.user)
+
+    def test_request_is_recorded_under_its_view(self):
+        requests = HTTP_DURATION.count('chat_list_api', 'GET')
+        queries = HTTP_QUERIES.count('chat_list_api')
+        self.assertEqual(self.client.get('/api/chats/').status_code, 200)
+        self.assertEqual(HTTP_DURATION.count('chat_list_api', 'GET'), requests + 1)
+        self.assertEqual(HTTP_QUERIES.count('chat_list_api'), queries + 1)
+
+        exported = self.client.get('/metrics').content.decode()
+        self.assertIn(
+            f'messenger_http_request_duration_seconds_count{{view="chat_list_api",method="GET"}} {requests + 1}',
+            exported,
+        )
+
+    def test_unknown_methods_are_labelled_other(self):
+        requests = HTTP_DURATION.count('chat_list_api', 'other')
+        self.client.generic('BREW', '/api/chats/')
+        self.assertEqual(HTTP_DURATION.count('chat_list_api', 'other'), requests + 1)
+        self.assertEqual(HTTP_DURATION.count('chat_list_api', 'BREW'), 0)
+
+
+class ChatConsumerMembershipTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user(username='user_+6530303030', phone='+6530303030', password='pw')
+        self.bob = User.objects.create_user(username='user_+6540404040', phone='+6540404040', password='pw')
+        self.carol = User.objects.create_user(username='user_+6550505050', phone='+6550505050', password='pw')
+        self.chat, _ = get_or_create_direct_chat(self.alice, self.bob)
+
+    async def connect(self, user, subprotocols=None, chat=None):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/{(chat or self.chat).id}/', subprotocols=subprotocols
+        )
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def test_only_participants_may_connect(self):
+        _, connected = await self.connect(self.carol)
+        self.assertFalse(connected)
+
+        alice, connected = await self.connect(self.alice)
+        self.assertTrue(connected)
+        with mock.patch('comms.metrics.check_budget') as check_budget:
+            await alice.send_json_to({'type': 'message', 'message': 'hi'})
+            self.assertEqual((await alice.receive_json_from())['message'], 'hi')
+        # Insert and counter update only (plus BEGIN on SQLite): the chat and its
+        # members come from connect
+        self.assertEqual(check_budget.call_args.args, ('ws:message', 4 if connection.vendor == 'sqlite' else 3))
+        await alice.disconnect()
+
+    async def test_msgpack_subprotocol(self):
+        alice, _ = await self.connect(self.alice, [MSGPACK_SUBPROTOCOL])
+        bob, _ = await self.connect(self.bob)
+        await alice.send_to(bytes_data=msgpack.packb({'t': TYPE_CODES['message'], 'm': 'hi'}))
+
+        frame = msgpack.unpackb(await alice.receive_from())
+        self.assertEqual((frame['t'], frame['m'], frame['s']), (TYPE_CODES['message'], 'hi', self.alice.username))
+        self.assertEqual(json.loads(await bob.receive_from())['message'], 'hi')
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_malformed_frames_are_dropped(self):
+        alice, _ = await self.connect(self.alice, [MSGPACK_SUBPROTOCOL])
+        bob, _ = await self.connect(self.bob)
+        for data in (b'\xc1', msgpack.packb(7), msgpack.packb([1, 2]), msgpack.packb({'t': [1]})):
+            await alice.send_to(bytes_data=data)
+            self.assertEqual(msgpack.unpackb(await alice.receive_from())['e'], 'Malformed frame')
+        for text in ('{', '"hi"', '[]', '{"type": {}}'):
+            await bob.send_to(text_data=text)
+            self.assertEqual(json.loads(await bob.receive_from())['error'], 'Malformed frame')
+
+        # The sockets stay open
+        await bob.send_json_to({'type': 'message', 'message': 'still here'})
+        self.assertEqual(msgpack.unpackb(await alice.receive_from())['m'], 'still here')
+        await alice.disconnect()
+        await bob.disconnect()
+
+    @sync_to_async
+    def send(self, chat, *senders):
+        messages = [Message.objects.create(chat=chat, sender=sender, text='hi') for sender in senders]
+        record_messages(messages)
+        return [m.id for m in messages]
+
+    @sync_to_async
+    def flags(self, chat):
+        return {i: (d, r) for i, d, r in Message.objects.filter(chat=chat).values_list('id', 'delivered', 'read')}
+
+    @sync_to_async
+    def counts(self, chat):
+        return dict(ChatMembership.objects.filter(chat=chat).values_list('user_id', 'unread_count'))
+
+    async def receipt(self, communicator, frame):
+        """Send a receipt frame; returns the counter UPDATEs it ran."""
+        update = QuerySet.update
+        with mock.patch.object(QuerySet, 'update', autospec=True, side_effect=update) as updates:
+            await communicator.send_json_to(frame)
+            status = await communicator.receive_json_from()
+        return status, [
+            call for call in updates.call_args_list
+            if call.args[0].model is ChatMembership and 'unread_count' in call.kwargs
+        ]
+
+    async def test_batched_read_receipt(self):
+        *received, own = await self.send(self.chat, self.bob, self.bob, self.bob, self.alice)
+        alice, _ = await self.connect(self.alice)
+        bob, _ = await self.connect(self.bob)
+
+        # Alice's own message is in the batch but is not hers to acknowledge
+        status, updates = await self.receipt(alice, {'type': 'read', 'message_ids': [*received, own]})
+        self.assertEqual(status['type'], 'status')
+        self.assertEqual(sorted(status['message_ids']), received)
+        self.assertEqual(len(updates), 1)
+
+        # One status frame for the whole batch
+        frame = await bob.receive_json_from()
+        self.assertEqual((frame['status'], frame['reader'], sorted(frame['message_ids'])),
+                         ('read', self.alice.username, received))
+        self.assertTrue(await bob.receive_nothing())
+
+        flags = await self.flags(self.chat)
+        self.assertEqual([flags[i] for i in received], [(True, True)] * 3)
+        self.assertEqual(flags[own], (False, False))
+        self.assertEqual(await self.counts(self.chat), {self.alice.id: 0, self.bob.id: 1})
+
+        # Nothing left to flip: no frame at all
+        await alice.send_json_to({'type': 'read', 'message_ids': received})
+        self.assertTrue(await bob.receive_nothing())
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_watermark_receipts(self):
+        first, second, third = await self.send(self.chat, self.bob, self.bob, self.bob)
+        alice, _ = await self.connect(self.alice)
+        bob, _ = await self.connect(self.bob)
+
+        status, updates = await self.receipt(alice, {'type': 'delivered', 'up_to': second})
+        self.assertEqual((status['status'], status['up_to']), ('delivered', second))
+        self.assertEqual(updates, [])
+        self.assertEqual((await bob.receive_json_from())['up_to'], second)
+        self.assertEqual(await self.flags(self.chat), {first: (True, False), second: (True, False), third: (False, False)})
+
+        status, updates = await self.receipt(alice, {'type': 'read', 'up_to': third})
+        self.assertEqual((status['status'], status['up_to']), ('read', third))
+        self.assertEqual(len(updates), 1)
+        self.assertEqual((await bob.receive_json_from())['up_to'], third)
+        self.assertTrue(await bob.receive_nothing())
+        self.assertEqual(set((await self.flags(self.chat)).values()), {(True, True)})
+        self.assertEqual(await self.counts(self.chat), {self.alice.id: 0, self.bob.id: 0})
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_self_chat_receipts(self):
+        notes, _ = await sync_to_async(get_or_create_direct_chat)(self.alice, self.alice)
+        first, second = await self.send(notes, self.alice, self.alice)
+        self.assertEqual(await self.counts(notes), {self.alice.id: 2})
+        alice, _ = await self.connect(self.alice, chat=notes)
+
+        # In a self chat the reader's own messages are theirs to acknowledge
+        status, updates = await self.receipt(alice, {'type': 'read', 'up_to': second})
+        self.assertEqual((status['status'], status['up_to']), ('read', second))
+        self.assertEqual(len(updates), 1)
+        self.assertTrue(await alice.receive_nothing())
+        self.assertEqual(await self.flags(notes), {first: (True, True), second: (True, True)})
+        self.assertEqual(await self.counts(notes), {self.alice.id: 0})
+        await alice.disconnect()
+
+    async def test_removed_participant_is_disconnected(self):
+        bob, connected = await self.connect(self.bob)
+        self.assertTrue(connected)
+        await sync_to_async(self.chat.participants.remove)(self.bob)
+        self.assertEqual((await bob.receive_output())['type'], 'websocket.close')
+
+
+class GroupChatTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice, self.bob, self.carol, self.dave = User.objects.bulk_create(
+            [User(username=f'group_{i}', phone=f'+6561000{i:03d}') for i in range(4)]
+        )
+        self.chat = Chat.objects.create(is_group=True)
+        self.chat.participants.set([self.alice, self.bob, self.carol, self.dave])
+
+    def send(self, sender, text='hi'):
+        message = Message.objects.create(chat=self.chat, sender=sender, text=text)
+        record_message(message)
+        return message
+
+    def unread(self, user):
+        return _unread_count_query(user, self.chat).first()
+
+    def test_send_cost_does_not_grow_with_the_room(self):
+        version = get_chat_list_version(self.bob.id)
+        with CaptureQueriesContext(connection) as small:
+            self.send(self.alice)
+        # One stamp of the chat moves every member's chat list version
+        self.assertGreater(get_chat_list_version(self.bob.id), version)
+        self.chat.participants.add(*User.objects.bulk_create(
+            [User(username=f'group_extra_{i}', phone=f'+6562000{i:03d}') for i in range(50)]
+        ))
+        with CaptureQueriesContext(connection) as large:
+            self.send(self.alice)
+        self.assertEqual(len(small), len(large))
+
+        # Members' rows are left alone; their counts come from the chat's
+        self.assertEqual((self.unread(self.alice), self.unread(self.bob)), (0, 2))
+        self.assertFalse(ChatMembership.objects.filter(chat=self.chat, unread_count__gt=0).exists())
+        self.assertEqual([row['unread_count'] for row in get_chat_list(self.bob)], [2])
+
+    def test_read_by_k_of_n(self):
+        first, second = self.send(self.alice), self.send(self.alice)
+        self.assertEqual(apply_receipt(self.chat.id, self.bob, 'read', second.id), (True, None))
+        self.assertEqual(apply_receipt(self.chat.id, self.carol, 'read', first.id), (True, None))
+        self.assertEqual(apply_receipt(self.chat.id, self.bob, 'read', first.id), (False, None))
+        counts = receipt_counts(self.chat.id, [first, second])
+        self.assertEqual(counts[first.id], {'delivered_to': 2, 'read_by': 2, 'recipients': 3})
+        self.assertEqual(counts[second.id], {'delivered_to': 1, 'read_by': 1, 'recipients': 3})
+
+        # Dave was the last to read the first message: the chat's watermark moves to it
+        self.assertEqual(apply_receipt(self.chat.id, self.dave, 'read', second.id), (True, first.id))
+        self.assertEqual(
+            list(Message.objects.filter(chat=self.chat).values_list('read', flat=True).order_by('id')), [True, False]
+        )
+        self.assertEqual((self.unread(self.carol), self.unread(self.dave)), (1, 0))
+
+    def test_receipt_for_a_message_not_in_the_chat_is_ignored(self):
+        first, second = self.send(self.alice), self.send(self.alice)
+        elsewhere = Chat.objects.create(is_group=True)
+        other = Message.objects.create(chat=elsewhere, sender=self.alice, text='hi')
+        for up_to in (second.id + 1000, other.id):
+            self.assertEqual(apply_receipt(self.chat.id, self.bob, 'read', up_to), (False, None))
+        self.assertEqual(self.unread(self.bob), 2)
+
+        # Real receipts still count
+        self.assertEqual(apply_receipt(self.chat.id, self.bob, 'read', first.id), (True, None))
+        third = self.send(self.alice)
+        self.assertEqual(apply_receipt(self.chat.id, self.bob, 'read', third.id), (True, None))
+        self.assertEqual(self.unread(self.bob), 0)
+
+    async def receive(self, socket):
+        # Skipping presence frames, which race with the other socket connecting
+        while (frame := await socket.receive_json_from())['type'] == 'presence':
+            pass
+        return frame
+
+    async def test_members_group_fan_out(self):
+        sockets = []
+        for user in (self.alice, self.bob):
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chats/')
+            communicator.scope['user'] = user
+            self.assertTrue((await communicator.connect())[0])
+            sockets.append(communicator)
+        alice, bob = sockets
+
+        await alice.send_json_to({'type': 'message', 'chat_id': self.chat.id, 'message': 'hello all'})
+        frame = await self.receive(bob)
+        self.assertEqual((frame['chat_id'], frame['message'], frame['unread_count']), (self.chat.id, 'hello all', None))
+        self.assertEqual((await self.receive(alice))['message'], 'hello all')
+
+        # Only the watermark everyone has reached is broadcast
+        await bob.send_json_to({'type': 'read', 'chat_id': self.chat.id, 'up_to': frame['message_id']})
+        self.assertEqual(await self.receive(bob), {'type': 'unread', 'chat_id': self.chat.id, 'unread_count': 0})
+        while not await alice.receive_nothing():
+            self.assertEqual((await alice.receive_json_from())['type'], 'presence')
+        for socket in sockets:
+            await socket.disconnect()
@@ -0,0 +1,119 @@
+"""
+Avatar thumbnails.
+
+Uploaded profile pictures are decoded once, cropped square and written as
+fixed-size thumbnails next to the original (profile_pics/thumbs/). The work
+runs on a small thread pool after the upload's transaction commits, so the
+request returns straight away; until the thumbnails exist `get_avatar_url`
+serves the original. User.avatar_thumbnails_checksum records which upload
+the thumbnails on disk were built from.
+"""
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+# Named sizes in pixels (square). small covers chat rows and search results,
+# large the profile and contact panels, both at 2x density.
+THUMBNAIL_SIZES = getattr(settings, 'AVATAR_THUMBNAIL_SIZES', {'small': 96, 'large': 320})
+THUMBNAIL_WORKERS = getattr(settings, 'AVATAR_THUMBNAIL_WORKERS', 2)
+THUMBNAIL_DIR = 'profile_pics/thumbs'
+
+if features.check('webp'):
+    THUMBNAIL_FORMAT, THUMBNAIL_EXT = 'WEBP', 'webp'
+    SAVE_OPTIONS = {'quality': 82, 'method': 4}
+else:
+    THUMBNAIL_FORMAT, THUMBNAIL_EXT = 'JPEG', 'jpg'
+    SAVE_OPTIONS = {'quality': 82, 'optimize': True}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def thumbnail_name(user_id, checksum, size):
+    return f'{THUMBNAIL_DIR}/{user_id}_{checksum[:12]}_{THUMBNAIL_SIZES[size]}.{THUMBNAIL_EXT}'
+
+
+def render_thumbnails(source):
+    """
+    Decode `source` once and return {size: encoded bytes} for every
+    THUMBNAIL_SIZES entry.
+    """
+    largest = max(THUMBNAIL_SIZES.values())
+    with Image.open(source) as image:
+        # Let the JPEG decoder downscale by a power of two while decoding
+        image.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if THUMBNAIL_FORMAT == 'WEBP' and image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+    rendered = {}
+    for size, px in sorted(THUMBNAIL_SIZES.items(), key=lambda item: -item[1]):
+        thumb = ImageOps.fit(image, (px, px), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        thumb.save(buffer, THUMBNAIL_FORMAT, **SAVE_OPTIONS)
+        rendered[size] = buffer.getvalue()
+    return rendered
+
+
+def build_thumbnails(user_id, checksum):
+    """
+    Write the thumbnails for the picture `user_id` uploaded with `checksum`.
+    Does nothing if the picture has changed again since.
+    """
+    from .chat_list import invalidate_chat_lists_showing
+
+    try:
+        user = User.objects.filter(pk=user_id, avatar_checksum=checksum).first()
+        if user is None or not user.profile_picture:
+            return
+        storage = user.profile_picture.storage
+        try:
+            with user.profile_picture.open('rb') as source:
+                rendered = render_thumbnails(source)
+        except (OSError, UnidentifiedImageError, Image.DecompressionBombError) as e:
+            logger.warning("Could not build avatar thumbnails for user %s: %s", user_id, e)
+            return
+
+        for size, data in rendered.items():
+            name = thumbnail_name(user_id, checksum, size)
+            if storage.exists(name):
+                storage.delete(name)
+            storage.save(name, ContentFile(data))
+
+        User.objects.filter(pk=user_id, avatar_checksum=checksum).update(avatar_thumbnails_checksum=checksum)
+        invalidate_chat_lists_showing(user)
+    finally:
+        close_old_connections()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix='avatar-thumbs')
+        return _executor
+
+
+def schedule_thumbnails(user):
+    """Build `user`'s thumbnails in the background once the upload is committed."""
+    user_id, checksum = user.pk, user.avatar_checksum
+    transaction.on_commit(lambda: _get_executor().submit(build_thumbnails, user_id, checksum))
+
+
+def delete_thumbnails(user):
+    if not user.avatar_thumbnails_checksum:
+        return
+    storage = user.profile_picture.storage
+    for size in THUMBNAIL_SIZES:
+        name = thumbnail_name(user.pk, user.avatar_thumbnails_checksum, size)
+        if storage.exists(name):
+            storage.delete(name)
@@ -20,6 +20,9 @@ urlpatterns = [
     path('api/chats/active/', views.api_active_chats, name='api_active_chats'),
     path('api/chats/favourites/', views.api_favourite_chats, name='api_favourite_chats'),
     path('api/chats/archived/', views.api_archived_chats, name='api_archived_chats'),
+    path('api/chats/<int:chat_id>/messages/', views.chat_messages_api, name='chat_messages_api'),
+    path('api/chats/<int:chat_id>/export/', views.chat_export_api, name='chat_export_api'),
     path('api/chats/', views.chat_list_api, name='chat_list_api'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
 
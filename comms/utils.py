@@ -0,0 +1,81 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from .thumbnails import schedule_thumbnails, thumbnail_name
+
+DEFAULT_AVATAR_URL = 'https://media.tenor.com/t3dLLNaI50oAAAAM/cat-cats.gif'
+
+
+class LRUCache:
+    """Small thread-safe LRU mapping, bounded to `maxsize` entries."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def file_checksum(f):
+    digest = hashlib.sha1()
+    for chunk in f.chunks():
+        digest.update(chunk)
+    f.seek(0)
+    return digest.hexdigest()
+
+
+def set_profile_picture(user, upload):
+    """
+    Attach an uploaded picture to `user` and record its checksum, so avatar
+    URLs can be resolved from the row alone. The caller saves the user, in
+    the same transaction.atomic() block: thumbnails are built in the
+    background once that commits, and outside a transaction the build would
+    start before the save.
+    """
+    user.profile_picture = upload
+    user.avatar_checksum = file_checksum(upload)
+    schedule_thumbnails(user)
+
+
+def get_avatar_url(user, size=None):
+    """
+    Avatar URL for `user`, resolved from stored metadata without touching the
+    filesystem. `size` names a thumbnail (see thumbnails.THUMBNAIL_SIZES);
+    the original is served until that thumbnail has been built. The checksum
+    doubles as a cache-busting version so browsers refetch a changed picture;
+    pictures uploaded before checksums were recorded are served unversioned.
+    """
+    if not user.profile_picture:
+        return DEFAULT_AVATAR_URL
+    if not user.avatar_checksum:
+        return user.profile_picture.url
+    if size and user.avatar_thumbnails_checksum == user.avatar_checksum:
+        return user.profile_picture.storage.url(thumbnail_name(user.pk, user.avatar_checksum, size))
+    return f'{user.profile_picture.url}?v={user.avatar_checksum[:12]}'
+
+
+def format_phone(phone):
+    return phone[:3] + ' ' + phone[3:] if phone.startswith('+') and len(phone) > 3 else phone
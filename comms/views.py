@@ -1,15 +1,20 @@
 from django.contrib.auth import authenticate, login, logout
-from django.db import IntegrityError
-from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
-from django.shortcuts import render, redirect, get_object_or_404
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404, render, redirect
 from django.urls import reverse
-from .models import User, Chat, Message, ArchivedChat
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from .models import User, Chat, ChatMembership, Message, ArchivedChat
 from django.contrib.auth.decorators import login_required
-from django.db.models import Count, Exists, OuterRef, Q, Max
+from django.db.models import Exists, F, OuterRef, Q
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.cache import cache_control
 from django.views.decorators.http import require_http_methods, require_GET
 import json
 import os
+from functools import wraps
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
@@ -19,45 +24,22 @@ from .serializers import ChatSerializer, MessageSerializer
 import phonenumbers
 from django.utils.timezone import localtime
 from django.utils.dateformat import format as django_date_format
-
-def get_avatar_url(user):
-    if user.profile_picture:
-        media_path = os.path.join(settings.MEDIA_ROOT, user.profile_picture.name)
-        if os.path.exists(media_path):
-            return user.profile_picture.url
-
-    return 'https://media.tenor.com/t3dLLNaI50oAAAAM/cat-cats.gif'
-
-def build_chat_data(chat, user, unread_count=None, has_unread=None):
-    last_msg = chat.messages.order_by('-timestamp').first()
-    if not last_msg:
-        return None
-
-    others = chat.participants.exclude(id=user.id)
-    if others.exists():
-        other = others.first()
-        raw_phone = other.phone
-        formatted_phone = raw_phone[:3] + ' ' + raw_phone[3:] if raw_phone.startswith('+') and len(raw_phone) > 3 else raw_phone
-        name = other.name or formatted_phone
-        avatar = get_avatar_url(other)
-        phone = other.phone
-    else:
-        # Self chat
-        name = "You"
-        avatar = get_avatar_url(user)
-        phone = user.phone
-
-    return {
-        'id': chat.id,
-        'name': name,
-        'avatar': avatar,
-        'message': last_msg.text,
-        'time': localtime(last_msg.timestamp).strftime('%H:%M'),
-        'phone': phone,
-        'has_unread': has_unread if has_unread is not None else False,
-        'unread_count': unread_count if unread_count is not None else 0,
-    }
-
+from .chat_list import (
+    ACTIVE, ARCHIVED, FAVOURITE, aget_cached_chat_list, aget_chat_list_version, chat_list_validators,
+    filter_chat_list, get_cached_chat_list, invalidate_chat_lists, invalidate_chat_lists_showing, split_chat_list,
+)
+from .direct_chats import afind_direct_chat_by_phone, find_direct_chat_by_phone, get_or_create_direct_chat
+from .export import EXPORT_FORMATS, aexport_chat
+from .groups import areceipt_counts
+from .history import aget_message_page, clamp_page_size, get_message_page
+from . import metrics
+from .membership import (
+    aget_unread_count, get_unread_count, mark_chat_unread, mark_message_read as record_message_read, mark_messages_read,
+)
+from .presence import awith_presence, get_presence, presence_stamp, with_presence
+from .search import clamp_page_size as clamp_search_page_size, search_messages
+from .thumbnails import delete_thumbnails
+from .utils import format_phone, get_avatar_url, set_profile_picture
 
 def index(request):
     if not request.user.is_authenticated:
@@ -68,198 +50,73 @@ def index(request):
 
     user = request.user
 
-    # Annotate all chats with last_message_time and total unread messages (including own)
-    chats = Chat.objects.filter(participants=user).annotate(
-        last_message_time=Max('messages__timestamp'),
-        unread_total=Count('messages', filter=Q(messages__read=False)),  # all unread
-    ).order_by('-last_message_time')
-
-    # Archived and Favourite chat IDs
-    archived_chat_ids = set(
-        ArchivedChat.objects.filter(user=user).values_list('chat_id', flat=True)
-    )
-    favourite_chat_ids = set(user.favourite_chats.values_list('id', flat=True))
-
-    active_chats = []
-    archived_chats = []
-
-    for chat in chats:
-        # Check if self chat (only one participant)
-        is_self_chat = (chat.participants.count() == 1 and chat.participants.filter(id=user.id).exists())
-
-        if is_self_chat:
-            # For self chat, unread_count = all unread messages (unread_total)
-            unread_count = chat.unread_total
-        else:
-            # For normal chats, exclude unread messages sent by user
-            unread_count = chat.messages.filter(read=False).exclude(sender=user).count()
-
-        has_unread = unread_count > 0
-
-        chat_data = build_chat_data(chat, user, unread_count=unread_count, has_unread=has_unread)
-        if not chat_data:
-            continue
-
-        if chat.id in archived_chat_ids:
-            archived_chats.append(chat_data)
-        else:
-            active_chats.append(chat_data)
-
-    unread_chat_list = [c for c in active_chats if c['unread_count'] > 0]
-    favourite_chat_list = [c for c in active_chats if c['id'] in favourite_chat_ids]
-
     context = {
-        "profile_pic": get_avatar_url(user),
+        "profile_pic": get_avatar_url(user, 'large'),
         "name": user.name,
         "about": user.about,
-        "chats": active_chats,
-        "unreadchats": unread_chat_list,
-        "archived_chats": archived_chats,
-        "favouritechats": favourite_chat_list,
+        **split_chat_list(with_presence(get_cached_chat_list(user))),
     }
 
     return render(request, "comms/index.html", context)
 
+def chat_list_conditional(view):
+    """
+    Conditional GET for the chat-list views. The user's chat-list version (see
+    comms.chat_list) and the presence of the listed users make the ETag, and
+    the version the Last-Modified, so an unchanged list is answered with 304
+    Not Modified; the view receives the full list, with presence, as `chats`.
+    Django's condition() calls its callbacks synchronously, which cannot load
+    request.user inside an async view.
+    """
+    @wraps(view)
+    async def inner(request, *args, **kwargs):
+        user = await request.auser()
+        version = await aget_chat_list_version(user.id)
+        chats = await awith_presence(await aget_cached_chat_list(user, version=version))
+        etag, last_modified = chat_list_validators(user.id, version, presence_stamp(chats))
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = await view(request, *args, chats=chats, **kwargs)
+        if request.method in ('GET', 'HEAD'):
+            response.headers.setdefault('ETag', etag)
+            response.headers.setdefault('Last-Modified', http_date(last_modified))
+        return response
+    return inner
+
+
+# no-cache makes the browser revalidate the lists (If-None-Match) on every fetch
 @login_required
-def chat_list_api(request):
-    user = request.user
-
-    # Annotate chats with last_message_time and unread_total
-    chats = Chat.objects.filter(participants=user).annotate(
-        last_message_time=Max('messages__timestamp'),
-        unread_total=Count('messages', filter=Q(messages__read=False)),
-    ).order_by('-last_message_time')
-
-    archived_chat_ids = set(
-        ArchivedChat.objects.filter(user=user).values_list('chat_id', flat=True)
-    )
-    favourite_chat_ids = set(user.favourite_chats.values_list('id', flat=True))
-
-    active_chats = []
-    archived_chats = []
-
-    for chat in chats:
-        is_self_chat = (chat.participants.count() == 1 and chat.participants.filter(id=user.id).exists())
-
-        if is_self_chat:
-            unread_count = chat.unread_total
-        else:
-            unread_count = chat.messages.filter(read=False).exclude(sender=user).count()
-
-        has_unread = unread_count > 0
-
-        chat_data = build_chat_data(chat, user, unread_count=unread_count, has_unread=has_unread)
-        if not chat_data:
-            continue
-
-        if chat.id in archived_chat_ids:
-            archived_chats.append(chat_data)
-        else:
-            active_chats.append(chat_data)
-
-    unread_chat_list = [c for c in active_chats if c['unread_count'] > 0]
-    favourite_chat_list = [c for c in active_chats if c['id'] in favourite_chat_ids]
+@cache_control(private=True, no_cache=True)
+@chat_list_conditional
+async def chat_list_api(request, chats):
+    user = await request.auser()
 
     data = {
-        "profile_pic": get_avatar_url(user),
+        "profile_pic": get_avatar_url(user, 'large'),
         "name": user.name,
         "about": user.about,
-        "chats": active_chats,
-        "unreadchats": unread_chat_list,
-        "archived_chats": archived_chats,
-        "favouritechats": favourite_chat_list,
+        **split_chat_list(chats),
     }
 
     return JsonResponse(data)
 
 @login_required
-def api_active_chats(request):
-    user = request.user
-
-    chats = Chat.objects.filter(participants=user).annotate(
-        last_message_time=Max('messages__timestamp'),
-        unread_total=Count('messages', filter=Q(messages__read=False)),
-    ).order_by('-last_message_time')
-
-    archived_chat_ids = set(
-        ArchivedChat.objects.filter(user=user).values_list('chat_id', flat=True)
-    )
-
-    active_chats = []
-
-    for chat in chats:
-        if chat.id in archived_chat_ids:
-            continue  # skip archived in active chats
-
-        is_self_chat = (chat.participants.count() == 1 and chat.participants.filter(id=user.id).exists())
-        if is_self_chat:
-            unread_count = chat.unread_total
-        else:
-            unread_count = chat.messages.filter(read=False).exclude(sender=user).count()
-
-        has_unread = unread_count > 0
-
-        chat_data = build_chat_data(chat, user, unread_count=unread_count, has_unread=has_unread)
-        if chat_data:
-            active_chats.append(chat_data)
-
-    return JsonResponse(active_chats, safe=False)
+@cache_control(private=True, no_cache=True)
+@chat_list_conditional
+async def api_active_chats(request, chats):
+    return JsonResponse(filter_chat_list(chats, ACTIVE), safe=False)
 
 @login_required
-def api_favourite_chats(request):
-    user = request.user
-    favourite_chat_ids = set(user.favourite_chats.values_list('id', flat=True))
-
-    chats = Chat.objects.filter(id__in=favourite_chat_ids).annotate(
-        last_message_time=Max('messages__timestamp'),
-        unread_total=Count('messages', filter=Q(messages__read=False)),
-    ).order_by('-last_message_time')
-
-    favourite_chats = []
-
-    for chat in chats:
-        is_self_chat = (chat.participants.count() == 1 and chat.participants.filter(id=user.id).exists())
-        if is_self_chat:
-            unread_count = chat.unread_total
-        else:
-            unread_count = chat.messages.filter(read=False).exclude(sender=user).count()
-
-        has_unread = unread_count > 0
-
-        chat_data = build_chat_data(chat, user, unread_count=unread_count, has_unread=has_unread)
-        if chat_data:
-            favourite_chats.append(chat_data)
-
-    return JsonResponse(favourite_chats, safe=False)
+@cache_control(private=True, no_cache=True)
+@chat_list_conditional
+async def api_favourite_chats(request, chats):
+    return JsonResponse(filter_chat_list(chats, FAVOURITE), safe=False)
 
 @login_required
-def api_archived_chats(request):
-    user = request.user
-    archived_chat_ids = set(
-        ArchivedChat.objects.filter(user=user).values_list('chat_id', flat=True)
-    )
-
-    chats = Chat.objects.filter(id__in=archived_chat_ids).annotate(
-        last_message_time=Max('messages__timestamp'),
-        unread_total=Count('messages', filter=Q(messages__read=False)),
-    ).order_by('-last_message_time')
-
-    archived_chats = []
-
-    for chat in chats:
-        is_self_chat = (chat.participants.count() == 1 and chat.participants.filter(id=user.id).exists())
-        if is_self_chat:
-            unread_count = chat.unread_total
-        else:
-            unread_count = chat.messages.filter(read=False).exclude(sender=user).count()
-
-        has_unread = unread_count > 0
-
-        chat_data = build_chat_data(chat, user, unread_count=unread_count, has_unread=has_unread)
-        if chat_data:
-            archived_chats.append(chat_data)
-
-    return JsonResponse(archived_chats, safe=False)
+@cache_control(private=True, no_cache=True)
+@chat_list_conditional
+async def api_archived_chats(request, chats):
+    return JsonResponse(filter_chat_list(chats, ARCHIVED), safe=False)
 
 
 def login_view(request):
@@ -332,9 +189,12 @@ def setup(request):
         profile_picture = request.FILES.get('profile_picture')
         if name:
             user.name = name
-        if profile_picture:
-            user.profile_picture = profile_picture
-        user.save()
+        # Thumbnails are scheduled for when this commits, after the save
+        with transaction.atomic():
+            if profile_picture:
+                set_profile_picture(user, profile_picture)
+            user.save()
+            invalidate_chat_lists_showing(user)
         print("done")
         return redirect('index')
     return render(request, 'comms/setup.html')
@@ -363,6 +223,7 @@ def setup_api(request):
 
         if updated:
             user.save()
+            invalidate_chat_lists_showing(user)
             return JsonResponse({'status': 'success'})
         else:
             return JsonResponse({'error': 'No valid fields to update'}, status=400)
@@ -374,8 +235,11 @@ def setup_api(request):
                 old_path = os.path.join(settings.MEDIA_ROOT, user.profile_picture.name)
                 if os.path.exists(old_path):
                     os.remove(old_path)
-            user.profile_picture = profile_picture
-            user.save()
+                delete_thumbnails(user)
+            with transaction.atomic():
+                set_profile_picture(user, profile_picture)
+                user.save()
+                invalidate_chat_lists_showing(user)
             return JsonResponse({'status': 'success'})
 
         return JsonResponse({'error': 'No profile picture uploaded'}, status=400)
@@ -384,43 +248,60 @@ def setup_api(request):
         return JsonResponse({'error': 'Unsupported method'}, status=405)
 
 @login_required
-def search_users(request):
+async def search_users(request):
     query = request.GET.get('q', '').strip()
-    user = request.user
+    user = await request.auser()
 
     if not query:
         return JsonResponse({'chats': [], 'people': [], 'messages': []})
 
-    # 1. Active chats the user is in, annotated with message count
-    active_chats = Chat.objects.filter(participants=user).annotate(
-        message_count=Count('messages')
-    )
-
-    # 2. Filter out chats with no messages
-    chats_with_messages = active_chats.filter(message_count__gt=0)
-
-    # 3. Users in those chats (excluding self)
-    users_in_active_chats = User.objects.filter(
-        chats__in=chats_with_messages
-    ).exclude(id=user.id).distinct()
+    # Everything below is assembled from batched lookups keyed by chat and user id,
+    # so the number of queries does not grow with the number of results.
 
-    # 4. Users matching query by phone or name (excluding self)
-    matched_users = User.objects.filter(
+    # 1. Users matching query by phone or name (excluding self)
+    matched_users = [u async for u in User.objects.filter(
         Q(phone__icontains=query) | Q(name__icontains=query)
-    ).exclude(id=user.id).distinct()
-
-    # 5. Split matched users into chat users and people
-    chats_users = users_in_active_chats.filter(id__in=matched_users.values_list('id', flat=True))
-    people_users = matched_users.exclude(id__in=chats_users.values_list('id', flat=True))
+    ).exclude(id=user.id)]
+    matched_ids = [u.id for u in matched_users]
+
+    # 2. The user's chats shared with any matched user, one row per (chat, matched user)
+    shared_chats = ChatMembership.objects.filter(
+        user=user, chat__participants__in=matched_ids
+    ).values(
+        'chat_id', 'unread_count', 'last_message_id', 'last_message__text', 'last_message__timestamp',
+        other_id=F('chat__participants'), is_group=F('chat__is_group'), created_at=F('chat__created_at'),
+    )
 
-    # 6. Matched messages in all user chats (including empty ones)
-    matched_messages = Message.objects.filter(
-        chat__in=active_chats,
-        text__icontains=query
-    ).select_related('chat').prefetch_related('chat__participants').order_by('-timestamp')[:50]
+    # 3. Split matched users into chat users (share a chat with messages) and people;
+    #    a chat user's preview comes from their newest direct chat with the user
+    chat_user_ids = set()
+    direct_chats = {}
+    async for row in shared_chats:
+        if row['last_message_id'] is not None:
+            chat_user_ids.add(row['other_id'])
+        if not row['is_group']:
+            current = direct_chats.get(row['other_id'])
+            if current is None or row['created_at'] > current['created_at']:
+                direct_chats[row['other_id']] = row
+    chats_users = [u for u in matched_users if u.id in chat_user_ids]
+    people_users = [u for u in matched_users if u.id not in chat_user_ids]
+
+    # 4. Ranked full-text hits in all user chats (including empty ones)
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    # The search backends run raw SQL, which has no async API
+    matched_messages, messages_has_more = await sync_to_async(search_messages)(
+        user, query, page=page, limit=clamp_search_page_size(request.GET.get('limit'))
+    )
 
-    def format_phone(phone):
-        return phone[:3] + ' ' + phone[3:] if phone.startswith('+') and len(phone) > 3 else phone
+    # 5. The other participant of every hit's chat, in one query
+    other_participants = {}
+    async for link in Chat.participants.through.objects.filter(
+        chat_id__in={m.chat_id for m in matched_messages}
+    ).exclude(user_id=user.id).select_related('user').order_by('user_id'):
+        other_participants.setdefault(link.chat_id, link.user)
 
     def format_user(u):
         raw_phone = u.phone
@@ -429,29 +310,27 @@ def search_users(request):
             'username': u.username,
             'phone': format_phone(raw_phone),
             'name': u.name or format_phone(raw_phone),
-            'profile_picture': get_avatar_url(u),
+            'profile_picture': get_avatar_url(u, 'small'),
             'fullphone': raw_phone,
             'about': u.about,
         }
 
     def format_chat_user(u):
-        chat = Chat.objects.filter(participants=user, is_group=False).filter(participants=u).order_by('-created_at').first()
-        if chat:
-            last_msg = chat.messages.order_by('-timestamp').first()
-            last_message_text = last_msg.text if last_msg else ''
-            last_message_time = localtime(last_msg.timestamp).strftime('%H:%M') if last_msg else ''
-            unread_count = chat.messages.filter(read=False).exclude(sender=user).count()
+        chat = direct_chats.get(u.id)
+        if chat and chat['last_message_id'] is not None:
+            last_message_text = chat['last_message__text']
+            last_message_time = localtime(chat['last_message__timestamp']).strftime('%H:%M')
         else:
             last_message_text = ''
             last_message_time = ''
-            unread_count = 0
+        unread_count = chat['unread_count'] if chat else 0
 
         return {
             'id': u.id,
             'username': u.username,
             'phone': format_phone(u.phone),
             'name': u.name or format_phone(u.phone),
-            'profile_picture': get_avatar_url(u),
+            'profile_picture': get_avatar_url(u, 'small'),
             'fullphone': u.phone,
             'last_message_preview': last_message_text,
             'last_message_time': last_message_time,
@@ -459,24 +338,24 @@ def search_users(request):
         }
 
     def format_message(m):
-        snippet = m.text[:97] + '...' if len(m.text) > 100 else m.text
-        other_user = m.chat.participants.exclude(id=user.id).first()
+        other_user = other_participants.get(m.chat_id)
         other_user_data = {
             'id': other_user.id if other_user else None,
             'username': other_user.username if other_user else None,
             'phone': format_phone(other_user.phone) if other_user else None,
             'name': other_user.name if other_user else None,
-            'profile_picture': get_avatar_url(other_user) if other_user else None,
+            'profile_picture': get_avatar_url(other_user, 'small') if other_user else None,
             'fullphone': other_user.phone if other_user else None,
             'about': other_user.about if other_user else '',
         }
 
-        chat_name = f"Group Chat {m.chat.id}" if m.chat.is_group else other_user_data['name']
+        chat_name = f"Group Chat {m.chat_id}" if m.chat.is_group else other_user_data['name']
         return {
             'messageId': m.id,
-            'chatId': m.chat.id,
+            'chatId': m.chat_id,
             'chatName': chat_name,
-            'snippet': snippet,
+            'snippet': m.search_snippet,
+            'rank': m.search_rank,
             'otherUser': other_user_data,
             'time': localtime(m.timestamp).strftime('%H:%M'),
         }
@@ -485,6 +364,8 @@ def search_users(request):
         'chats': [format_chat_user(u) for u in chats_users],
         'people': [format_user(u) for u in people_users],
         'messages': [format_message(m) for m in matched_messages],
+        'messagesPage': page,
+        'messagesHasMore': messages_has_more,
         'selfUser': format_user(user),  # 👈 Include the current user info
     })
 
@@ -502,22 +383,9 @@ def get_or_create_chat(request):
         return Response({'error': 'User not found'}, status=404)
 
     current_user = request.user
+    chat, created = get_or_create_direct_chat(current_user, other_user)
 
-    if current_user == other_user:
-        chats = Chat.objects.annotate(num_participants=Count('participants')) \
-                            .filter(participants=current_user, num_participants=1)
-    else:
-        chats = Chat.objects.filter(participants=current_user).filter(participants=other_user)
-
-    if chats.exists():
-        chat = chats.first()
-        created = False
-    else:
-        chat = Chat.objects.create()
-        chat.participants.set([current_user, other_user])
-        created = True
-
-    messages = Message.objects.filter(chat=chat)
+    messages, has_more = get_message_page(chat)
     serialized_messages = MessageSerializer(messages, many=True).data
 
     try:
@@ -528,6 +396,9 @@ def get_or_create_chat(request):
         country_code = ''
         local_number = other_phone
 
+    presence = get_presence([other_user.id])[other_user.id]
+    last_seen = max(filter(None, [presence['last_seen'], other_user.last_seen]), default=None)
+
     # Determine display name
     if not other_user.name:
         username = f"{country_code} {local_number}"
@@ -539,22 +410,69 @@ def get_or_create_chat(request):
         'other_user': {
             'username': username,
             'phone': other_user.phone,
-            'profile_pic': get_avatar_url(other_user),
+            'profile_pic': get_avatar_url(other_user, 'large'),
             'about': other_user.about,
             'parsed_phone': f"{country_code} {local_number}", 
+            'id': other_user.id,
+            'online': presence['online'],
+            'last_seen': last_seen.isoformat() if last_seen else None,
         },
         'messages': serialized_messages,
+        'has_more': has_more,
         'created': created
     })
 
 
+@login_required
+@require_GET
+async def chat_messages_api(request, chat_id):
+    chat = await aget_object_or_404(Chat, pk=chat_id, participants=await request.auser())
+
+    try:
+        before_id = int(request.GET['before_id']) if request.GET.get('before_id') else None
+        after_id = int(request.GET['after_id']) if request.GET.get('after_id') else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+    if before_id is not None and after_id is not None:
+        return JsonResponse({'error': 'Use either before_id or after_id, not both'}, status=400)
+
+    limit = clamp_page_size(request.GET.get('limit'))
+    messages, has_more = await aget_message_page(chat, before_id=before_id, after_id=after_id, limit=limit)
+
+    data = MessageSerializer(messages, many=True).data
+    if chat.is_group:
+        # "Read by k of n" from the members' watermarks, for the whole page at once
+        counts = await areceipt_counts(chat.id, messages)
+        data = [{**message, **counts[message['id']]} for message in data]
+
+    return JsonResponse({
+        'messages': data,
+        'has_more': has_more,
+    })
+
+
+@login_required
+@require_GET
+async def chat_export_api(request, chat_id):
+    chat = await aget_object_or_404(Chat, pk=chat_id, participants=await request.auser())
+
+    fmt = request.GET.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return JsonResponse({'error': f"Format must be one of: {', '.join(EXPORT_FORMATS)}"}, status=400)
+
+    content_type, extension = EXPORT_FORMATS[fmt]
+    response = StreamingHttpResponse(aexport_chat(chat, fmt), content_type=f'{content_type}; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="chat-{chat.id}.{extension}"'
+    return response
+
+
 @login_required
 def mark_message_read(request, message_id):
     if request.method == "POST":
         try:
-            msg = Message.objects.get(pk=message_id, chat__participants=request.user)
-            msg.read = True
-            msg.save()
+            msg = Message.objects.select_related('chat').get(pk=message_id, chat__participants=request.user)
+            record_message_read(msg, reader=request.user)
             return JsonResponse({'status': 'ok'})
         except Message.DoesNotExist:
             return JsonResponse({'error': 'Message not found'}, status=404)
@@ -563,36 +481,24 @@ def mark_message_read(request, message_id):
 
 @login_required
 @require_GET
-def chat_status_api(request):
+async def chat_status_api(request):
     phone = request.GET.get('phone')
-    user = request.user
+    user = await request.auser()
 
     if not phone:
         return JsonResponse({'error': 'Missing phone parameter'}, status=400)
 
     try:
-        if phone == user.phone:
-            # Self chat: find chat with exactly one participant = user
-            chat = Chat.objects.annotate(num_participants=Count('participants')) \
-                               .filter(num_participants=1, participants=user) \
-                               .first()
-            # For self-chat, do NOT exclude sender when counting unread
-            unread_messages_count = chat.messages.filter(read=False).count() if chat else 0
-        else:
-            # Normal chat between user and the phone
-            chat = Chat.objects.filter(participants__phone=user.phone) \
-                               .filter(participants__phone=phone) \
-                               .distinct() \
-                               .first()
-            # For normal chat, exclude messages sent by user
-            unread_messages_count = chat.messages.filter(read=False).exclude(sender=user).count() if chat else 0
+        chat = await afind_direct_chat_by_phone(user, phone)
 
         if not chat:
             return JsonResponse({'error': 'Chat not found'}, status=404)
 
-        is_archived = ArchivedChat.objects.filter(user=user, chat=chat).exists()
+        unread_messages_count = await aget_unread_count(user, chat)
+
+        is_archived = await ArchivedChat.objects.filter(user=user, chat=chat).aexists()
         has_unread = unread_messages_count > 0
-        is_favourite = user.favourite_chats.filter(pk=chat.pk).exists()
+        is_favourite = await user.favourite_chats.filter(pk=chat.pk).aexists()
 
         return JsonResponse({
             'is_archived': is_archived,
@@ -622,15 +528,7 @@ def chat_toggle_api(request):
     if not phone or not action:
         return JsonResponse({'error': 'Missing parameters'}, status=400)
 
-    # Special case: if user phone == target phone, find chats with exactly 1 participant = user (self-chat)
-    if phone == user.phone:
-        chat = Chat.objects.annotate(num_participants=Count('participants')) \
-                           .filter(num_participants=1, participants=user) \
-                           .first()
-    else:
-        # Normal case: chat with both user and target phone as participants
-        chat = Chat.objects.filter(participants__phone=user.phone) \
-                           .filter(participants__phone=phone).distinct().first()
+    chat = find_direct_chat_by_phone(user, phone)
 
     if not chat:
         return JsonResponse({'error': 'Chat not found'}, status=404)
@@ -644,18 +542,12 @@ def chat_toggle_api(request):
                 user.archived_chats.create(chat=chat)
 
         elif action == 'mark-read':
-            # For self-chat, don't exclude sender (because sender == user)
-            if phone == user.phone:
-                unread_msgs = chat.messages.filter(read=False)
-            else:
-                unread_msgs = chat.messages.filter(read=False).exclude(sender=user)
-
-            has_unread = unread_msgs.exists()
-
-            if has_unread:
-                unread_msgs.update(read=True)
-            else:
-                chat.messages.filter(read=True).update(read=False)
+            # Reads what the user received (everything in a self chat); with
+            # nothing left to read, marks the chat unread again
+            with transaction.atomic():
+                unread = chat.messages.filter(read=False).values('id')
+                if not mark_messages_read(chat.id, user, message_ids=unread):
+                    mark_chat_unread(chat.id)
 
         elif action == 'favourite':
             if chat in user.favourite_chats.all():
@@ -666,11 +558,8 @@ def chat_toggle_api(request):
         else:
             return JsonResponse({'error': 'Invalid action'}, status=400)
 
-        # Also adjust unread count for response accordingly
-        if phone == user.phone:
-            unread_messages_count = chat.messages.filter(read=False).count()
-        else:
-            unread_messages_count = chat.messages.filter(read=False).exclude(sender=user).count()
+        invalidate_chat_lists([user.id])
+        unread_messages_count = get_unread_count(user, chat)
 
         is_archived = user.archived_chats.filter(chat=chat).exists()
         has_unread = unread_messages_count > 0
@@ -686,3 +575,10 @@ def chat_toggle_api(request):
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+
+
+@require_GET
+def metrics_view(request):
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,212 @@
+"""
+Optimistic message sends with write-behind persistence.
+
+A message frame that carries a `client_msg_id` is broadcast as soon as it has
+an id, and the message is handed to a per-process queue that writes
+everything pending with one bulk_create (plus one counter UPDATE per chat)
+every WRITE_BEHIND_INTERVAL seconds, or sooner once WRITE_BEHIND_MAX_BATCH
+messages are waiting.
+
+Durability is at least once. The sender is told with a `persisted` ack once
+its message is committed, and keeps it in an outbox until then, resending it
+after a reconnect. A resend is recognised by (sender, client_msg_id) through
+the shared cache for MESSAGE_DEDUP_TTL seconds. It gets the id and time it was
+first given, and is acked from the database if a message with that client id
+is stored there, by whichever process wrote it; it is only written again if
+none is. A failed flush keeps its batch and is retried.
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .membership import record_messages
+from .flow_control import database_sync_to_async
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_INTERVAL = getattr(settings, 'WRITE_BEHIND_INTERVAL', 0.005)
+WRITE_BEHIND_MAX_BATCH = getattr(settings, 'WRITE_BEHIND_MAX_BATCH', 500)
+WRITE_BEHIND_RETRY_DELAY = 1.0
+DEDUP_TTL = getattr(settings, 'MESSAGE_DEDUP_TTL', 86400)
+MAX_CLIENT_MSG_ID_LENGTH = Message._meta.get_field('client_msg_id').max_length
+
+
+def dedup_key(sender_id, client_msg_id):
+    return f'msg:client:{sender_id}:{client_msg_id}'
+
+
+def _stored(messages):
+    """Of `messages`, the ids and the (sender, client id) pairs already in the database, in one query."""
+    resent = [m for m in messages if m.client_msg_id]
+    by_client_id = Q(sender_id__in={m.sender_id for m in resent}, client_msg_id__in={m.client_msg_id for m in resent})
+    rows = Message.objects.filter(Q(id__in=[m.id for m in messages]) | by_client_id) \
+        .values_list('id', 'sender_id', 'client_msg_id')
+    ids, client_ids = set(), set()
+    for message_id, sender_id, client_msg_id in rows:
+        ids.add(message_id)
+        if client_msg_id is not None:
+            client_ids.add((sender_id, client_msg_id))
+    return ids, client_ids
+
+
+def persist_messages(messages):
+    """
+    Insert the messages not stored yet, by id or by client id, and count them
+    into the chats' counters, in one transaction. Returns (stored ids,
+    {chat_id: {user_id: unread_count}}) for the messages inserted by this call.
+    """
+    with transaction.atomic():
+        ids, client_ids = _stored(messages)
+        new = [m for m in messages if m.id not in ids and (m.sender_id, m.client_msg_id) not in client_ids]
+        Message.objects.bulk_create(new)
+        return [m.id for m in new], record_messages(new)
+
+
+def persist_each(messages):
+    """
+    persist_messages one message at a time, after a batch failed on an
+    integrity error, so that one bad message (say, for a chat deleted in the
+    meantime) cannot hold up the others. Returns (stored ids, unread counts,
+    ids rejected).
+    """
+    stored, unread_counts, rejected = [], {}, []
+    for message in messages:
+        try:
+            ids, counts = persist_messages([message])
+        except IntegrityError:
+            ids, client_ids = _stored([message])
+            if ids or client_ids:
+                # Another process stored it in the meantime
+                continue
+            logger.warning("Dropping message %s: chat %s rejected it", message.id, message.chat_id)
+            rejected.append(message.id)
+            continue
+        stored += ids
+        unread_counts.update(counts)
+    return stored, unread_counts, rejected
+
+
+class WriteBehindQueue:
+    """
+    Messages waiting to be written, flushed in batches by a background task
+    on the event loop. `enqueue` returns a future that resolves, once the
+    message is committed, to the {user_id: unread_count} of its chat after the
+    flush (None if an earlier flush had already stored it).
+    """
+
+    def __init__(self, interval=WRITE_BEHIND_INTERVAL, max_batch=WRITE_BEHIND_MAX_BATCH):
+        self.interval = interval
+        self.max_batch = max_batch
+        self._pending = {}
+        self._loop = None
+        self._task = None
+        self._full = None
+        self._lock = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def pending_in(self, chat_id):
+        return any(message.chat_id == chat_id for message, _ in self._pending.values())
+
+    def pending(self, message_id):
+        """(message, future) if `message_id` is waiting to be written here, else None."""
+        return self._pending.get(message_id)
+
+    def enqueue(self, message):
+        if message.id in self._pending:
+            return self._pending[message.id][1]
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # First use, or a new event loop (tests run one per case)
+            self._loop = loop
+            self._full = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._task = None
+        future = loop.create_future()
+        self._pending[message.id] = (message, future)
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        return future
+
+    async def _run(self):
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            if not await self.flush():
+                await asyncio.sleep(WRITE_BEHIND_RETRY_DELAY)
+
+    async def flush(self):
+        """Write up to max_batch pending messages now. Returns False if the write failed."""
+        if self._lock is None:
+            return True
+        async with self._lock:
+            batch = list(self._pending.values())[:self.max_batch]
+            if not batch:
+                return True
+            messages = [m for m, _ in batch]
+            rejected = ()
+            try:
+                try:
+                    stored, unread_counts = await database_sync_to_async(persist_messages)(messages)
+                except IntegrityError:
+                    stored, unread_counts, rejected = await database_sync_to_async(persist_each)(messages)
+            except Exception:
+                logger.exception("Writing %d messages failed; will retry", len(batch))
+                return False
+            stored = set(stored)
+            for message, future in batch:
+                del self._pending[message.id]
+                if future.done():
+                    continue
+                if message.id in rejected:
+                    future.set_exception(IntegrityError(f"Message {message.id} could not be stored"))
+                else:
+                    future.set_result(unread_counts[message.chat_id] if message.id in stored else None)
+            return True
+
+
+write_behind = WriteBehindQueue()
+
+
+async def accept_message(sender, chat_id, text, client_msg_id):
+    """
+    Take a message sent with a client id. Returns (message, future, is_new):
+    the message with its server id and time, a future for its persistence
+    (None if it is already stored), and whether to broadcast it, which is
+    false for a resend of a message that is pending or stored.
+    """
+    # The id is given as the message is made (see comms.ids)
+    message = Message(
+        chat_id=int(chat_id), sender=sender, text=text, timestamp=timezone.now(), client_msg_id=client_msg_id,
+    )
+    key = dedup_key(sender.id, client_msg_id)
+    if await cache.aadd(key, (message.id, message.timestamp), DEDUP_TTL):
+        return message, write_behind.enqueue(message), True
+
+    first = await cache.aget(key)
+    if first is None:
+        # Expired between the two calls; treat it as new
+        return message, write_behind.enqueue(message), True
+    message.id, message.timestamp = first
+    pending = write_behind.pending(message.id)
+    if pending is not None:
+        return pending[0], pending[1], False
+    stored = await Message.objects.filter(sender=sender, client_msg_id=client_msg_id) \
+        .values_list('id', 'timestamp').afirst()
+    if stored is not None:
+        message.id, message.timestamp = stored
+        return message, None, False
+    # Accepted before but lost (e.g. the worker stopped before flushing): write it again
+    return message, write_behind.enqueue(message), True
@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'comms.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware', # Add this line
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -144,11 +145,45 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+# Channel layer
+# Without REDIS_URL every daphne process gets its own in-memory layer, so only
+# run one. Set REDIS_URL to run several: a comma-separated list of redis:// URLs
+# shards channels and groups across those hosts.
+#   CHANNEL_LAYER_CAPACITY        messages buffered per channel before ChannelFull (100)
+#   CHANNEL_LAYER_EXPIRY          seconds an undelivered message is kept (60)
+#   CHANNEL_LAYER_GROUP_EXPIRY    seconds a group membership lives without refresh (86400)
+#   CHANNEL_LAYER_CHANNEL_CAPACITY  overrides by channel-name pattern, e.g. "specific.*=50"
+#                                 (group_send checks the capacity of each member's channel)
+#   CHANNEL_LAYER_PREFIX          key prefix, to share one Redis between deployments (asgi)
+REDIS_HOSTS = [url.strip() for url in os.getenv('REDIS_URL', '').split(',') if url.strip()]
+
+if REDIS_HOSTS:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': REDIS_HOSTS,
+                'prefix': os.getenv('CHANNEL_LAYER_PREFIX', 'asgi'),
+                'capacity': int(os.getenv('CHANNEL_LAYER_CAPACITY', 100)),
+                'expiry': int(os.getenv('CHANNEL_LAYER_EXPIRY', 60)),
+                'group_expiry': int(os.getenv('CHANNEL_LAYER_GROUP_EXPIRY', 86400)),
+                'channel_capacity': {
+                    pattern.strip(): int(capacity)
+                    for pattern, capacity in (
+                        item.split('=', 1)
+                        for item in os.getenv('CHANNEL_LAYER_CHANNEL_CAPACITY', '').split(',')
+                        if '=' in item
+                    )
+                },
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        }
     }
-}
 
 CSRF_TRUSTED_ORIGINS = [
     'http://127.0.0.1',
@@ -157,3 +192,92 @@ CSRF_TRUSTED_ORIGINS = [
     'https://messenger-ybyw.onrender.com',
 ]
 STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
+
+# Cache (per-user chat lists, see comms.chat_list)
+# Shared through Redis when REDIS_URL is set, so an invalidation in one process
+# is seen by all; otherwise a per-process memory cache.
+#   CHAT_LIST_CACHE_TIMEOUT       seconds a cached chat list is kept (300)
+if REDIS_HOSTS:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_HOSTS,
+            'KEY_PREFIX': os.getenv('CHANNEL_LAYER_PREFIX', 'asgi'),
+        }
+    }
+
+CHAT_LIST_CACHE_TIMEOUT = int(os.getenv('CHAT_LIST_CACHE_TIMEOUT', 300))
+# Seconds the member ids of a chat are cached for the WebSocket consumers
+# (comms.participants); changes to participants drop them at once
+CHAT_MEMBERS_CACHE_TIMEOUT = int(os.getenv('CHAT_MEMBERS_CACHE_TIMEOUT', 3600))
+
+# Message storage. On Postgres messages are partitioned by month (comms.partitions);
+# `manage.py maintain_message_storage` keeps partitions ready and, with --archive,
+# moves old read messages into compressed cold blocks (comms.cold_archive).
+#   MESSAGE_PARTITION_MONTHS_AHEAD  months of partitions created ahead of time (3)
+#   MESSAGE_ARCHIVE_AFTER_DAYS      age in days after which messages are archived (unset: never)
+MESSAGE_PARTITION_MONTHS_AHEAD = int(os.getenv('MESSAGE_PARTITION_MONTHS_AHEAD', 3))
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv('MESSAGE_ARCHIVE_AFTER_DAYS')) if os.getenv('MESSAGE_ARCHIVE_AFTER_DAYS') else None
+
+# Optimistic sends (see comms.write_behind): messages that carry a client_msg_id
+# are broadcast at once and written in batches.
+#   WRITE_BEHIND_INTERVAL         seconds between batch writes (0.005)
+#   WRITE_BEHIND_MAX_BATCH        messages that trigger a write before the interval ends (500)
+#   MESSAGE_DEDUP_TTL             seconds a client_msg_id is remembered to drop resends (86400)
+#   MESSAGE_ID_WORKER             worker id for message ids, 0-1023 (unset: leased from the shared
+#                                 cache; 0 without REDIS_URL, where only one process may run)
+#   MESSAGE_ID_LEASE              seconds a leased worker id is held between renewals (60)
+WRITE_BEHIND_INTERVAL = float(os.getenv('WRITE_BEHIND_INTERVAL', 0.005))
+WRITE_BEHIND_MAX_BATCH = int(os.getenv('WRITE_BEHIND_MAX_BATCH', 500))
+MESSAGE_DEDUP_TTL = int(os.getenv('MESSAGE_DEDUP_TTL', 86400))
+if os.getenv('MESSAGE_ID_WORKER'):
+    MESSAGE_ID_WORKER = int(os.getenv('MESSAGE_ID_WORKER'))
+else:
+    MESSAGE_ID_WORKER = None if REDIS_HOSTS else 0
+MESSAGE_ID_LEASE = int(os.getenv('MESSAGE_ID_LEASE', 60))
+
+# Presence and typing (see comms.presence), kept in the cache above
+#   PRESENCE_TTL                  seconds a user stays online after their last heartbeat (60)
+#   PRESENCE_HEARTBEAT_INTERVAL   seconds between client heartbeats (25)
+#   LAST_SEEN_FLUSH_INTERVAL      seconds between batched writes of User.last_seen (30)
+#   TYPING_THROTTLE               seconds between typing events relayed per user and chat (3)
+PRESENCE_TTL = int(os.getenv('PRESENCE_TTL', 60))
+PRESENCE_HEARTBEAT_INTERVAL = int(os.getenv('PRESENCE_HEARTBEAT_INTERVAL', 25))
+LAST_SEEN_FLUSH_INTERVAL = int(os.getenv('LAST_SEEN_FLUSH_INTERVAL', 30))
+TYPING_THROTTLE = int(os.getenv('TYPING_THROTTLE', 3))
+
+# WebSocket flow control (see comms.flow_control), per worker process
+#   WS_MAX_CONNECTIONS            sockets accepted before new ones are refused (10000)
+#   WS_MAX_FRAME_BYTES            largest client frame handled (65536)
+#   WS_CONNECTION_RATE            frames per second per socket, and burst ("10,30")
+#   WS_USER_RATE                  frames per second per user over all their sockets, and burst ("20,60")
+#   WS_SEND_QUEUE_SIZE            frames queued for a slow client before state frames are dropped (256)
+#   DB_TASK_LIMIT                 database_sync_to_async calls running at once (16)
+WS_MAX_CONNECTIONS = int(os.getenv('WS_MAX_CONNECTIONS', 10000))
+WS_MAX_FRAME_BYTES = int(os.getenv('WS_MAX_FRAME_BYTES', 65536))
+WS_CONNECTION_RATE = tuple(float(x) for x in os.getenv('WS_CONNECTION_RATE', '10,30').split(','))
+WS_USER_RATE = tuple(float(x) for x in os.getenv('WS_USER_RATE', '20,60').split(','))
+WS_SEND_QUEUE_SIZE = int(os.getenv('WS_SEND_QUEUE_SIZE', 256))
+DB_TASK_LIMIT = int(os.getenv('DB_TASK_LIMIT', 16))
+
+# Metrics (see comms.metrics), served in Prometheus format on /metrics
+#   METRICS_ALLOWED_IPS           comma-separated client addresses allowed to scrape (127.0.0.1,::1)
+# Query budgets: a request or WebSocket frame that runs more queries than its
+# budget is logged as a warning. Keys are URL names, or "ws:<frame type>".
+METRICS_ALLOWED_IPS = [ip.strip() for ip in os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip.strip()]
+METRICS_DEFAULT_QUERY_BUDGET = 20
+METRICS_QUERY_BUDGETS = {
+    'chat_list_api': 6,
+    'api_active_chats': 6,
+    'api_favourite_chats': 6,
+    'api_archived_chats': 6,
+    'search_users': 10,
+    'chat_messages_api': 7,  # one more in group chats, for the receipt counts
+    'chat-status-api': 8,
+    'get_or_create_chat': 16,
+    'ws:message': 6,
+    'ws:delivered': 6,
+    'ws:read': 10,
+    'ws:typing': 2,
+    'ws:heartbeat': 0,
+}